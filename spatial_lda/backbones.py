@@ -0,0 +1,319 @@
+"""Registry of the torchvision feature backbones we sweep over (see
+experiments/experiment_calls.txt).
+
+Each entry knows how to build the network, where to truncate it by default,
+which input transform it expects and how large its input is, from which the
+shape of its descriptors follows.  Weights are read from a local directory
+so that offline nodes never touch the network: the first time a model is
+requested with pretrained weights they are downloaded (if possible) and
+saved there as <name>.pth.  Truncated models are pickled as well, together
+with their descriptor shape, so a sweep cell starts by loading just the
+layers it needs instead of building and trimming the full network.
+
+Students distilled from a truncated backbone (see train_cnn.distillStudent)
+are backbones too: their architecture is saved next to their weights as
+<name>.json, and get_backbone_spec registers them from there.
+"""
+
+import os
+import json
+
+import torch
+import torchvision
+
+from dataset import data_root, alexnet_transform, inception_transform, \
+    get_model_transform, get_eval_transform
+from inference_engine import FeatureTaps, inference_context, resolve_tap
+
+default_weights_root = os.path.join(data_root, "backbone_weights")
+default_truncated_root = os.path.join(data_root, "truncated_backbones")
+
+
+class BackboneSpec:
+    """How to build and truncate one backbone.
+
+    Arguments:
+        name (str): torchvision constructor name.
+        default_tap: Truncation point used when none is given: an int
+            counts top-level layers removed (like cnn_num_layers_removed), a
+            str names the module whose output is kept.
+        input_size (int): Side of the square input crop.
+        sequential (bool): Whether the model's top-level children can be
+            chained in a torch.nn.Sequential.  Models whose forward does
+            more than that (auxiliary heads, dict outputs) are truncated
+            with a forward hook instead.
+        module: torchvision module holding the constructor.
+        kwargs (dict): Constructor arguments matching the pretrained
+            architecture, used when building the model for local weights.
+    """
+
+    def __init__(self, name, default_tap, input_size=224, sequential=True,
+                 module=torchvision.models, kwargs=None):
+        self.name = name
+        self.default_tap = default_tap
+        self.input_size = input_size
+        self.sequential = sequential
+        self.module = module
+        self.kwargs = kwargs or {}
+
+    def construct(self, pretrained=False):
+        constructor = getattr(self.module, self.name)
+        if pretrained:
+            try:
+                return constructor(weights="DEFAULT")
+            except TypeError:  # torchvision < 0.13
+                return constructor(pretrained=True)
+        try:
+            return constructor(weights=None, **self.kwargs)
+        except TypeError:
+            return constructor(pretrained=False, **self.kwargs)
+
+
+def _register(specs, names, *args, **kwargs):
+    for name in names:
+        specs[name] = BackboneSpec(name, *args, **kwargs)
+
+
+BACKBONES = {}
+_register(BACKBONES, ["alexnet"], 2)
+_register(BACKBONES, ["vgg11", "vgg13", "vgg16", "vgg19", "vgg11_bn",
+                      "vgg13_bn", "vgg16_bn", "vgg19_bn"], 2)
+_register(BACKBONES, ["resnet18", "resnet34", "resnet50", "resnet101",
+                      "resnet152", "resnext50_32x4d", "resnext101_32x8d",
+                      "wide_resnet50_2", "wide_resnet101_2"], 2)
+_register(BACKBONES, ["densenet121", "densenet169", "densenet201",
+                      "densenet161"], 1)
+_register(BACKBONES, ["squeezenet1_0", "squeezenet1_1"], 1)
+_register(BACKBONES, ["mobilenet_v2"], 1)
+_register(BACKBONES, ["shufflenet_v2_x0_5", "shufflenet_v2_x1_0"], 1)
+_register(BACKBONES, ["googlenet"], "inception5b", sequential=False,
+          kwargs={"transform_input": True, "aux_logits": False,
+                  "init_weights": False})
+_register(BACKBONES, ["inception_v3"], "Mixed_7c", input_size=299,
+          sequential=False,
+          kwargs={"transform_input": True, "init_weights": False})
+_register(BACKBONES, ["fcn_resnet101", "deeplabv3_resnet101"],
+          "backbone.layer4", sequential=False,
+          module=torchvision.models.segmentation,
+          kwargs={"aux_loss": True, "weights_backbone": None})
+
+
+class StudentSpec(BackboneSpec):
+    """A models.ResNet.StudentResNet distilled from a truncated teacher.  It
+    already outputs the teacher's features, so it is used whole (tap 0)
+    with the teacher's input transform.
+
+    Arguments:
+        name (str): Name of the student.
+        teacher (str): Backbone the student was distilled from.
+        teacher_tap: Truncation point of the teacher.
+        kwargs (dict): StudentResNet arguments.
+        trained_at (str): When the weights were saved, so features of a
+            retrained student are not mistaken for the old ones.
+    """
+
+    def __init__(self, name, teacher, teacher_tap, kwargs, trained_at=None):
+        super(StudentSpec, self).__init__(
+            name, 0, input_size=get_backbone_spec(teacher).input_size,
+            kwargs=kwargs)
+        self.teacher = teacher
+        self.teacher_tap = teacher_tap
+        self.trained_at = trained_at
+
+    def construct(self, pretrained=False):
+        if pretrained:
+            raise Exception("No weights for student %s, distill it first "
+                            "(train_cnn.distillStudent)" % self.name)
+        from models.ResNet import StudentResNet
+        return StudentResNet(**self.kwargs)
+
+    def to_json(self):
+        return {"teacher": self.teacher, "teacher_tap": self.teacher_tap,
+                "kwargs": self.kwargs, "trained_at": self.trained_at}
+
+
+def save_student_spec(spec, weights_root=None):
+    BACKBONES[spec.name] = spec
+    weights_root = weights_root or default_weights_root
+    os.makedirs(weights_root, exist_ok=True)
+    with open(os.path.join(weights_root, "%s.json" % spec.name), "w") as f:
+        json.dump(spec.to_json(), f)
+
+
+def _load_student_spec(name, weights_root=None):
+    path = os.path.join(weights_root or default_weights_root,
+                        "%s.json" % name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        meta = json.load(f)
+    BACKBONES[name] = StudentSpec(name, meta["teacher"], meta["teacher_tap"],
+                                  meta["kwargs"], meta.get("trained_at"))
+    return BACKBONES[name]
+
+
+def get_backbone_spec(name):
+    """Looks a backbone up by name.  Like get_model_transform, a trailing
+    variant character is tolerated (feature_model = "alexnetg").  Students
+    saved in the default weights directory are registered on first use."""
+    for key in (name, name[:-1]):
+        if key in BACKBONES:
+            return BACKBONES[key]
+    for key in (name, name[:-1]):
+        spec = _load_student_spec(key)
+        if spec is not None:
+            return spec
+    raise Exception("Unknown backbone %s, add it to backbones.BACKBONES"
+                    % name)
+
+
+def get_eval_sizes(name):
+    """(crop_size, resize) of a backbone's deterministic eval transform: its
+    input size, after resizing the shorter side by the usual 256 / 224."""
+    input_size = get_backbone_spec(name).input_size
+    return input_size, int(round(input_size * 256 / 224.))
+
+
+def get_backbone_transform(name, crops=None):
+    """Input transform for a backbone.
+
+    With crops None, models that get_model_transform already handles keep
+    its (training, partly random crop) transform, so existing features stay
+    comparable, and the others get a deterministic resize and center crop.
+    Otherwise the transform is dataset.get_eval_transform with the
+    backbone's sizes (see get_eval_sizes) and crops ("center" or an n x n
+    tile grid)."""
+    spec = get_backbone_spec(name)
+    if isinstance(spec, StudentSpec):
+        return get_backbone_transform(spec.teacher, crops)
+    if crops is not None:
+        crop_size, resize = get_eval_sizes(name)
+        return get_eval_transform(crop_size, resize, crops)
+    try:
+        return get_model_transform(spec.name + "_")
+    except Exception:
+        pass
+    if spec.input_size == 299:
+        return inception_transform
+    return alexnet_transform
+
+
+class TruncatedBackbone(torch.nn.Module):
+    """Runs a backbone up to a tap point and returns its activations there
+    (see inference_engine.resolve_tap)."""
+
+    def __init__(self, model, tap):
+        super(TruncatedBackbone, self).__init__()
+        self.model = model
+        self.tap = tap
+
+    def forward(self, x):
+        with FeatureTaps(self.model, [self.tap]) as taps:
+            return taps(x)[self.tap]
+
+
+def truncate_backbone(model, spec, tap):
+    if tap == 0:  # nothing removed
+        return model
+    resolve_tap(model, tap)  # raises for taps the model does not have
+    if spec.sequential and not isinstance(tap, str):
+        return torch.nn.Sequential(*list(model.children())[:-tap])
+    return TruncatedBackbone(model, tap)
+
+
+def load_backbone(name, pretrained=True, weights_root=None):
+    """Builds a full backbone, with weights from weights_root/<name>.pth.
+    Missing weights are downloaded once and saved there."""
+    spec = get_backbone_spec(name)
+    weights_root = weights_root or default_weights_root
+    weights_path = os.path.join(weights_root, "%s.pth" % spec.name)
+    if not pretrained:
+        model = spec.construct(pretrained=False)
+    elif os.path.exists(weights_path):
+        model = spec.construct(pretrained=False)
+        model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    else:
+        print("no local weights for %s, downloading to %s" % (
+            spec.name, weights_root))
+        os.makedirs(weights_root, exist_ok=True)
+        torch.hub.set_dir(weights_root)
+        model = spec.construct(pretrained=True)
+        _save_atomic(model.state_dict(), weights_path)
+    return model.eval()
+
+
+def _save_atomic(obj, path):
+    # write then rename, so concurrent runs never read a half written file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _torch_load_module(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+def get_truncated_path(name, tap=None, truncated_root=None):
+    spec = get_backbone_spec(name)
+    tap = spec.default_tap if tap is None else tap
+    return os.path.join(truncated_root or default_truncated_root,
+                        "%s_%s.pt" % (spec.name, tap))
+
+
+def load_truncated_backbone(name, tap=None, pretrained=True,
+                            weights_root=None, truncated_root=None):
+    """Returns the backbone truncated at tap (its default_tap if None),
+    loading it from truncated_root when it was saved before and saving it
+    there (with its descriptor shape) otherwise.
+
+    Arguments:
+        name (str): Backbone name, see get_backbone_spec.
+        tap: Truncation point, an int number of layers removed or a module
+            name.
+        pretrained (bool): Load pretrained weights.  Untrained models are
+            built every time and never saved, so they cannot shadow the
+            pretrained one.
+        weights_root (str): Directory of full model weights.
+        truncated_root (str): Directory of truncated models.
+    """
+    spec = get_backbone_spec(name)
+    tap = spec.default_tap if tap is None else tap
+    path = get_truncated_path(name, tap, truncated_root)
+    if pretrained and os.path.exists(path):
+        return _torch_load_module(path).eval()
+    model = truncate_backbone(load_backbone(name, pretrained, weights_root),
+                              spec, tap).eval()
+    if pretrained:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta_path = path[:-len(".pt")] + ".json"
+        tmp_path = "%s.%d.tmp" % (meta_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"descriptor_shape": list(
+                compute_descriptor_shape(model, spec.input_size))}, f)
+        os.replace(tmp_path, meta_path)
+        _save_atomic(model, path)
+    return model
+
+
+def compute_descriptor_shape(model, input_size):
+    """(rows, dim) of the descriptors a truncated model gives per image:
+    one row per channel, one value per spatial position."""
+    with inference_context():
+        outputs = model(torch.zeros(1, 3, input_size, input_size))
+    return int(outputs.shape[1]), int(outputs[0, 0].numel())
+
+
+def get_descriptor_shape(name, tap=None, truncated_root=None, **kwargs):
+    """Descriptor shape of a truncated backbone, read from the metadata saved
+    next to it when available."""
+    meta_path = get_truncated_path(name, tap, truncated_root)[:-len(".pt")] + \
+        ".json"
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            return tuple(json.load(f)["descriptor_shape"])
+    model = load_truncated_backbone(name, tap, truncated_root=truncated_root,
+                                    **kwargs)
+    return compute_descriptor_shape(model, get_backbone_spec(name).input_size)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import torch
+import torchvision
+import backbones
+
+
+class TruncatedBackboneCacheTestCase(unittest.TestCase):
+    def test_second_call_loads_saved_model(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as root:
+            weights_root = os.path.join(root, "weights")
+            truncated_root = os.path.join(root, "truncated")
+            os.makedirs(weights_root)
+            # random "pretrained" weights, so nothing is downloaded
+            torch.save(torchvision.models.alexnet().state_dict(),
+                       os.path.join(weights_root, "alexnet.pth"))
+
+            # untrained models are never cached in place of pretrained ones
+            backbones.load_truncated_backbone(
+                "alexnet", pretrained=False, truncated_root=truncated_root)
+            self.assertFalse(os.path.exists(truncated_root))
+
+            model = backbones.load_truncated_backbone(
+                "alexnet", weights_root=weights_root,
+                truncated_root=truncated_root)
+            path = backbones.get_truncated_path("alexnet", None,
+                                                truncated_root)
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(os.path.exists(path[:-len(".pt")] + ".json"))
+            self.assertFalse([name for name in os.listdir(truncated_root)
+                              if name.endswith(".tmp")])
+
+            with mock.patch.object(backbones, "load_backbone",
+                                   side_effect=AssertionError("rebuilt")):
+                cached = backbones.load_truncated_backbone(
+                    "alexnet", weights_root=weights_root,
+                    truncated_root=truncated_root)
+            images = torch.rand(2, 3, 224, 224)
+            with torch.no_grad():
+                torch.testing.assert_close(cached(images), model(images))
+
+            expected = backbones.compute_descriptor_shape(model, 224)
+            with mock.patch.object(backbones, "load_truncated_backbone",
+                                   side_effect=AssertionError("loaded")):
+                self.assertEqual(backbones.get_descriptor_shape(
+                    "alexnet", truncated_root=truncated_root), expected)
+
+            # without the metadata the shape is computed from the model
+            os.remove(path[:-len(".pt")] + ".json")
+            self.assertEqual(backbones.get_descriptor_shape(
+                "alexnet", truncated_root=truncated_root), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
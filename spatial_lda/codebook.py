@@ -0,0 +1,159 @@
+"""Streaming codebook (visual vocabulary) training.
+
+Instead of stacking every descriptor into one matrix before calling
+KMeans.fit, descriptors are fed to MiniBatchKMeans.partial_fit a chunk at a
+time, so the memory needed to train a codebook is bounded by a configurable
+budget rather than by the size of the dataset.
+"""
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans, KMeans
+from tqdm import tqdm
+
+
+def reservoir_sample(batches, size, random_state=None):
+    """Uniformly samples size rows from a stream of row batches (Algorithm R,
+    vectorized over each batch) while only ever holding size rows."""
+    rng = np.random.RandomState(random_state)
+    reservoir = None
+    seen = 0
+    for batch in batches:
+        batch = np.asarray(batch)
+        if reservoir is None:
+            reservoir = np.empty((size, batch.shape[1]), dtype=batch.dtype)
+        n_fill = min(max(size - seen, 0), batch.shape[0])
+        reservoir[seen:seen + n_fill] = batch[:n_fill]
+        rest = batch[n_fill:]
+        if rest.shape[0] > 0:
+            # row t of the stream replaces a random slot with prob size / t
+            t = seen + n_fill + np.arange(1, rest.shape[0] + 1)
+            slots = (rng.random_sample(rest.shape[0]) * t).astype(np.int64)
+            keep = slots < size
+            # later rows win when several land in the same slot
+            reservoir[slots[keep]] = rest[keep]
+        seen += batch.shape[0]
+    if reservoir is None:
+        return None
+    return reservoir[:min(seen, size)]
+
+
+class StreamingCodebookTrainer:
+    """Fits a MiniBatchKMeans codebook on descriptors that arrive in batches.
+
+    Batches passed to partial_fit are cut into mini-batches of batch_size
+    rows and handed to MiniBatchKMeans.partial_fit as they arrive, so only a
+    partial mini-batch is ever kept between calls.  When the descriptors are
+    already on disk, fit_store reads them in chunks bounded by the memory
+    budget, optionally after a first pass that draws a reservoir sample to
+    seed the centers.
+
+    Arguments:
+        n_clusters (int): Size of the vocabulary.
+        memory_budget_mb (float): Upper bound on descriptor memory held at
+            once (disk chunks and the reservoir sample).
+        reservoir_size (int): Rows sampled to initialize the centers in
+            fit_store; None lets the first mini-batch initialize them.
+        batch_size (int): Rows per MiniBatchKMeans update.
+        random_state (int): Seed for sampling and k-means initialization.
+    """
+
+    def __init__(self, n_clusters, memory_budget_mb=1024,
+                 reservoir_size=None, batch_size=1024, random_state=None):
+        self.n_clusters = n_clusters
+        self.memory_budget_mb = memory_budget_mb
+        self.reservoir_size = reservoir_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters,
+                                      batch_size=batch_size,
+                                      random_state=random_state)
+        self._leftover = None
+        self.rows_seen = 0
+
+    def budget_rows(self, dim):
+        """Number of float32 descriptor rows that fit in the memory budget,
+        never fewer than one mini-batch."""
+        budget_bytes = int(self.memory_budget_mb * (1 << 20))
+        return max(budget_bytes // (4 * dim), self.batch_size)
+
+    @property
+    def initialized(self):
+        return hasattr(self.kmeans, "cluster_centers_")
+
+    def partial_fit(self, batch):
+        """Adds a (n_rows x dim) batch of descriptors to the codebook."""
+        batch = np.asarray(batch)
+        if batch.shape[0] == 0:
+            return self
+        batch = batch.reshape(-1, batch.shape[-1])
+        self.rows_seen += batch.shape[0]
+        if self._leftover is not None:
+            batch = np.concatenate([self._leftover, batch])
+            self._leftover = None
+        start = 0
+        while True:
+            # the first update also places the initial centers, so give it
+            # a few rows per cluster to choose from
+            size = self.batch_size if self.initialized else max(
+                self.batch_size, 3 * self.n_clusters)
+            if batch.shape[0] - start < size:
+                break
+            self.kmeans.partial_fit(
+                np.asarray(batch[start:start + size], dtype=np.float32))
+            start += size
+        if start < batch.shape[0]:
+            self._leftover = np.array(batch[start:])
+        return self
+
+    def finalize(self):
+        """Fits the remaining partial mini-batch and returns the fitted
+        MiniBatchKMeans."""
+        if self._leftover is not None:
+            if not self.initialized and \
+                    self._leftover.shape[0] < self.n_clusters:
+                raise Exception("Only %d descriptors seen, cannot fit %d "
+                                "clusters" % (self._leftover.shape[0],
+                                              self.n_clusters))
+            self.kmeans.partial_fit(
+                np.asarray(self._leftover, dtype=np.float32))
+            self._leftover = None
+        return self.kmeans
+
+    def init_from_sample(self, sample):
+        """Seeds the centers with a short k-means run on a descriptor sample."""
+        sample = np.asarray(sample, dtype=np.float32)
+        seed = KMeans(n_clusters=self.n_clusters, n_init=1, max_iter=20,
+                      random_state=self.random_state).fit(sample)
+        self.kmeans = MiniBatchKMeans(n_clusters=self.n_clusters,
+                                      init=seed.cluster_centers_, n_init=1,
+                                      batch_size=self.batch_size,
+                                      random_state=self.random_state)
+        self.kmeans.partial_fit(seed.cluster_centers_)
+        return self
+
+    def fit_store(self, descriptor_store, ids=None, n_passes=1):
+        """Fits the codebook on the rows of a DescriptorStore, streaming them
+        in chunks bounded by the memory budget.
+
+        Arguments:
+            descriptor_store: A DescriptorStore.
+            ids (list): Image ids to train on; every image if None.
+            n_passes (int): Number of passes over the descriptors.
+
+        Returns:
+            The fitted MiniBatchKMeans.
+        """
+        chunk_rows = self.budget_rows(descriptor_store.dim)
+        if self.reservoir_size is not None:
+            sample = reservoir_sample(
+                (rows for _, _, rows in
+                 descriptor_store.iter_chunks(ids, chunk_rows)),
+                min(self.reservoir_size, chunk_rows),
+                random_state=self.random_state)
+            self.init_from_sample(sample)
+        for _ in range(n_passes):
+            for _, _, rows in tqdm(
+                    descriptor_store.iter_chunks(ids, chunk_rows),
+                    desc="training codebook"):
+                self.partial_fit(rows)
+        return self.finalize()
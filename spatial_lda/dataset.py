@@ -1,5 +1,6 @@
 import torch
 import os
+import time
 from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
 from skimage import io
@@ -11,6 +12,7 @@ from utils import *
 from torch.utils.data.sampler import SubsetRandomSampler, WeightedRandomSampler
 import numpy as np
 from PIL import Image
+from skimage.color import rgb2gray
 
 # Parameters for root directory of dataset
 from configuration import box_data_root
@@ -128,6 +130,13 @@ googlenet_transform = transforms.Compose([
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
+inception_transform = transforms.Compose([
+    transforms.ToPILImage(),
+    transforms.Resize(342),
+    transforms.CenterCrop(299),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+])
 alexnet_transform = transforms.Compose([
     transforms.ToPILImage(),
     transforms.Resize(256),
@@ -137,12 +146,113 @@ alexnet_transform = transforms.Compose([
 ])
 
 
+class TileCrop:
+    """Cuts a (C x H x W) image tensor into an n x n grid of size x size
+    tiles at fixed, evenly spaced offsets (overlapping when the image is not
+    n * size wide), returned as an (n * n) x C x size x size tensor.  Images
+    smaller than a tile are zero padded first."""
+
+    def __init__(self, size, n):
+        self.size = size
+        self.n = n
+
+    def __call__(self, image):
+        pad_h = max(0, self.size - image.shape[1])
+        pad_w = max(0, self.size - image.shape[2])
+        if pad_h or pad_w:
+            image = torch.nn.functional.pad(
+                image, (pad_w // 2, pad_w - pad_w // 2,
+                        pad_h // 2, pad_h - pad_h // 2))
+        tops = np.linspace(0, image.shape[1] - self.size, self.n).round()
+        lefts = np.linspace(0, image.shape[2] - self.size, self.n).round()
+        return torch.stack([image[:, top:top + self.size, left:left + self.size]
+                            for top in tops.astype(int)
+                            for left in lefts.astype(int)])
+
+
+def get_eval_transform(crop_size=224, resize=256, crops="center"):
+    """Deterministic input transform for feature extraction, so an image
+    always gives the same descriptors (unlike the RandomCrop transforms used
+    for training).
+
+    Arguments:
+        crop_size (int): Side of the square crops fed to the network.
+        resize (int): The shorter side of the image is resized to this first.
+        crops: "center" for a single center crop, or an int n for an n x n
+            grid of tiles (see TileCrop); tiles come out stacked, so a batch
+            is N x n*n x C x H x W.
+    """
+    crop = transforms.CenterCrop(crop_size) if crops == "center" \
+        else TileCrop(crop_size, crops)
+    return transforms.Compose([
+        transforms.ToPILImage(),
+        transforms.Resize(resize),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                             std=[0.229, 0.224, 0.225]),
+        crop,
+    ])
+
+
+def decode_image(impath, max_edge_length=None, as_gray=False, use_pil=False):
+    """Reads an image from disk, optionally at reduced resolution.
+
+    With max_edge_length set, the JPEG decoder is asked for a downscaled
+    image directly (libjpeg DCT scaling by 1/2, 1/4 or 1/8 through PIL's
+    draft mode), which skips most of the decoding work; the result is then
+    shrunk so its longer edge is at most max_edge_length.  Images already
+    within the limit are decoded at full size.
+
+    Arguments:
+        impath (str): Path to the image.
+        max_edge_length (int): Longest edge of the decoded image, or None to
+            decode at full resolution with skimage.
+        as_gray (bool): Return a float grayscale image, like skimage's
+            imread(as_gray=True).
+        use_pil (bool): Return the PIL image instead of a numpy array.
+    """
+    if max_edge_length is None and not use_pil:
+        return io.imread(impath, as_gray=as_gray)
+    with Image.open(impath) as im:
+        if max_edge_length is not None:
+            scale = max_edge_length / float(max(im.size))
+            if scale < 1:
+                target = (max(1, int(round(im.size[0] * scale))),
+                          max(1, int(round(im.size[1] * scale))))
+                # draft picks the largest DCT scaling that still covers
+                # target
+                im.draft(im.mode, target)
+                im.thumbnail((max_edge_length, max_edge_length),
+                             Image.BILINEAR)
+        # detached from the file, which is closed on leaving the block
+        image = im.convert("RGB") if im.mode not in ("L", "RGB") \
+            else im.copy()
+    if use_pil:
+        return image
+    image = np.asarray(image)
+    if as_gray:
+        return rgb2gray(image) if image.ndim == 3 else image / 255.0
+    return image
+
+
+def benchmark_decode(image_paths, max_edge_length):
+    """Prints the average time to decode image_paths at full resolution and
+    at max_edge_length."""
+    for edge in (None, max_edge_length):
+        start = time.time()
+        for impath in image_paths:
+            decode_image(impath, edge)
+        elapsed = time.time() - start
+        print("max_edge_length=%s: %.1f ms/image" % (
+            edge, 1000 * elapsed / max(len(image_paths), 1)))
+
+
 class ADE20K(Dataset):
 
     def __init__(self, root=train_root, transform=resnet_transform,
                  grayscale=False, numLabelsLoaded=0, labelSubset=None,
                  useStringLabels=True, randomSeed=33, normalizeWeights=False,
-                 usePIL=False, grayscaleRGB=False):
+                 usePIL=False, grayscaleRGB=False, maxEdgeLength=None):
         """
         Args:
             root_dir (string): Directory with all the images organized into
@@ -155,6 +265,8 @@ class ADE20K(Dataset):
             useStringLabels: use string over one hot
             normalizeWeights: if label subsets in effct, will make sure there
             are equal numbers of each class
+            maxEdgeLength: decode images straight at reduced resolution, with
+            the longer edge at most this many pixels (see decode_image)
 
 
         """
@@ -171,6 +283,7 @@ class ADE20K(Dataset):
         self.counter = Counter()
         self.usePIL = usePIL
         self.grayscaleRGB = grayscaleRGB
+        self.maxEdgeLength = maxEdgeLength
         index = 0
         label_letters = os.listdir(self.root)  # E.g. directories given by "a/"
         # Iterate over each letter label
@@ -207,11 +320,9 @@ class ADE20K(Dataset):
 
     def __getitem__(self, idx):
         impath = self.image_paths[idx]
-        if not self.usePIL:
-            image = io.imread(impath,
-                              as_gray=(self.grayscale or self.grayscaleRGB))
-        else:
-            image = Image.open(impath)
+        image = decode_image(impath, self.maxEdgeLength,
+                             as_gray=(self.grayscale or self.grayscaleRGB),
+                             use_pil=self.usePIL)
 
         if self.transform:
             try:
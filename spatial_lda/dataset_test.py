@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from PIL import Image, JpegImagePlugin
+from dataset import decode_image
+
+
+def write_jpeg(path, width, height):
+    rng = np.random.RandomState(0)
+    pixels = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+    Image.fromarray(pixels).save(path, quality=90)
+
+
+class DecodeImageTestCase(unittest.TestCase):
+    def test_max_edge_length(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "image.jpg")
+            write_jpeg(path, 800, 600)
+            jpeg = JpegImagePlugin.JpegImageFile
+            with mock.patch.object(jpeg, "draft", autospec=True,
+                                   side_effect=jpeg.draft) as drafted:
+                image = decode_image(path, max_edge_length=100)
+            # the decoder is asked for a 100 x 75 draft, then shrunk to fit
+            self.assertEqual(drafted.call_args_list[0][0][1:],
+                             ("RGB", (100, 75)))
+            self.assertEqual(image.shape, (75, 100, 3))
+            self.assertEqual(image.dtype, np.uint8)
+
+            self.assertEqual(decode_image(path, 300, use_pil=True).size,
+                             (300, 225))
+            gray = decode_image(path, 160, as_gray=True)
+            self.assertEqual(gray.shape, (120, 160))
+            self.assertLessEqual(gray.max(), 1.0)
+
+            # images within the limit are not resized
+            with mock.patch.object(jpeg, "draft", autospec=True) as drafted:
+                image = decode_image(path, max_edge_length=800)
+            drafted.assert_not_called()
+            self.assertEqual(image.shape, (600, 800, 3))
+
+    def test_portrait_image(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "image.jpg")
+            write_jpeg(path, 300, 500)
+            self.assertEqual(decode_image(path, 250).shape, (250, 150, 3))
+            # the file is closed, so it can be replaced right away
+            image = decode_image(path, None, use_pil=True)
+            os.remove(path)
+            self.assertEqual(image.size, (300, 500))
+            self.assertEqual(np.asarray(image).shape, (500, 300, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+import cv2 as cv
+import numpy as np
+import feature_extraction as fe
+
+
+class DenseSiftTestCase(unittest.TestCase):
+    def test_descriptor_count_does_not_depend_on_image_size(self):
+        rng = np.random.RandomState(0)
+        with fe.hyperparameters(sift_mode="dense"):
+            expected = fe.get_expected_descriptor_count()
+            # 16 x 16 grid points, inset by 8 pixels, at two scales
+            self.assertEqual(expected, 512)
+            worker_sift = cv.SIFT_create(fe.n_keypoints)
+            for shape in [(120, 90), (480, 640)]:
+                img = rng.randint(0, 256, size=shape).astype(np.uint8)
+                kp, des = fe.get_dense_feature_vector(img)
+                self.assertEqual(len(kp), expected)
+                self.assertEqual(des.shape, (expected, 128))
+                # the pool's detector, built with n_keypoints, keeps them all
+                _, des = fe.get_dense_feature_vector(
+                    img, worker_sift, fe.get_dense_keypoints())
+                self.assertEqual(des.shape, (expected, 128))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+"""Resumable, content-addressed checkpointing for descriptor extraction.
+
+Extracted descriptors are checkpointed in shards of a few hundred images.
+Each shard is a DescriptorStore whose keys are content hashes of the image
+files, and shards are grouped under a directory named after a digest of the
+extractor configuration (model, truncation depth, number of keypoints, ...).
+A rerun with the same configuration only extracts images whose content has
+not been seen before, so an interrupted run resumes from its last shard and
+adding images to the dataset only costs the new images.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+from tqdm import tqdm
+
+from descriptor_store import DescriptorStore, DescriptorStoreWriter, \
+    FixedDescriptorStoreWriter
+
+HASH_INDEX_FILE = "content_hashes.json"
+CONFIG_FILE = "config.json"
+
+
+def config_digest(config):
+    """Stable digest of an extractor configuration dictionary."""
+    encoded = json.dumps(config, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def hash_file(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            h.update(block)
+            block = f.read(block_size)
+    return h.hexdigest()
+
+
+def hash_image_files(paths, cache_root=None):
+    """Returns the content hash of every file in paths.
+
+    When cache_root is given, hashes are remembered together with each
+    file's size and modification time, so unchanged files are not re-read
+    on the next run.
+    """
+    index = {}
+    index_path = None
+    if cache_root is not None:
+        os.makedirs(cache_root, exist_ok=True)
+        index_path = os.path.join(cache_root, HASH_INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+    hashes = []
+    changed = False
+    for path in tqdm(paths, desc="hashing images"):
+        stat = os.stat(path)
+        entry = index.get(path)
+        if entry is None or entry[0] != stat.st_size or \
+                entry[1] != stat.st_mtime:
+            entry = [stat.st_size, stat.st_mtime, hash_file(path)]
+            index[path] = entry
+            changed = True
+        hashes.append(entry[2])
+    if index_path is not None and changed:
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return hashes
+
+
+class DescriptorCache:
+    """Shards of descriptors keyed by image content hash, for one extractor
+    configuration.
+
+    Arguments:
+        cache_root (str): Directory holding the caches of every
+            configuration.
+        config (dict): JSON-serializable extractor configuration; any change
+            to it selects a different cache.
+        dtype: Dtype descriptors are stored with; kept as extracted if None.
+    """
+
+    def __init__(self, cache_root, config, dtype=None):
+        self.config = config
+        self.dtype = dtype
+        self.root = os.path.join(cache_root, config_digest(config))
+        os.makedirs(self.root, exist_ok=True)
+        config_path = os.path.join(self.root, CONFIG_FILE)
+        if not os.path.exists(config_path):
+            with open(config_path, "w") as f:
+                json.dump(config, f, sort_keys=True)
+        self.shards = []
+        self._index = {}  # content hash -> (shard number, id in shard)
+        for name in sorted(os.listdir(self.root)):
+            shard_root = os.path.join(self.root, name)
+            if name.startswith("shard_") and DescriptorStore.exists(
+                    shard_root):
+                self._add_to_index(DescriptorStore(shard_root))
+
+    def _add_to_index(self, shard):
+        n = len(self.shards)
+        self.shards.append(shard)
+        for i, content_hash in enumerate(shard.paths):
+            self._index[content_hash] = (n, i)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, content_hash):
+        return content_hash in self._index
+
+    def get(self, content_hash):
+        shard, i = self._index[content_hash]
+        return self.shards[shard][i]
+
+    def missing(self, hashes):
+        """Indices into hashes of the images that still need extracting.
+        Each distinct content is only reported once."""
+        seen = set()
+        todo = []
+        for i, content_hash in enumerate(hashes):
+            if content_hash in self._index or content_hash in seen:
+                continue
+            seen.add(content_hash)
+            todo.append(i)
+        return todo
+
+    def _new_shard_root(self):
+        name = "shard_%05d" % len(self.shards)
+        tmp_root = os.path.join(self.root, "tmp_" + name)
+        if os.path.exists(tmp_root):
+            shutil.rmtree(tmp_root)
+        return tmp_root, os.path.join(self.root, name)
+
+    def add_shard(self, items):
+        """Checkpoints an iterable of (content hash, descriptors) pairs as a
+        new shard.  The shard is written to a temporary directory and renamed
+        into place, so a crash never leaves a partial shard behind."""
+        tmp_root, shard_root = self._new_shard_root()
+        writer = DescriptorStoreWriter(tmp_root, dtype=self.dtype)
+        for content_hash, descriptors in items:
+            writer.append(content_hash, descriptors)
+        writer.close()
+        os.rename(tmp_root, shard_root)
+        self._add_to_index(DescriptorStore(shard_root))
+
+    def open_fixed_shard(self, content_hashes, rows_per_image, dim):
+        """Preallocates a shard of images that all have rows_per_image rows
+        and returns its FixedDescriptorStoreWriter; the shard is added to
+        the cache by commit_fixed_shard."""
+        tmp_root, _ = self._new_shard_root()
+        return FixedDescriptorStoreWriter(tmp_root, content_hashes,
+                                          rows_per_image, dim,
+                                          dtype=self.dtype or np.float32)
+
+    def commit_fixed_shard(self, writer):
+        writer.close()
+        shard_root = os.path.join(self.root, "shard_%05d" % len(self.shards))
+        os.rename(writer.root, shard_root)
+        self._add_to_index(DescriptorStore(shard_root))
+
+    def add_fixed_shard(self, content_hashes, rows_per_image, dim, fill_fn):
+        """Checkpoints a shard of images that all have rows_per_image rows.
+        The shard is preallocated and fill_fn(writer) writes the descriptors
+        into it by position (see FixedDescriptorStoreWriter.write)."""
+        writer = self.open_fixed_shard(content_hashes, rows_per_image, dim)
+        fill_fn(writer)
+        self.commit_fixed_shard(writer)
+
+    def assemble(self, paths, hashes, store_root, rows_per_image=None,
+                 dim=None):
+        """Gathers the cached descriptors of the given images, in order, into
+        one contiguous DescriptorStore keyed by path.  With rows_per_image
+        and dim the store is preallocated and filled by position."""
+        if rows_per_image is not None:
+            writer = FixedDescriptorStoreWriter(store_root, paths,
+                                                rows_per_image, dim,
+                                                dtype=self.dtype or np.float32)
+            for i, content_hash in enumerate(hashes):
+                writer.write(i, self.get(content_hash)[None])
+            return writer.close()
+        writer = DescriptorStoreWriter(store_root, dtype=self.dtype)
+        for path, content_hash in zip(paths, hashes):
+            writer.append(path, self.get(content_hash))
+        return writer.close()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import feature_extraction as fe
+from descriptor_cache import DescriptorCache, hash_file
+
+CONFIG = {"extractor": "test"}
+
+
+class FileDataset:
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+def file_descriptors(path):
+    with open(path, "rb") as f:
+        return np.frombuffer(f.read(), dtype=np.uint8).reshape(-1, 4) \
+            .astype(np.float32)
+
+
+class DescriptorCacheTestCase(unittest.TestCase):
+    def test_resume_and_extract_only_new_images(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache_root = os.path.join(root, "cache")
+            paths = []
+            for i in range(6):
+                paths.append(os.path.join(root, "%d.jpg" % i))
+                with open(paths[-1], "wb") as f:
+                    f.write(bytes([i] * 4 * (i + 1)))
+            dataset = FileDataset(paths)
+            extracted = []
+
+            def extract(indices):
+                extracted.extend(indices)
+                return [file_descriptors(paths[i]) for i in indices]
+
+            # an interrupted run: one finished shard and a partial one
+            cache = DescriptorCache(cache_root, CONFIG)
+            cache.add_shard((hash_file(p), file_descriptors(p))
+                            for p in paths[:2])
+            os.makedirs(os.path.join(cache.root, "tmp_shard_00001"))
+
+            def run():
+                with fe.hyperparameters(descriptor_cache_root=cache_root,
+                                        descriptor_cache_shard_size=2):
+                    return fe.extract_descriptors_incremental(
+                        dataset, CONFIG, extract, os.path.join(root, "store"))
+
+            store = run()
+            self.assertEqual(extracted, [2, 3, 4, 5])
+            for p in paths:
+                np.testing.assert_array_equal(store[p], file_descriptors(p))
+
+            # nothing new: nothing extracted
+            del extracted[:]
+            run()
+            self.assertEqual(extracted, [])
+
+            # a changed image no longer matches its cached hash and is
+            # extracted again, alone
+            with open(paths[3], "wb") as f:
+                f.write(bytes([9] * 8))
+            store = run()
+            self.assertEqual(extracted, [3])
+            np.testing.assert_array_equal(store[paths[3]], np.full((2, 4), 9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+"""Columnar, memory-mapped storage for per-image descriptors.
+
+A descriptor store replaces the {path: descriptors} dictionaries that used
+to be pickled between pipeline stages.  All descriptor rows live back to
+back in a single memory-mapped array, so opening a store is near-instant and
+reads are served from the OS page cache instead of a fully unpickled copy.
+
+On disk a store is a directory holding:
+    rows.bin      raw (n_rows x dim) descriptor rows, image after image
+    offsets.npy   (n_images + 1) row offsets; image i owns
+                  rows[offsets[i]:offsets[i + 1]]
+    meta.json     dtype, descriptor dimension and the image paths, where the
+                  position of a path in the list is its image id
+"""
+
+import os
+import json
+import pickle
+
+import numpy as np
+
+ROWS_FILE = "rows.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+
+
+def cast_descriptors(descriptors, dtype):
+    """Converts descriptors to a storage dtype without wrapping around or
+    overflowing: float values going into an integer dtype are rounded and
+    clipped to its range, and values going into a narrower float dtype
+    (e.g. float16, whose largest value is 65504) are clipped to its range
+    instead of becoming inf."""
+    dtype = np.dtype(dtype)
+    descriptors = np.asarray(descriptors)
+    if dtype.kind in "ui" and descriptors.dtype.kind == "f":
+        info = np.iinfo(dtype)
+        descriptors = np.clip(np.rint(descriptors), info.min, info.max)
+    elif dtype.kind == "f" and descriptors.dtype.kind == "f" and \
+            dtype.itemsize < descriptors.dtype.itemsize:
+        info = np.finfo(dtype)
+        descriptors = np.clip(descriptors, info.min, info.max)
+    return np.ascontiguousarray(descriptors, dtype=dtype)
+
+
+class DescriptorStore:
+    """Read access to a descriptor store written by DescriptorStoreWriter.
+
+    Images can be looked up by id, by the path they were stored under or by
+    their file name (the key used by the older directory-walking code).
+    Every lookup returns a zero-copy view into the memory-mapped rows.
+
+    Arguments:
+        root (str): Directory of the store.
+        mode (str): Memory map mode, 'r' (default) or 'r+' to write in place.
+    """
+
+    def __init__(self, root, mode="r"):
+        self.root = root
+        with open(os.path.join(root, META_FILE), "r") as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta["dtype"])
+        self.dim = meta["dim"]
+        self.paths = meta["paths"]
+        self.offsets = np.load(os.path.join(root, OFFSETS_FILE))
+        self.n_rows = int(self.offsets[-1])
+        if self.n_rows > 0:
+            self.rows = np.memmap(os.path.join(root, ROWS_FILE),
+                                  dtype=self.dtype, mode=mode,
+                                  shape=(self.n_rows, self.dim))
+        else:
+            self.rows = np.zeros((0, self.dim), dtype=self.dtype)
+        self.path_to_id = {p: i for i, p in enumerate(self.paths)}
+        self._name_to_id = None
+
+    @staticmethod
+    def exists(root):
+        """A store is only complete once its metadata has been written."""
+        return os.path.exists(os.path.join(root, META_FILE))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, key):
+        return self.get_id(key) is not None
+
+    def __getitem__(self, key):
+        i = self.get_id(key)
+        if i is None:
+            raise KeyError(key)
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, key, default=None):
+        i = self.get_id(key)
+        if i is None:
+            return default
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_id(self, key):
+        """Returns the image id for an id, a stored path or a file name."""
+        if isinstance(key, (int, np.integer)):
+            return int(key) if 0 <= key < len(self.paths) else None
+        i = self.path_to_id.get(key)
+        if i is not None:
+            return i
+        if self._name_to_id is None:
+            self._name_to_id = {os.path.basename(p): i for i, p in
+                                enumerate(self.paths)}
+        return self._name_to_id.get(os.path.basename(key))
+
+    def keys(self):
+        return list(self.paths)
+
+    def items(self):
+        for i, path in enumerate(self.paths):
+            yield path, self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def counts(self):
+        """Number of descriptor rows stored for each image."""
+        return np.diff(self.offsets)
+
+    def select_rows(self, ids):
+        """Returns the rows of the given images stacked together.  When the
+        ids cover a contiguous run of images this is a view, not a copy."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.size == 0:
+            return self.rows[:0]
+        if np.all(np.diff(ids) == 1):
+            return self.rows[self.offsets[ids[0]]:self.offsets[ids[-1] + 1]]
+        return np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]]
+                               for i in ids])
+
+    def iter_chunks(self, ids=None, chunk_rows=1 << 18):
+        """Walks the rows of the given images (every image if None) in
+        chunks of whole images holding about chunk_rows rows each.
+
+        Yields:
+            (start, end, rows) where ids[start:end] are the images in the
+            chunk and rows are their stacked descriptor rows.
+        """
+        if ids is None:
+            ids = np.arange(len(self))
+        ids = np.asarray(ids, dtype=np.int64)
+        counts = self.counts[ids]
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(ids):
+            first_row = ends[start] - counts[start]
+            end = max(int(np.searchsorted(ends, first_row + chunk_rows,
+                                          side="right")), start + 1)
+            yield start, end, self.select_rows(ids[start:end])
+            start = end
+
+
+class DescriptorStoreWriter:
+    """Streams descriptors for one image at a time into a new store.
+
+    Rows are appended to disk as they arrive, so only the current image has
+    to be held in memory.  Images without descriptors (e.g. SIFT found no
+    keypoints) are recorded with zero rows.  The store only becomes visible
+    to readers once close() writes the offsets and metadata.
+
+    Arguments:
+        root (str): Directory of the store, created if needed.
+        dim (int): Descriptor dimension; inferred from the first image if
+            None.
+        dtype: Row dtype; inferred from the first image if None.
+            Descriptors are converted with cast_descriptors, so float
+            descriptors written to an integer store are rounded and clipped
+            to the dtype's range (SIFT values are whole numbers in 0-255, so
+            uint8 storage is lossless) and to a float16 store clipped to
+            its range.
+    """
+
+    def __init__(self, root, dim=None, dtype=None):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.dim = dim
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.paths = []
+        self.offsets = [0]
+        self._file = open(os.path.join(root, ROWS_FILE), "wb")
+
+    def append(self, path, descriptors):
+        if descriptors is None or np.size(descriptors) == 0:
+            n = 0
+        else:
+            descriptors = np.asarray(descriptors)
+            if self.dim is None:
+                self.dim = descriptors.shape[-1]
+            if self.dtype is None:
+                self.dtype = descriptors.dtype
+            descriptors = descriptors.reshape(-1, self.dim)
+            self._file.write(
+                cast_descriptors(descriptors, self.dtype).tobytes())
+            n = descriptors.shape[0]
+        self.paths.append(path)
+        self.offsets.append(self.offsets[-1] + n)
+
+    def close(self):
+        self._file.close()
+        np.save(os.path.join(self.root, OFFSETS_FILE),
+                np.array(self.offsets, dtype=np.int64))
+        meta = {"dtype": (self.dtype or np.dtype(np.float32)).str,
+                "dim": self.dim or 0,
+                "paths": self.paths}
+        with open(os.path.join(self.root, META_FILE), "w") as f:
+            json.dump(meta, f)
+        return DescriptorStore(self.root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+class FixedDescriptorStoreWriter:
+    """Preallocates a store in which every image has the same number of
+    descriptor rows, and lets batches be written straight into place by
+    image position (e.g. CNN activations, C channels of H*W values each).
+
+    The rows file is created at its final size and memory-mapped, so
+    writing a batch is a single copy into the page cache with no
+    intermediate per-image objects.  As with DescriptorStoreWriter, the
+    store only becomes visible to readers once close() writes the metadata.
+
+    Arguments:
+        root (str): Directory of the store, created if needed.
+        paths (list): Image paths; image i is stored at position i.
+        rows_per_image (int): Descriptor rows for every image.
+        dim (int): Descriptor dimension.
+        dtype: Row dtype.
+    """
+
+    def __init__(self, root, paths, rows_per_image, dim, dtype=np.float32):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.paths = list(paths)
+        self.rows_per_image = rows_per_image
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.n_rows = len(self.paths) * rows_per_image
+        rows_path = os.path.join(root, ROWS_FILE)
+        with open(rows_path, "wb") as f:
+            f.truncate(self.n_rows * dim * self.dtype.itemsize)
+        if self.n_rows > 0:
+            self.rows = np.memmap(rows_path, dtype=self.dtype, mode="r+",
+                                  shape=(len(self.paths), rows_per_image,
+                                         dim))
+        else:
+            self.rows = np.zeros((0, rows_per_image, dim), dtype=self.dtype)
+
+    def write(self, start, descriptors):
+        """Writes a (n_images x rows_per_image x dim) batch for the images
+        at positions start, ..., start + n_images - 1."""
+        descriptors = np.asarray(descriptors)
+        n = descriptors.shape[0]
+        self.rows[start:start + n] = cast_descriptors(descriptors.reshape(
+            n, self.rows_per_image, self.dim), self.dtype)
+
+    def close(self):
+        if isinstance(self.rows, np.memmap):
+            self.rows.flush()
+        del self.rows
+        np.save(os.path.join(self.root, OFFSETS_FILE),
+                np.arange(len(self.paths) + 1, dtype=np.int64) *
+                self.rows_per_image)
+        meta = {"dtype": self.dtype.str, "dim": self.dim,
+                "paths": self.paths}
+        with open(os.path.join(self.root, META_FILE), "w") as f:
+            json.dump(meta, f)
+        return DescriptorStore(self.root)
+
+
+def write_descriptor_store(root, items, dim=None, dtype=None):
+    """Writes an iterable of (path, descriptors) pairs to a new store."""
+    writer = DescriptorStoreWriter(root, dim=dim, dtype=dtype)
+    for path, descriptors in items:
+        writer.append(path, descriptors)
+    return writer.close()
+
+
+def convert_descriptor_dictionary(pickle_path, root):
+    """Converts a pickled {path: descriptors} dictionary into a store."""
+    with open(pickle_path, "rb") as f:
+        descriptor_dict = pickle.load(f)
+    return write_descriptor_store(root, descriptor_dict.items())
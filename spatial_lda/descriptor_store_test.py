@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from descriptor_store import DescriptorStore, FixedDescriptorStoreWriter, \
+    write_descriptor_store
+
+
+class DescriptorStoreTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        descriptors = {"a/abbey/1.jpg": np.arange(12, dtype=np.float32)
+                       .reshape(3, 4),
+                       "a/abbey/2.jpg": None,
+                       "b/bar/3.jpg": np.ones((2, 4), dtype=np.float32)}
+        with tempfile.TemporaryDirectory() as root:
+            root = os.path.join(root, "store")
+            write_descriptor_store(root, descriptors.items())
+            store = DescriptorStore(root)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(list(store.counts), [3, 0, 2])
+            np.testing.assert_array_equal(store["a/abbey/1.jpg"],
+                                          descriptors["a/abbey/1.jpg"])
+            # lookups by id and by bare file name hit the same rows
+            np.testing.assert_array_equal(store[2], store["3.jpg"])
+            self.assertEqual(store["a/abbey/2.jpg"].shape, (0, 4))
+            self.assertEqual(store.select_rows([0, 2]).shape, (5, 4))
+
+    def test_fixed_writer_fills_by_position(self):
+        activations = np.random.RandomState(0).rand(5, 3, 4)
+        with tempfile.TemporaryDirectory() as root:
+            root = os.path.join(root, "store")
+            writer = FixedDescriptorStoreWriter(root, list("abcde"), 3, 4,
+                                                dtype=np.float16)
+            self.assertFalse(DescriptorStore.exists(root))
+            writer.write(2, activations[2:])  # batches may land in any order
+            writer.write(0, activations[:2])
+            store = writer.close()
+            self.assertEqual(list(store.counts), [3] * 5)
+            np.testing.assert_array_equal(
+                store["d"], activations[3].astype(np.float16))
+            # contiguous selections are views of the memory map
+            self.assertTrue(np.shares_memory(store.select_rows([1, 2, 3]),
+                                             store.rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
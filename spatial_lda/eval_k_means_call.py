@@ -1,5 +1,6 @@
 import argparse
 from feature_extraction import evaluate_kmeans, build_histogram, \
+    load_descriptor_store, feature_matrix_exists, load_feature_matrix, \
     n_keypoints, n_cnn_keypoints, n_clusters, \
     feature_model, cnn_num_layers_removed, num_most_common_labels_used
 
@@ -26,9 +27,8 @@ def main_eval_cli():
     # Get paths to filenames
     f_kmeans = "/home/yaatehr/programs/spatial_LDA/data/kmeans_%s_clusters_" \
                "%s_keypoints.pkl" % (num_clusters, num_keypoints)
-    f_descriptor = "/home/yaatehr/programs/spatial_LDA/data" \
-                   "/image_descriptors_dictionary_%s_keypoints.pkl" % \
-                   num_keypoints
+    descriptor_list = load_descriptor_store(
+        "/home/yaatehr/programs/spatial_LDA/data", num_keypoints)
 
     # For each, go through all our metrics
     for metric in ["l2", "l1", "kl"]:
@@ -39,9 +39,6 @@ def main_eval_cli():
         with open(f_kmeans, "rb") as f:
             kmeans = pickle.load(f)
         f.close()
-        with open(f_descriptor, "rb") as f:
-            descriptor_list = pickle.load(f)
-        f.close()
 
         # Evaluate model with different params/hyperparams
         histogram_distance_dict = evaluate_kmeans(descriptor_list, kmeans,
@@ -64,13 +61,10 @@ def plot_histograms_for_labels(n_keypoints, n_clusters):
     f_kmeans = "/home/yaatehr/programs/spatial_LDA/data/top25_sift/kmeans_" \
                "%s_clusters_" \
                "%s_keypoints.pkl" % (n_clusters, n_keypoints)
-    f_descriptor = "/home/yaatehr/programs/spatial_LDA/data/top25_sift" \
-                   "/image_descriptors_dictionary_%s_keypoints.pkl" % \
-                   n_keypoints
     with open(f_kmeans, 'rb') as f:
         kmeans = pickle.load(f)
-    with open(f_descriptor, 'rb') as f:
-        descriptor_list = pickle.load(f)
+    descriptor_list = load_descriptor_store(
+        "/home/yaatehr/programs/spatial_LDA/data/top25_sift", n_keypoints)
     for l in letters:
         labels_path = os.path.join(label_path, l)
         labels = os.listdir(labels_path)
@@ -91,15 +85,14 @@ def plot_histograms_for_dataset(n_keypoints, n_clusters,
                                 "feature_matrix_%s_keypoints_%s_clusters" % (
                                 n_keypoints, n_clusters))
     print("eval for root: \n", save_root)
-    if not os.path.exists(feature_path):
+    if not feature_matrix_exists(feature_path):
         raise Exception(
             "Must be an existing param tuple\n path non-existant: %s" %
             feature_path)
 
-    with open(feature_path, "rb") as f:
-        feature_tup = pickle.load(f)
+    feature_tup = load_feature_matrix(feature_path)
 
-    if model == "sift":
+    if isinstance(feature_tup, tuple):  # SIFT matrices carry their mask
         hist_list, index_mask = feature_tup
     else:
         hist_list = feature_tup
@@ -122,13 +115,9 @@ def plot_histograms_for_dataset(n_keypoints, n_clusters,
                                    "batch_kmeans_%s_clusters_%s_keypoints.pkl" % (
                                    n_clusters, n_keypoints))
 
-    f_descriptor = os.path.join(save_root,
-                                "image_descriptors_dictionary_%s_keypoints.pkl" % n_keypoints)
-
     with open(kmeans_path, 'rb') as f:
         kmeans = pickle.load(f)
-    with open(f_descriptor, 'rb') as f:
-        descriptor_list = pickle.load(f)
+    descriptor_list = load_descriptor_store(save_root, n_keypoints)
     plot_prefix = "plots_%s_keypoints_%s_clusters/" % (n_keypoints, n_clusters)
     for label in dataset.class_indices.keys():
         labelIndices = dataset.class_indices[label]
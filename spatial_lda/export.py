@@ -0,0 +1,188 @@
+"""Export of feature backbones to graph runtimes for CPU extraction.
+
+Long extraction runs spend a noticeable share of their time in eager-mode
+PyTorch overhead.  A backbone (a truncated torchvision model, see backbones,
+or the feature path of one of our own models.ResNet, models.InceptionV3 and
+models.SegNet networks) is traced once and then run as
+
+    "torchscript"  a frozen TorchScript graph, optimized for inference when
+                   loaded (conv / batch norm folding, fused kernels);
+    "onnx"         an ONNX graph run by a local ONNX Runtime session, when the
+                   onnx and onnxruntime packages are installed.
+
+Exported graphs are saved so later runs skip the tracing, and every export
+is checked against the eager model on a batch of real images before it is
+used.
+"""
+
+import copy
+import os
+import warnings
+
+import torch
+
+from inference_engine import inference_context
+
+RUNTIMES = ("torchscript", "onnx")
+
+
+class FeaturePath(torch.nn.Module):
+    """The feature path of one of our own models as a plain forward: the
+    pooled features of a models.ResNet (get_feature), the penultimate layer
+    of a models.InceptionV3 (featureModel) or the encoder output of a
+    models.SegNet (get_feature)."""
+
+    def __init__(self, model):
+        super(FeaturePath, self).__init__()
+        if hasattr(model, "featureModel"):
+            # shallow copy: shares the weights, only the flag differs
+            model = copy.copy(model)
+            model.featureModel = True
+        self.model = model
+
+    def forward(self, x):
+        if hasattr(self.model, "get_feature"):
+            return self.model.get_feature(x)
+        return self.model(x)
+
+
+def get_feature_path(model):
+    """Wraps our own models in a FeaturePath; other models (torchvision
+    backbones, truncated or not) are returned as they are."""
+    if hasattr(model, "get_feature") or hasattr(model, "featureModel"):
+        return FeaturePath(model)
+    return model
+
+
+def export_torchscript(model, example, path):
+    """Traces model on an example batch, freezes the graph (weights become
+    constants) and saves it to path."""
+    with inference_context(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        traced = torch.jit.trace(model.eval(), example)
+    # inference_mode tensors cannot be frozen, so freeze under no_grad
+    with torch.no_grad():
+        frozen = torch.jit.freeze(traced)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    torch.jit.save(frozen, path)
+
+
+def load_torchscript(path):
+    # optimize_for_inference rewrites the graph into ops that cannot be
+    # serialized, so it is applied at load time rather than before saving
+    return torch.jit.optimize_for_inference(
+        torch.jit.load(path, map_location="cpu"))
+
+
+def export_onnx(model, example, path):
+    """Exports model to an ONNX graph with a dynamic batch dimension."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    kwargs = dict(input_names=["images"], output_names=["features"],
+                  dynamic_axes={"images": {0: "batch"},
+                                "features": {0: "batch"}})
+    with torch.no_grad():
+        try:
+            torch.onnx.export(model.eval(), (example,), path, dynamo=False,
+                              **kwargs)
+        except TypeError:  # torch < 2.5 has a single exporter
+            torch.onnx.export(model.eval(), (example,), path, **kwargs)
+
+
+class OnnxRuntimeModel(torch.nn.Module):
+    """Runs an exported ONNX graph with ONNX Runtime on the CPU, taking and
+    returning torch tensors like the model it was exported from.
+
+    Arguments:
+        path (str): The .onnx file.
+        num_threads (int): Intra-op threads of the session; None lets ONNX
+            Runtime decide.
+    """
+
+    def __init__(self, path, num_threads=None):
+        super(OnnxRuntimeModel, self).__init__()
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception("The onnx runtime needs the onnxruntime package")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        outputs = self.session.run(None, {self.input_name: x.numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+def check_parity(eager, exported, images, tolerance=1e-3):
+    """Compares an exported model with the eager one on a batch of images.
+
+    Returns:
+        The largest absolute difference between the two outputs, relative to
+        the largest eager activation.  An Exception is raised when it exceeds
+        tolerance.
+    """
+    with inference_context():
+        expected = eager(images)
+        actual = exported(images)
+    if tuple(actual.shape) != tuple(expected.shape):
+        raise Exception("Exported model gives shape %s instead of %s" % (
+            tuple(actual.shape), tuple(expected.shape)))
+    error = float((actual.float() - expected.float()).abs().max() /
+                  max(float(expected.float().abs().max()), 1e-12))
+    if error > tolerance:
+        raise Exception("Exported model differs from the eager one by %.2e "
+                        "(tolerance %.0e)" % (error, tolerance))
+    return error
+
+
+def export_backbone(model, images, path, runtime, num_threads=None,
+                    tolerance=1e-3):
+    """Returns model running in runtime (see RUNTIMES), loaded from path when
+    it was exported before and exported there otherwise.
+
+    Arguments:
+        model: The eager feature model.
+        images: A batch of real input images, used to trace the model and to
+            check the exported graph against it.
+        path (str): Exported graph, without extension; .pt or .onnx is
+            appended.
+        runtime (str): "torchscript" or "onnx"; None returns model.
+        num_threads (int): ONNX Runtime intra-op threads.
+        tolerance (float): See check_parity.
+    """
+    if runtime is None:
+        return model
+    if runtime not in RUNTIMES:
+        raise Exception("Unknown runtime %s" % runtime)
+    model = get_feature_path(model).eval()
+    torchscript = runtime == "torchscript"
+    path = path + (".pt" if torchscript else ".onnx")
+
+    def load():
+        if torchscript:
+            return load_torchscript(path)
+        return OnnxRuntimeModel(path, num_threads)
+
+    if os.path.exists(path):
+        exported = load()
+        try:
+            error = check_parity(model, exported, images, tolerance)
+        except Exception as e:
+            # saved from a different model (e.g. new weights): export again
+            print("%s, exporting it again" % e)
+            os.remove(path)
+    if not os.path.exists(path):
+        if torchscript:
+            export_torchscript(model, images, path)
+        else:
+            export_onnx(model, images, path)
+        exported = load()
+        error = check_parity(model, exported, images, tolerance)
+    print("running %s graph %s (parity with eager: %.2e)" % (
+        runtime, path, error))
+    return exported
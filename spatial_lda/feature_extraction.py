@@ -3,52 +3,608 @@ import numpy as np
 import os
 from sklearn.cluster import MiniBatchKMeans, KMeans
 from scipy.special import kl_div as KL
+import scipy.sparse
 import pickle
 from skimage import io
 import matplotlib.pyplot as plt
 from dataset import *
+from descriptor_store import DescriptorStore, DescriptorStoreWriter, \
+    convert_descriptor_dictionary
+from descriptor_cache import DescriptorCache, hash_image_files
+from codebook import StreamingCodebookTrainer
+from vocab_tree import VocabularyTree
+from reduction import DescriptorReducer, ReducedCodebook
+from inference_engine import InferenceEngine, flatten_activations, \
+    PRECISIONS
+import backbones
+from quantization import quantize_backbone
+from export import export_backbone
 import torch
 import torchvision
 from tqdm import tqdm
-import gc
 import copy
+import sys
+import time
+import contextlib
+from multiprocessing import Pool
 
 # Hyperparameters
 n_keypoints = 300  # hyperparameter, need to tune
 n_cnn_keypoints = 4 * 49
 n_clusters = 300  # also need to tune this
 feature_model = "alexnetg"  # see experiment_calls.txt for possible list of models
-cnn_num_layers_removed = 3  # NOTE set to None for sift
+# layers removed from the end of the backbone, fewer than its top-level
+# children (alexnet has 3: features, avgpool, classifier); None uses the
+# backbone's default truncation.  NOTE set to None for sift
+cnn_num_layers_removed = 2
 num_most_common_labels_used = 25
+# Storage dtypes for descriptors: SIFT values are whole numbers in 0-255, so
+# uint8 is lossless.  CNN activations are kept exact in float32; "float16"
+# halves them on disk but is lossy (about 3 significant digits, values past
+# 65504 clipped), so check its effect on the visual words (compare_descriptors)
+# before switching.  Rows are upcast to float32 a chunk at a time for k-means.
+sift_descriptor_dtype = "uint8"
+cnn_descriptor_dtype = "float32"
+# "detect" runs the SIFT keypoint detector; "dense" computes descriptors on a
+# fixed grid, so every image gets the same number of descriptors (see
+# get_expected_descriptor_count) and no image is dropped
+sift_mode = "detect"
+dense_sift_image_size = 256  # images are resized to this square first
+dense_sift_stride = 16  # grid spacing in pixels
+dense_sift_scales = (8, 16)  # keypoint diameters computed at each grid point
+# Decode images straight at reduced resolution (longer edge in pixels, see
+# dataset.decode_image); None decodes at full resolution
+decode_max_edge_length = None
+# Input crops for CNN features: "center" (fixed resize and center crop) or an
+# int n (n x n grid of tiles at fixed offsets, whose descriptors are pooled
+# per image) give the same descriptors on every run, so they can be cached;
+# None keeps the backbone's training transform, random crops for some nets
+cnn_eval_crops = "center"
+cnn_batch_size = 79
+cnn_num_workers = None  # image decoding processes; None picks from CPU count
+cnn_num_threads = None  # intra-op threads for the forward pass; None likewise
+# Forward pass precision, "float32" or "bfloat16" (CPU autocast, for CPUs with
+# bf16 vector instructions; its features get their own cache and directory),
+# and whether to run it in the channels_last (NHWC) memory format
+cnn_precision = "float32"
+cnn_channels_last = False
+# int8 CPU inference for create_feature_matrix_cnn: None (float32), "dynamic"
+# (backbones with Linear layers only) or "static" (see quantization); tap
+# extraction always runs in float32
+cnn_quantization = None
+cnn_calibration_images = 256  # images used to calibrate static quantization
+# Graph runtime for the backbone: None (eager PyTorch), "torchscript" (frozen,
+# optimized graph) or "onnx" (ONNX Runtime, if installed).  Exports are
+# checked against the eager model and, matching it, share its features cache
+cnn_runtime = None
+n_sift_workers = os.cpu_count()  # processes used for SIFT extraction
+# Extraction checkpoints, keyed by image content and extractor config
+descriptor_cache_root = os.path.join(data_root, "descriptor_cache")
+descriptor_cache_shard_size = 500  # images per checkpoint
+codebook_memory_budget_mb = 2048  # descriptors held at once by k-means
+codebook_reservoir_size = 100000  # rows sampled to seed k-means, or None
+# (branching_factor, depth) to quantize with a VocabularyTree instead of a
+# flat codebook; n_clusters must then equal branching_factor ** depth.  The
+# shape tags the data directory, so tree and flat codebooks never collide
+vocab_tree_shape = None
+# Reduce CNN descriptors before codebook training and assignment: None, or
+# (method, n_components) with method "pca" (IncrementalPCA) or "random"
+# (sparse random projection) and n_components below the descriptor dimension
+# (H * W of the feature map, 36 for alexnet's conv features), e.g.
+# ("pca", 16); see reduction.  The reduced store is written by a second pass
+# over the finished descriptor store
+cnn_descriptor_reduction = None
+# Layers to extract in one pass by create_feature_matrices_cnn_taps: ints
+# count layers removed (like cnn_num_layers_removed), strs are module names
+# of the full model (e.g. "features.7"); the defaults fit alexnet
+cnn_tap_points = [2, "features.7"]
+# Local copies of backbone weights and of truncated backbones (see backbones)
+backbone_weights_root = os.path.join(data_root, "backbone_weights")
+truncated_backbone_root = os.path.join(data_root, "truncated_backbones")
+exported_backbone_root = os.path.join(data_root, "exported_backbones")
+
+
+@contextlib.contextmanager
+def hyperparameters(**values):
+    """Sets the hyperparameters above (by name) for the duration of a with
+    block, restoring them afterwards.  The functions of this module read
+    them when called, so one process can work through several settings;
+    other processes are not affected.  Note that defaults of keyword
+    arguments (e.g. n_keypoints=n_keypoints) keep their import-time value,
+    so pass those explicitly."""
+    module = sys.modules[__name__]
+    previous = {}
+    for name in values:
+        if not hasattr(module, name):
+            raise Exception("Unknown hyperparameter %s" % name)
+        previous[name] = getattr(module, name)
+    try:
+        for name, value in values.items():
+            setattr(module, name, value)
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+def get_base_model():
+    """The full, untruncated feature model."""
+    return backbones.load_backbone(feature_model,
+                                   weights_root=backbone_weights_root)
 
 
 def get_model():
-    model = torchvision.models.alexnet(pretrained=True)
-    # Remove off the last layer of this classifier
-    new_classifier = torch.nn.Sequential(
-        *list(model.children())[:-cnn_num_layers_removed])
-    print(new_classifier)
-    model = new_classifier
+    # cnn_num_layers_removed = None uses the backbone's default truncation
+    model = backbones.load_truncated_backbone(
+        feature_model, cnn_num_layers_removed,
+        weights_root=backbone_weights_root,
+        truncated_root=truncated_backbone_root)
+    print(model)
     return model
 
 
 def get_feature_vector(img):
     # Get keypoints and feature descriptors
+    if sift_mode == "dense":
+        return get_dense_feature_vector(img)
     sift = cv.SIFT_create(n_keypoints)
     kp, des = sift.detectAndCompute(img, None)
     return kp, des
 
 
+def get_dense_keypoints(image_size=None, stride=None, scales=None):
+    """Keypoints on a regular grid over an image_size x image_size image,
+    one per grid point and scale.  The grid is inset by half the largest
+    scale so every patch lies inside the image.  Arguments default to the
+    dense_sift_* hyperparameters."""
+    image_size = image_size or dense_sift_image_size
+    stride = stride or dense_sift_stride
+    scales = scales or dense_sift_scales
+    margin = max(scales) / 2.0
+    steps = np.arange(margin, image_size - margin + 1, stride)
+    return [cv.KeyPoint(float(x), float(y), float(size))
+            for y in steps for x in steps for size in scales]
+
+
+def get_expected_descriptor_count():
+    """Number of descriptors an image must have to be histogrammed: the
+    dense grid size in dense mode, n_keypoints otherwise."""
+    if sift_mode == "dense":
+        return len(get_dense_keypoints())
+    return n_keypoints
+
+
+def get_codebook_tag():
+    """Suffix of the data directory names for the codebook kind: empty for
+    a flat codebook, the shape for a vocabulary tree (e.g. "_tree10x3")."""
+    if vocab_tree_shape is None:
+        return ""
+    return "_tree%dx%d" % tuple(vocab_tree_shape)
+
+
+def get_sift_model_name():
+    """Name of the SIFT variant, used as its data directory, tagged with the
+    vocabulary tree shape when there is one."""
+    return ("dense_sift" if sift_mode == "dense" else "sift") + \
+        get_codebook_tag()
+
+
+def get_dense_feature_vector(img, sift=None, keypoints=None):
+    """Computes SIFT descriptors on the dense grid of get_dense_keypoints,
+    skipping keypoint detection entirely.
+
+    Returns:
+        The keypoints and a (len(keypoints) x 128) descriptor array, with the
+        same number of rows for every image.
+    """
+    if sift is None:
+        sift = cv.SIFT_create()
+    if keypoints is None:
+        keypoints = get_dense_keypoints()
+    img = cv.resize(img, (dense_sift_image_size, dense_sift_image_size),
+                    interpolation=cv.INTER_AREA)
+    kp, des = sift.compute(img, keypoints)
+    return kp, des
+
+
+# Per-process state for the SIFT worker pool
+_worker_dataset = None
+_worker_sift = None
+_worker_keypoints = None
+
+
+def _init_sift_worker(dataset, n_keypoints):
+    """Pool initializer: keeps a handle on the dataset and builds a single
+    SIFT detector that is reused for every image handled by this worker."""
+    global _worker_dataset, _worker_sift, _worker_keypoints
+    cv.setNumThreads(1)  # parallelism comes from the pool, not from OpenCV
+    _worker_dataset = dataset
+    _worker_sift = cv.SIFT_create(n_keypoints)
+    _worker_keypoints = get_dense_keypoints() if sift_mode == "dense" else None
+
+
+def _sift_worker(idx):
+    img, _ = _worker_dataset[idx]
+    if _worker_keypoints is not None:
+        _, des = get_dense_feature_vector(img, _worker_sift, _worker_keypoints)
+    else:
+        _, des = _worker_sift.detectAndCompute(img, None)
+    return des
+
+
+def extract_sift_descriptors(dataset, indices=None, n_workers=None,
+                             chunksize=8):
+    """Computes SIFT descriptors for images in the dataset, fanning the
+    images out over a pool of worker processes.
+
+    Arguments:
+        dataset: An ADE20K dataset with no transform applied.
+        indices (list): Dataset indices to process; all images if None.
+        n_workers (int): Number of worker processes, n_sift_workers if None;
+            1 runs in this process.
+        chunksize (int): Number of images handed to a worker at a time.
+
+    Returns:
+        A list of descriptor arrays (or None when SIFT finds no keypoints),
+        in the same order as indices (dataset.image_paths by default).
+    """
+    if indices is None:
+        indices = range(len(dataset))
+    if n_workers is None:  # read here, so hyperparameters() changes apply
+        n_workers = n_sift_workers
+    num_images = len(indices)
+    start = time.time()
+    if n_workers is None or n_workers <= 1:
+        _init_sift_worker(dataset, n_keypoints)
+        descriptors = [_sift_worker(i) for i in tqdm(indices)]
+    else:
+        with Pool(n_workers, initializer=_init_sift_worker,
+                  initargs=(dataset, n_keypoints)) as pool:
+            descriptors = list(tqdm(pool.imap(_sift_worker, indices,
+                                              chunksize=chunksize),
+                                    total=num_images))
+    elapsed = time.time() - start
+    print("Extracted SIFT descriptors for %d images in %.1fs (%.1f images/sec)"
+          % (num_images, elapsed, num_images / max(elapsed, 1e-9)))
+    return descriptors
+
+
+def get_descriptor_store_path(save_root, n_keypoints=n_keypoints):
+    return os.path.join(save_root,
+                        "image_descriptors_%s_keypoints" % n_keypoints)
+
+
+def get_legacy_descriptor_path(save_root, n_keypoints=n_keypoints):
+    return os.path.join(save_root,
+                        "image_descriptors_dictionary_%s_keypoints.pkl" %
+                        n_keypoints)
+
+
+def descriptors_exist(save_root, n_keypoints=n_keypoints):
+    return DescriptorStore.exists(
+        get_descriptor_store_path(save_root, n_keypoints)) or os.path.exists(
+        get_legacy_descriptor_path(save_root, n_keypoints))
+
+
+def load_descriptor_store(save_root, n_keypoints=n_keypoints):
+    """Opens the descriptor store kept under save_root.  A pickled
+    descriptor dictionary left by an older run is converted into a store the
+    first time it is seen."""
+    store_path = get_descriptor_store_path(save_root, n_keypoints)
+    if not DescriptorStore.exists(store_path):
+        legacy_path = get_legacy_descriptor_path(save_root, n_keypoints)
+        if not os.path.exists(legacy_path):
+            raise Exception("No descriptors found for %s keypoints in %s" % (
+                n_keypoints, save_root))
+        print("converting %s to a descriptor store" % legacy_path)
+        convert_descriptor_dictionary(legacy_path, store_path)
+    return DescriptorStore(store_path)
+
+
+def get_codebook_trainer():
+    if vocab_tree_shape is not None:
+        branching_factor, depth = vocab_tree_shape
+        if branching_factor ** depth != n_clusters:
+            raise Exception("vocab_tree_shape %s gives %d words, but "
+                            "n_clusters is %d" % (vocab_tree_shape,
+                                                  branching_factor ** depth,
+                                                  n_clusters))
+        return VocabularyTree(branching_factor, depth,
+                              sample_size=codebook_reservoir_size or 200000)
+    return StreamingCodebookTrainer(n_clusters,
+                                    memory_budget_mb=codebook_memory_budget_mb,
+                                    reservoir_size=codebook_reservoir_size)
+
+
+def get_descriptor_reducer():
+    if cnn_descriptor_reduction is None:
+        return None
+    method, n_components = cnn_descriptor_reduction
+    return DescriptorReducer(n_components, method,
+                             sample_size=codebook_reservoir_size or 100000,
+                             random_state=0)
+
+
+def get_reduced_store(save_root, descriptor_store, reducer, rewrite=False):
+    """The reduced copy of descriptor_store kept in save_root, under a name
+    keyed on the reducer's method and n_components, written with reducer
+    (a fitted DescriptorReducer) unless it already exists.  This is a
+    post-pass over the finished store: the reducer has to be fit on a
+    sample of all the descriptors before any of them can be reduced.  rewrite=True
+    writes it again, for a reducer that was just fitted."""
+    reduced_path = get_descriptor_store_path(save_root, n_keypoints) + \
+        "_reduced_%s%d" % (reducer.method, reducer.n_components)
+    if not rewrite and DescriptorStore.exists(reduced_path):
+        return DescriptorStore(reduced_path)
+    return reducer.reduce_store(descriptor_store, reduced_path)
+
+
+def get_sift_cache_config():
+    if sift_mode == "dense":
+        return {"extractor": "dense_sift", "image_size": dense_sift_image_size,
+                "stride": dense_sift_stride,
+                "scales": list(dense_sift_scales),
+                "dtype": sift_descriptor_dtype,
+                "max_edge_length": decode_max_edge_length}
+    return {"extractor": "sift", "n_keypoints": n_keypoints,
+            "dtype": sift_descriptor_dtype,
+            "max_edge_length": decode_max_edge_length}
+
+
+def get_cnn_cache_config(tap=None, quantization=None):
+    """Cache config of the CNN features at a tap point (see
+    inference_engine.resolve_tap), cnn_num_layers_removed by default.  Int
+    taps share their cache with the truncated model of the same depth."""
+    config = {"extractor": "cnn", "model": feature_model,
+              "dtype": cnn_descriptor_dtype,
+              "max_edge_length": decode_max_edge_length}
+    if cnn_eval_crops is not None:
+        crop_size, resize = backbones.get_eval_sizes(feature_model)
+        config["transform"] = {"crops": cnn_eval_crops, "crop_size": crop_size,
+                               "resize": resize}
+    if quantization is not None:  # float32 configs keep their old key
+        config["quantization"] = quantization
+    if cnn_precision != "float32":
+        config["precision"] = cnn_precision
+    spec = backbones.get_backbone_spec(feature_model)
+    if isinstance(spec, backbones.StudentSpec):  # students can be retrained
+        config["trained_at"] = spec.trained_at
+    if tap is None:
+        tap = cnn_num_layers_removed
+    if isinstance(tap, str):
+        config["tap"] = tap
+    else:
+        config["cnn_num_layers_removed"] = tap
+    return config
+
+
+def get_tap_dir(tap):
+    """Data directory of the CNN features at a tap point.  Int taps use the
+    directory of the truncated model of the same depth."""
+    name = feature_model
+    if cnn_precision != "float32":
+        name = "%s_%s" % (name, get_precision_tag())
+    name += get_codebook_tag()
+    if isinstance(tap, str):
+        return getDirPrefix(num_most_common_labels_used,
+                            "%s_%s" % (name, tap.replace(".", "_")),
+                            makedirs=True)
+    return getDirPrefix(num_most_common_labels_used, name,
+                        cnn_num_layers_removed=tap, makedirs=True)
+
+
+def get_cnn_dataset(model_name=None):
+    """The CNN feature dataset, with the input transform of model_name
+    (feature_model by default)."""
+    transform = backbones.get_backbone_transform(model_name or feature_model,
+                                                 cnn_eval_crops)
+    dataset = ADE20K(root=getDataRoot(), transform=transform,
+                     useStringLabels=True, randomSeed=49,
+                     maxEdgeLength=decode_max_edge_length)
+    mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
+        num_most_common_labels_used)))
+    dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
+    dataset.useOneHotLabels()
+    return dataset
+
+
+def get_precision_tag():
+    if cnn_precision not in PRECISIONS:
+        raise Exception("Unknown precision %s" % cnn_precision)
+    return {"float32": "fp32", "bfloat16": "bf16"}[cnn_precision]
+
+
+def get_cnn_model_name():
+    """Name of the CNN features' data directory: feature_model, tagged with
+    the quantization mode when int8 inference is on, the precision when it
+    is not float32, the reduction when descriptors are reduced before
+    clustering and the vocabulary tree shape when there is one."""
+    name = feature_model
+    if cnn_quantization is not None:
+        name = "%s_%s_int8" % (name, cnn_quantization)
+    if cnn_precision != "float32":
+        name = "%s_%s" % (name, get_precision_tag())
+    if cnn_descriptor_reduction is not None:
+        name = "%s_%s%d" % ((name,) + tuple(cnn_descriptor_reduction))
+    return name + get_codebook_tag()
+
+
+def get_calibration_batches(dataset, n_images=None):
+    """Image batches from an evenly spaced subset of the dataset, for
+    calibrating static quantization."""
+    n_images = min(n_images or cnn_calibration_images, len(dataset))
+    indices = np.linspace(0, len(dataset) - 1, n_images).astype(int).tolist()
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices),
+        batch_size=cnn_batch_size, shuffle=False)
+    # tiled inputs (N x n x C x H x W) are calibrated on the tiles
+    return (images.flatten(0, 1) if images.dim() == 5 else images
+            for images, _ in loader)
+
+
+def get_inference_model(model, dataset, mode=None, runtime=None):
+    """Applies the cnn_quantization mode (or mode) to a truncated backbone,
+    calibrating static quantization on dataset, then moves it to the
+    cnn_runtime (or runtime) graph runtime.  A failed export falls back to
+    the eager model."""
+    mode = cnn_quantization if mode is None else mode
+    runtime = cnn_runtime if runtime is None else runtime
+    calibration = get_calibration_batches(dataset) if mode == "static" \
+        else None
+    model = quantize_backbone(model, mode, calibration)
+    if runtime is None:
+        return model
+    images = next(get_calibration_batches(dataset, 8))
+    path = os.path.join(exported_backbone_root, "%s_%s_%s" % (
+        feature_model, mode or "float32", cnn_num_layers_removed))
+    try:
+        return export_backbone(model, images, path, runtime,
+                               num_threads=cnn_num_threads)
+    except Exception as e:
+        print("%s export failed (%s), running the eager model" % (runtime, e))
+        return model
+
+
+def get_cnn_engine(model):
+    return InferenceEngine(
+        model, batch_size=cnn_batch_size, num_workers=cnn_num_workers,
+        num_threads=cnn_num_threads,
+        postprocess=lambda outputs: flatten_activations(
+            outputs, cnn_descriptor_dtype),
+        precision=cnn_precision, channels_last=cnn_channels_last)
+
+
+def extract_descriptors_incremental(dataset, config, extract_fn, store_root,
+                                    dtype=None, descriptor_shape=None):
+    """Extracts descriptors for a dataset, checkpointing every
+    descriptor_cache_shard_size images under descriptor_cache_root.
+
+    Images are keyed by a hash of their file content, so a rerun with the
+    same config only processes images that are new or have changed, and an
+    interrupted run picks up after its last finished shard.
+
+    Arguments:
+        dataset: Dataset whose image_paths are to be extracted.
+        config (dict): Extractor configuration the cache is keyed on.
+        extract_fn: Callable mapping a list of dataset indices to a list of
+            per-image descriptor arrays in the same order.  When
+            descriptor_shape is given it is instead called as
+            extract_fn(indices, writer) and writes the descriptors into a
+            preallocated FixedDescriptorStoreWriter by position in indices.
+        store_root (str): Where the assembled DescriptorStore is written.
+        dtype: Dtype the descriptors are stored with; as extracted if None.
+        descriptor_shape (tuple): (rows, dim) of every image's descriptors,
+            for extractors with a fixed output shape.
+
+    Returns:
+        A DescriptorStore over dataset.image_paths, in dataset order.
+    """
+    cache = DescriptorCache(descriptor_cache_root, config, dtype=dtype)
+    hashes = hash_image_files(dataset.image_paths, descriptor_cache_root)
+    todo = cache.missing(hashes)
+    print("%d of %d images already extracted, %d to go" % (
+        len(dataset) - len(todo), len(dataset), len(todo)))
+    for start in range(0, len(todo), descriptor_cache_shard_size):
+        indices = todo[start:start + descriptor_cache_shard_size]
+        if descriptor_shape is not None:
+            cache.add_fixed_shard(
+                [hashes[i] for i in indices], descriptor_shape[0],
+                descriptor_shape[1],
+                lambda writer: extract_fn(indices, writer))
+        else:
+            descriptors = extract_fn(indices)
+            cache.add_shard(zip([hashes[i] for i in indices], descriptors))
+    if descriptor_shape is not None:
+        return cache.assemble(dataset.image_paths, hashes, store_root,
+                              *descriptor_shape)
+    return cache.assemble(dataset.image_paths, hashes, store_root)
+
+
 def build_histogram(descriptor_list, cluster_alg, n_clusters):
     """Helper function/sub-routine that uses a fitted clustering algorithm
     and a descriptor list for an image to a histogram."""
     histogram = np.zeros(n_clusters)
-    cluster_result = cluster_alg.predict(descriptor_list)
+    cluster_result = cluster_alg.predict(
+        np.asarray(descriptor_list, dtype=np.float32))
     for i in cluster_result:
         histogram[i] += 1.0
     return histogram
 
 
+def build_histograms(descriptor_store, cluster_alg, n_clusters, ids=None,
+                     chunk_rows=1 << 18):
+    """Batched version of build_histogram over a whole DescriptorStore.
+
+    Descriptor rows are assigned to clusters in chunks of about chunk_rows
+    rows, and each chunk is histogrammed with a single pass over its
+    (image, cluster) pairs.  Row i of the result holds the same counts as
+    build_histogram(descriptor_store[ids[i]], cluster_alg, n_clusters).
+
+    Arguments:
+        descriptor_store: A DescriptorStore.
+        cluster_alg: A fitted clustering algorithm with a predict method.
+        n_clusters (int): Number of clusters (histogram bins).
+        ids (list): Image ids to histogram; every image if None.
+        chunk_rows (int): Approximate number of rows predicted at once.
+
+    Returns:
+        A (len(ids) x n_clusters) scipy.sparse.csr_matrix of int32 counts.
+    """
+    if ids is None:
+        ids = np.arange(len(descriptor_store))
+    ids = np.asarray(ids, dtype=np.int64)
+    counts = descriptor_store.counts[ids]
+    row_nnz = np.zeros(len(ids), dtype=np.int64)
+    indices = []
+    data = []
+    for start, end, rows in descriptor_store.iter_chunks(ids, chunk_rows):
+        if rows.shape[0] == 0:
+            continue
+        cluster_result = cluster_alg.predict(
+            np.asarray(rows, dtype=np.float32))
+        image_index = np.repeat(np.arange(start, end), counts[start:end])
+        # sorted unique (image, cluster) keys are already in CSR order
+        keys, key_counts = np.unique(image_index * n_clusters +
+                                     cluster_result, return_counts=True)
+        row_nnz[start:end] = np.bincount(keys // n_clusters - start,
+                                         minlength=end - start)
+        indices.append(keys % n_clusters)
+        data.append(key_counts)
+    indptr = np.concatenate([[0], np.cumsum(row_nnz)])
+    indices = np.concatenate(indices) if indices else np.zeros(0, np.int64)
+    data = np.concatenate(data) if data else np.zeros(0, np.int64)
+    return scipy.sparse.csr_matrix(
+        (data.astype(np.int32), indices.astype(np.int32), indptr),
+        shape=(len(ids), n_clusters))
+
+
+def feature_matrix_exists(feature_path):
+    return os.path.exists(feature_path + ".npz") or os.path.exists(
+        feature_path)
+
+
+def save_feature_matrix(feature_path, M, index_mask=None):
+    """Saves a histogram matrix as a compressed sparse .npz file, with the
+    SIFT index mask (if any) next to it."""
+    scipy.sparse.save_npz(feature_path + ".npz", scipy.sparse.csr_matrix(M))
+    if index_mask is not None:
+        np.save(feature_path + "_mask.npy", np.asarray(index_mask, dtype=bool))
+
+
+def load_feature_matrix(feature_path):
+    """Loads a histogram matrix written by save_feature_matrix, returning
+    (M, index_mask) when a mask was saved and M otherwise.  Feature matrices
+    pickled by older runs are returned as they were pickled."""
+    if not os.path.exists(feature_path + ".npz"):
+        with open(feature_path, "rb") as f:
+            return pickle.load(f)
+    M = scipy.sparse.load_npz(feature_path + ".npz").tocsr()
+    mask_path = feature_path + "_mask.npy"
+    if os.path.exists(mask_path):
+        return M, np.load(mask_path).tolist()
+    return M
+
+
 def get_difference_histograms(hist1, hist2, metric="l2"):
     """Helper function/sub-routine to compute the distance between two
     distributions."""
@@ -245,16 +801,14 @@ def create_feature_matrix(img_path, n_clusters=n_clusters):
     # Make clustering algorithm
     kmeans = KMeans(n_clusters=n_clusters)
     img_files = os.listdir(img_path)  # img_file should be
-    descriptor_path = "/home/yaatehr/programs/spatial_LDA/data" \
-                      "/image_descriptors_dictionary_%s_keypoints.pkl" % \
-                      n_keypoints
+    descriptor_path = get_descriptor_store_path(
+        "/home/yaatehr/programs/spatial_LDA/data", n_keypoints)
     print(descriptor_path)
-    # uncomment for pickled descriptor_list_dic
-    # with open(descriptor_path, "rb") as f:
-    # descriptor_list_dic = pickle.load(f)
+    # uncomment for stored descriptors
+    # descriptor_list_dic = DescriptorStore(descriptor_path)
 
-    # uncomment to create descriptor_list_dic
-    descriptor_list_dic = {}  # f: descriptor vectors
+    # uncomment to create the descriptor store
+    writer = DescriptorStoreWriter(descriptor_path, dtype=sift_descriptor_dtype)
     num_files = 0
     for l in img_files:
         label_path = os.path.join(img_path, l)  # a/
@@ -271,15 +825,15 @@ def create_feature_matrix(img_path, n_clusters=n_clusters):
                     print(str(num_files + 1) + " files processed")
                 A = cv.imread(os.path.join(singular_label_path, f))  # read
                 _, des = get_feature_vector(A)
-                descriptor_list_dic[f] = des
-    with open(descriptor_path, "wb") as f:
-        pickle.dump(descriptor_list_dic, f)
-    print("Dumped descriptor dictionary of %s keypoints" % n_keypoints)
+                writer.append(f, des)
+    descriptor_list_dic = writer.close()
+    print("Dumped descriptor store of %s keypoints" % n_keypoints)
 
-    vstack = np.vstack([i for i in list(descriptor_list_dic.values()) if
-                        i is not None and i.shape[0] == n_keypoints])
+    complete = np.flatnonzero(
+        descriptor_list_dic.counts == get_expected_descriptor_count())
+    vstack = descriptor_list_dic.select_rows(complete)
     print(vstack.shape)
-    kmeans.fit(vstack)
+    kmeans.fit(np.asarray(vstack, dtype=np.float32))
     kmeans_path = "/home/yaatehr/programs/spatial_LDA/data/kmeans_" \
                   "%s_clusters_%s_keypoints.pkl" % (n_clusters, n_keypoints)
     with open(kmeans_path, "wb") as f:
@@ -287,41 +841,43 @@ def create_feature_matrix(img_path, n_clusters=n_clusters):
         # kmeans = pickle.load(f)
     print('dumped kmeans model')
 
-    # Get image files
-    M = []
-    num_files = 0
-    for l in img_files:
-        label_path = os.path.join(img_path, l)  # a/
-        labels = os.listdir(label_path)  # a/amusement_park
-        for label in labels:
-            singular_label_path = os.path.join(label_path, label)
-            print(singular_label_path)
-            images = os.listdir(singular_label_path)
-            for f in images:  # Iterate over all image files
-                if f[-3:] != "jpg":
-                    continue
-                if num_files % 100 == 0:
-                    print(str(num_files) + " files processed")
-                des = descriptor_list_dic[
-                    f]  # Get keypoints/descriptors from SIFT
-                if des is None or des.shape[0] != n_keypoints:
-                    continue
-                histogram = build_histogram(des, kmeans, n_clusters)
-
-                M.append(histogram)  # Append to output matrix
-                num_files += 1
+    # Histogram the images with n_keypoints descriptors, in directory order
+    M = build_histograms(descriptor_list_dic, kmeans, n_clusters,
+                         ids=complete)
     return M, kmeans
 
 
-def create_feature_matrix_cnn():
-    save_root = getDirPrefix(num_most_common_labels_used, feature_model,
-                             cnn_num_layers_removed=cnn_num_layers_removed,
-                             makedirs=True)
+def get_cnn_save_root():
+    """Data directory of the CNN features of feature_model truncated by
+    cnn_num_layers_removed."""
+    return getDirPrefix(num_most_common_labels_used, get_cnn_model_name(),
+                        cnn_num_layers_removed=cnn_num_layers_removed,
+                        makedirs=True)
+
 
-    # DUMP DESCRIPTOR LIST
-    descriptor_path = os.path.join(save_root,
-                                   "image_descriptors_dictionary_%s_keypoints.pkl" % \
-                                   (n_keypoints))
+def extract_cnn_store(save_root):
+    """Extracts (or loads from the descriptor cache) the CNN features of
+    the dataset into the descriptor store of save_root."""
+    dataset = get_cnn_dataset()
+    model = get_inference_model(get_model(), dataset)
+    engine = get_cnn_engine(model)
+
+    def extract(indices, writer):
+        # activations go straight into the shard, by position in indices
+        engine.extract_into(dataset, writer, indices)
+
+    descriptor_dict = extract_descriptors_incremental(
+        dataset, get_cnn_cache_config(quantization=cnn_quantization),
+        extract, get_descriptor_store_path(save_root, n_keypoints),
+        dtype=cnn_descriptor_dtype,
+        descriptor_shape=engine.output_shape(dataset))
+    print('dumped descriptor store for %s, %s, %s' % (
+        feature_model, cnn_num_layers_removed, n_keypoints))
+    return descriptor_dict
+
+
+def create_feature_matrix_cnn():
+    save_root = get_cnn_save_root()
 
     kmeans_path = os.path.join(save_root,
                                "kmeans_%s_clusters_%s_keypoints.pkl" % (
@@ -331,77 +887,27 @@ def create_feature_matrix_cnn():
                                    "batch_kmeans_%s_clusters_%s_keypoints.pkl" % (
                                    n_clusters, n_keypoints))
 
-    if not (os.path.exists(kmeans_path) and os.path.exists(descriptor_path)):
+    if not (os.path.exists(kmeans_path) and
+            descriptors_exist(save_root, n_keypoints)):
         print(
             "NO PATHS FOUND, overwriting descriptors and kmeans for: \n %s \n "
             "%s_clusters_%s_keypoints" % (
             save_root, n_clusters, n_keypoints))
-        minibatchkmeans = MiniBatchKMeans(n_clusters=n_clusters)
-        kmeans = KMeans(n_clusters)
-        usingMinibatch = False
-        model = get_model()
-        transform = get_model_transform(feature_model)
-        dataset = ADE20K(root=getDataRoot(), transform=transform,
-                         useStringLabels=True, randomSeed=49)
-        mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
-            num_most_common_labels_used)))
-        dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
-        dataset.useOneHotLabels()
-        num_images = len(dataset)
-        batch_size = 79
-        loader = get_single_loader(dataset=dataset, batch_size=batch_size)
-        descriptor_dict = {}
-        bar = tqdm(total=num_images)
-
-        for step, (img, label) in enumerate(loader):
-            outputs = model(img)
-            unrolled_outputs = torch.flatten(outputs,
-                                             start_dim=2).detach().numpy()
-            # unrolled_outputs = np.apply_along_axis(featureNormalize, 1,
-            # unrolled_outputs)
-
-            # build the descriptor map
-            offset = step * batch_size
-
-            descriptors = dict(
-                zip(dataset.image_paths[offset:offset + batch_size],
-                    unrolled_outputs.tolist()))
-            descriptor_dict.update(descriptors)
-            batch_outputs_for_kmeans = unrolled_outputs.reshape(-1,
-                                                                unrolled_outputs.shape[
-                                                                    -1])
-
-            # build kmeans  fit input
-            if step == 0:
-                vstack = batch_outputs_for_kmeans
-                continue
-            vstack = np.vstack((vstack, batch_outputs_for_kmeans))
-            del outputs
-            gc.collect()
-            bar.update(batch_size)
-
-        bar.close()
-
-        with open(descriptor_path, "wb") as f:
-            pickle.dump(descriptor_dict, f)
-            # kmeans = pickle.load(f)
-        print('dumped descriptor dict for %s, %d, %s' % (
-        feature_model, cnn_num_layers_removed, n_keypoints))
-        gc.collect()
-        print("falling back to minibatch")
-        kmeans = minibatchkmeans.fit(vstack)
-        usingMinibatch = True
-
-        # DUMP KMEANS
-        if not usingMinibatch:
-            kmeans_path = os.path.join(save_root, "kmeans_" \
-                                                  "%s_clusters_%s_keypoints.pkl" % (
-                                       n_clusters, n_keypoints))
-        else:
-            kmeans_path = os.path.join(save_root, "batch_kmeans_" \
-                                                  "%s_clusters_%s_keypoints.pkl" % (
-                                       n_clusters, n_keypoints))
-
+        descriptor_dict = extract_cnn_store(save_root)
+        reducer = get_descriptor_reducer()
+        if reducer is not None:
+            # the codebook is trained and applied in the reduced space
+            reducer.fit_store(descriptor_dict)
+            descriptor_dict = get_reduced_store(save_root, descriptor_dict,
+                                                reducer, rewrite=True)
+        kmeans = get_codebook_trainer().fit_store(descriptor_dict)
+        if reducer is not None:
+            kmeans = ReducedCodebook(reducer, kmeans)
+
+        # DUMP KMEANS, under the batch_kmeans_ name of streamed codebooks
+        kmeans_path = os.path.join(save_root,
+                                   "batch_kmeans_%s_clusters_%s_keypoints.pkl" % (
+                                   n_clusters, n_keypoints))
         with open(kmeans_path, "wb") as f:
             pickle.dump(kmeans, f)
             # kmeans = pickle.load(f)
@@ -410,106 +916,342 @@ def create_feature_matrix_cnn():
         print("LOADING CHECKPOINTS")
         with open(kmeans_path, 'rb') as f:
             kmeans = pickle.load(f)
-        with open(descriptor_path, 'rb') as f:
-            descriptor_dict = pickle.load(f)
+        descriptor_dict = load_descriptor_store(save_root, n_keypoints)
+        if isinstance(kmeans, ReducedCodebook):
+            descriptor_dict = get_reduced_store(save_root, descriptor_dict,
+                                                kmeans.reducer)
 
     # build histograms for CNN Features
-    hist_list = []
     print("building historgram")
-    for path in descriptor_dict.keys():
-        des = descriptor_dict[path]
-        histogram = build_histogram(des, kmeans, n_clusters)
-        hist_list.append(histogram)
+    if isinstance(kmeans, ReducedCodebook):
+        # descriptor_dict already holds the reduced descriptors
+        hist_list = build_histograms(descriptor_dict, kmeans.kmeans,
+                                     n_clusters)
+    else:
+        hist_list = build_histograms(descriptor_dict, kmeans, n_clusters)
 
     return hist_list, kmeans
 
 
+def compare_descriptors(reference, other, n_topics=10):
+    """Measures how far descriptors computed another way (other) drift from
+    reference descriptors downstream: a codebook is fit on the reference
+    descriptors and used to histogram both sets, and an LDA model fit on the
+    reference histograms assigns topics to both.
+
+    Arguments:
+        reference: (n_images x rows x dim) reference descriptors.
+        other: Descriptors of the same images, same shape.
+        n_topics (int): Topics of the LDA model.
+
+    Returns:
+        A dictionary with the relative activation error, the mean L1
+        distance between normalized histograms, the fraction of descriptors
+        assigned a different word and the fraction of images whose most
+        likely topic changes.
+    """
+    from sklearn.decomposition import LatentDirichletAllocation
+    n_images, rows_per_image, dim = reference.shape
+    reference_rows = reference.reshape(-1, dim).astype(np.float32)
+    other_rows = other.reshape(-1, dim).astype(np.float32)
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=0).fit(
+        reference_rows)
+    reference_words = kmeans.predict(reference_rows)
+    other_words = kmeans.predict(other_rows)
+    image_index = np.repeat(np.arange(n_images), rows_per_image)
+    reference_hist = np.zeros((n_images, n_clusters))
+    other_hist = np.zeros((n_images, n_clusters))
+    np.add.at(reference_hist, (image_index, reference_words), 1)
+    np.add.at(other_hist, (image_index, other_words), 1)
+    lda = LatentDirichletAllocation(n_components=n_topics,
+                                    random_state=0).fit(reference_hist)
+    reference_topics = np.argmax(lda.transform(reference_hist), axis=1)
+    other_topics = np.argmax(lda.transform(other_hist), axis=1)
+    return {"activation_error": float(
+                np.linalg.norm(other_rows - reference_rows) /
+                max(np.linalg.norm(reference_rows), 1e-12)),
+            "histogram_l1": float(np.mean(np.sum(np.abs(
+                other_hist - reference_hist), axis=1) / rows_per_image)),
+            "words_changed": float(np.mean(reference_words != other_words)),
+            "topics_changed": float(np.mean(
+                reference_topics != other_topics))}
+
+
+def run_engine(engine, dataset, indices):
+    """Descriptors of dataset[indices] stacked in one array, and the
+    seconds the engine spent in forward passes."""
+    engine.output_shape(dataset)  # untimed warm-up forward pass
+    torch.manual_seed(0)  # identical random crops for every engine
+    outputs = np.stack(engine.extract(dataset, indices))
+    return outputs, engine.timer.seconds["forward"]
+
+
+def report_quantization_drift(mode="static", n_images=200, n_topics=10):
+    """Measures what int8 inference changes downstream of the backbone.
+
+    The truncated backbone and its quantized copy are run over the same
+    n_images images (in a fixed order, with the same crops), and their
+    descriptors compared with compare_descriptors.
+
+    Returns:
+        The compare_descriptors dictionary, with the forward-pass speedup.
+    """
+    dataset = get_cnn_dataset()
+    indices = np.linspace(0, len(dataset) - 1,
+                          min(n_images, len(dataset))).astype(int).tolist()
+    float_model = get_model()
+    quant_model = get_inference_model(float_model, dataset, mode)
+
+    def activations(model):
+        return run_engine(InferenceEngine(
+            model, batch_size=cnn_batch_size, num_workers=0,
+            num_threads=cnn_num_threads), dataset, indices)
+
+    float_des, float_seconds = activations(float_model)
+    quant_des, quant_seconds = activations(quant_model)
+    report = {"mode": mode,
+              "speedup": float_seconds / max(quant_seconds, 1e-9)}
+    report.update(compare_descriptors(float_des, quant_des, n_topics))
+    print("%(mode)s int8: %(speedup).2fx forward speedup, relative "
+          "activation error %(activation_error).4f, histogram L1 "
+          "%(histogram_l1).4f, words changed %(words_changed).3f, topic "
+          "assignments changed %(topics_changed).3f" % report)
+    return report
+
+
+def benchmark_precision(names=None, precision="bfloat16", channels_last=True,
+                        n_images=64, n_topics=10, pretrained=True):
+    """Compares float32 NCHW inference with another precision and memory
+    format for each backbone of the registry.
+
+    Every backbone, truncated at its default tap, is run over the same
+    n_images images both ways; throughput is measured on the forward pass
+    and the drift of the descriptors with compare_descriptors.
+
+    Arguments:
+        names (list): Backbone names, every entry of backbones.BACKBONES if
+            None.
+        precision (str): See inference_engine.PRECISIONS.
+        channels_last (bool): Use the channels_last memory format.
+        n_images (int): Images run through each backbone.
+        n_topics (int): Topics of the LDA model in compare_descriptors.
+        pretrained (bool): Use pretrained weights (fetched once, see
+            backbones.load_backbone) rather than random ones.
+
+    Returns:
+        A list of dictionaries, one per backbone.
+    """
+    results = []
+    for name in names or list(backbones.BACKBONES):
+        dataset = get_cnn_dataset(name)
+        indices = np.linspace(0, len(dataset) - 1,
+                              min(n_images, len(dataset))).astype(int).tolist()
+        model = backbones.load_truncated_backbone(
+            name, pretrained=pretrained, weights_root=backbone_weights_root,
+            truncated_root=truncated_backbone_root)
+        float_des, float_seconds = run_engine(
+            InferenceEngine(model, batch_size=cnn_batch_size, num_workers=0,
+                            num_threads=cnn_num_threads), dataset, indices)
+        # built second: channels_last converts the model's weights in place
+        fast_des, fast_seconds = run_engine(
+            InferenceEngine(model, batch_size=cnn_batch_size, num_workers=0,
+                            num_threads=cnn_num_threads, precision=precision,
+                            channels_last=channels_last), dataset, indices)
+        result = {"backbone": name, "precision": precision,
+                  "channels_last": channels_last,
+                  "float32_images_per_second": len(indices) / max(
+                      float_seconds, 1e-9),
+                  "images_per_second": len(indices) / max(fast_seconds, 1e-9)}
+        result.update(compare_descriptors(float_des, fast_des, n_topics))
+        print("%(backbone)s: %(float32_images_per_second).1f -> "
+              "%(images_per_second).1f images/sec, relative activation "
+              "error %(activation_error).4f, histogram L1 "
+              "%(histogram_l1).4f, words changed %(words_changed).3f, topic "
+              "assignments changed %(topics_changed).3f" % result)
+        results.append(result)
+    return results
+
+
+def benchmark_student(student_name, n_images=200, n_topics=10):
+    """Compares a distilled student backbone (see train_cnn.distillStudent)
+    with its truncated teacher on the same n_images images: forward-pass
+    speedup, and how far the student's descriptors drift downstream (see
+    compare_descriptors), including the fraction of images whose most
+    likely topic agrees.
+
+    Returns:
+        The compare_descriptors dictionary, with the speedup and the topic
+        agreement.
+    """
+    spec = backbones.get_backbone_spec(student_name)
+    if not isinstance(spec, backbones.StudentSpec):
+        raise Exception("%s is not a distilled student" % student_name)
+    dataset = get_cnn_dataset(student_name)
+    indices = np.linspace(0, len(dataset) - 1,
+                          min(n_images, len(dataset))).astype(int).tolist()
+    models = [backbones.load_truncated_backbone(
+        name, tap, weights_root=backbone_weights_root,
+        truncated_root=truncated_backbone_root)
+        for name, tap in [(spec.teacher, spec.teacher_tap),
+                          (student_name, 0)]]
+    (teacher_des, teacher_seconds), (student_des, student_seconds) = [
+        run_engine(InferenceEngine(model, batch_size=cnn_batch_size,
+                                   num_workers=0,
+                                   num_threads=cnn_num_threads),
+                   dataset, indices) for model in models]
+    report = {"student": student_name, "teacher": spec.teacher,
+              "speedup": teacher_seconds / max(student_seconds, 1e-9)}
+    report.update(compare_descriptors(teacher_des, student_des, n_topics))
+    report["topic_agreement"] = 1 - report["topics_changed"]
+    print("%(student)s vs %(teacher)s: %(speedup).2fx forward speedup, "
+          "relative activation error %(activation_error).4f, histogram L1 "
+          "%(histogram_l1).4f, words changed %(words_changed).3f, topic "
+          "agreement %(topic_agreement).3f" % report)
+    return report
+
+
+def extract_cnn_tap_descriptors(taps=None):
+    """Extracts CNN features at several tap points with a single pass of
+    the full model over the dataset, checkpointing each tap in its own
+    descriptor cache.
+
+    Arguments:
+        taps (list): Tap points, cnn_tap_points by default.
+
+    Returns:
+        A {tap: DescriptorStore} dictionary, each store written under the
+        tap's get_tap_dir.
+    """
+    taps = cnn_tap_points if taps is None else list(taps)
+    dataset = get_cnn_dataset()
+    engine = get_cnn_engine(get_base_model())
+    shapes = engine.output_shape(dataset, taps)
+    caches = {tap: DescriptorCache(descriptor_cache_root,
+                                   get_cnn_cache_config(tap),
+                                   dtype=cnn_descriptor_dtype)
+              for tap in taps}
+    hashes = hash_image_files(dataset.image_paths, descriptor_cache_root)
+    # an image missing from any tap is run once for all of them
+    todo = sorted(set().union(*[cache.missing(hashes)
+                                for cache in caches.values()]))
+    print("%d of %d images already extracted at all %d tap points" % (
+        len(dataset) - len(todo), len(dataset), len(taps)))
+    for start in range(0, len(todo), descriptor_cache_shard_size):
+        indices = todo[start:start + descriptor_cache_shard_size]
+        shard_hashes = [hashes[i] for i in indices]
+        writers = {tap: caches[tap].open_fixed_shard(shard_hashes,
+                                                     *shapes[tap])
+                   for tap in taps}
+        engine.extract_taps_into(dataset, writers, indices)
+        for tap in taps:
+            caches[tap].commit_fixed_shard(writers[tap])
+    return {tap: caches[tap].assemble(
+        dataset.image_paths, hashes,
+        get_descriptor_store_path(get_tap_dir(tap), n_keypoints),
+        *shapes[tap]) for tap in taps}
+
+
+def create_feature_matrices_cnn_taps(taps=None):
+    """create_feature_matrix_cnn for several tap points at once: features
+    come from one pass of extract_cnn_tap_descriptors, then each tap gets
+    its own codebook (saved in its directory) and histograms.
+
+    Returns:
+        A {tap: (hist_list, kmeans)} dictionary.
+    """
+    results = {}
+    for tap, descriptor_dict in extract_cnn_tap_descriptors(taps).items():
+        kmeans = get_codebook_trainer().fit_store(descriptor_dict)
+        kmeans_path = os.path.join(
+            get_tap_dir(tap), "batch_kmeans_%s_clusters_%s_keypoints.pkl" % (
+                n_clusters, n_keypoints))
+        with open(kmeans_path, "wb") as f:
+            pickle.dump(kmeans, f)
+        print("building historgram for tap %s" % (tap,))
+        results[tap] = (build_histograms(descriptor_dict, kmeans, n_clusters),
+                        kmeans)
+    return results
+
+
+def get_sift_dataset():
+    """The SIFT feature dataset: images of the num_most_common_labels_used
+    most common labels, without a transform."""
+    dataset = ADE20K(root=getDataRoot(), transform=None,
+                     useStringLabels=True, randomSeed=49,
+                     maxEdgeLength=decode_max_edge_length)
+    mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
+        num_most_common_labels_used)))
+    dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
+    return dataset
+
+
+def extract_sift_store(dataset, save_root, n_workers=None):
+    """Extracts (or loads from the descriptor cache) the SIFT descriptors
+    of dataset into the descriptor store of save_root, on n_workers
+    processes (n_sift_workers if None)."""
+    descriptor_dict = extract_descriptors_incremental(
+        dataset, get_sift_cache_config(),
+        lambda indices: extract_sift_descriptors(dataset, indices, n_workers),
+        get_descriptor_store_path(save_root, n_keypoints),
+        dtype=sift_descriptor_dtype)
+    print("Dumped descriptor store of %s keypoints" % n_keypoints)
+    return descriptor_dict
+
+
+def fit_sift_codebook(descriptor_dict):
+    """Trains the codebook on the images with a full set of descriptors."""
+    return get_codebook_trainer().fit_store(
+        descriptor_dict,
+        ids=np.flatnonzero(
+            descriptor_dict.counts == get_expected_descriptor_count()))
+
+
+def build_sift_feature_matrix(descriptor_dict, dataset, kmeans):
+    """Histograms of the images of dataset that have a full set of
+    descriptors.
+
+    Returns:
+        (hist_list, index_mask), index_mask marking the images of dataset
+        that have a histogram row.
+    """
+    print("building historgram")
+    ids = np.array([descriptor_dict.get_id(path) for path in
+                    dataset.image_paths])
+    index_mask = (descriptor_dict.counts[ids] ==
+                  get_expected_descriptor_count()).tolist()
+    hist_list = build_histograms(descriptor_dict, kmeans, n_clusters,
+                                 ids=ids[index_mask])
+    return hist_list, index_mask
+
+
 def create_feature_matrix_sift():
     # save_root = os.path.join(os.path.dirname(__file__), '../data')
-    save_root = getDirPrefix(num_most_common_labels_used, "sift")
-
-    # DUMP DESCRIPTOR LIST
-    descriptor_path = os.path.join(save_root,
-                                   "image_descriptors_dictionary_%s_keypoints.pkl" % \
-                                   (n_keypoints))
+    save_root = getDirPrefix(num_most_common_labels_used,
+                             get_sift_model_name())
 
     kmeans_path = os.path.join(save_root,
                                "kmeans_%s_clusters_%s_keypoints.pkl" % (
                                n_clusters, n_keypoints))
 
-    if not (os.path.exists(kmeans_path) and os.path.exists(descriptor_path)):
+    dataset = get_sift_dataset()
+    if not (os.path.exists(kmeans_path) and
+            descriptors_exist(save_root, n_keypoints)):
         print(
             "NO PATHS FOUND, overwriting descriptors and kmeans for: \n %s \n "
             "%s_clusters_%s_keypoints" % (
             save_root, n_clusters, n_keypoints))
-        minibatchkmeans = MiniBatchKMeans(n_clusters=n_clusters)
-        kmeans = KMeans(n_clusters)
-        dataset = ADE20K(root=getDataRoot(), transform=None,
-                         useStringLabels=True, randomSeed=49)
-        mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
-            num_most_common_labels_used)))
-        dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
-        num_images = len(dataset)
-        descriptor_dict = {}
-        bar = tqdm(total=num_images)
-
-        for step, (img, label) in enumerate(dataset):
-            _, des = get_feature_vector(img)
-            f = dataset.image_paths[step]
-            descriptor_dict[f] = des
-            if step % 50 == 0:
-                bar.update(50)
-
-        bar.close()
-
-        with open(descriptor_path, "wb") as f:
-            pickle.dump(descriptor_dict, f)
-        print("Dumped descriptor dictionary of %s keypoints" % n_keypoints)
-        vstack = np.vstack([i for i in list(descriptor_dict.values()) if
-                            i is not None and i.shape[0] == n_keypoints])
-        print(vstack.shape)
-        kmeans.fit(vstack)
+        descriptor_dict = extract_sift_store(dataset, save_root)
+        kmeans = fit_sift_codebook(descriptor_dict)
         with open(kmeans_path, "wb") as f:
             pickle.dump(kmeans, f)
             # kmeans = pickle.load(f)
         print('dumped kmeans model')
-
-        hist_list = []
-        index_mask = []
-        print("building historgram")
-        for i, path in enumerate(dataset.image_paths):
-            des = descriptor_dict[path]
-
-            if des is None or des.shape[0] != n_keypoints:
-                index_mask.append(False)
-                continue
-            histogram = build_histogram(des, kmeans, n_clusters)
-            hist_list.append(histogram)
-            index_mask.append(True)
     else:
         with open(kmeans_path, 'rb') as f:
             kmeans = pickle.load(f)
-        with open(descriptor_path, 'rb') as f:
-            descriptor_dic = pickle.load(f)
-        dataset = ADE20K(root=getDataRoot(), transform=None,
-                         useStringLabels=True, randomSeed=49)
-        mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
-            num_most_common_labels_used)))
-        dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
-        hist_list = []
-        index_mask = []
-        print("building historgram")
-        for i, path in enumerate(dataset.image_paths):
-            des = descriptor_dic[path.split('/')[-1]]
-
-            if des is None or des.shape[0] != n_keypoints:
-                index_mask.append(False)
-                continue
-            histogram = build_histogram(des, kmeans, n_clusters)
-            hist_list.append(histogram)
-            index_mask.append(True)
+        descriptor_dict = load_descriptor_store(save_root, n_keypoints)
 
-    return (hist_list, index_mask), kmeans
+    return build_sift_feature_matrix(descriptor_dict, dataset, kmeans), kmeans
 
 
 def make_dataset_directory(dataset_filepath):
@@ -0,0 +1,370 @@
+"""Parallel runner for hyperparameter grids over the full pipeline.
+
+The pipeline's hyperparameters (feature_model, cnn_num_layers_removed,
+n_keypoints, n_clusters, n_topics) are module level globals, so sweeping
+them used to take one process launch per grid cell, each redoing the work
+it shares with the others.  run_grid instead turns a grid into a
+dependency graph of three stages,
+
+    descriptors  per (feature_model, cnn_num_layers_removed, n_keypoints)
+    features     per descriptors and n_clusters (codebook and histograms)
+    lda          per features and n_topics (topics and predictions)
+
+so every shared artifact is computed exactly once, runs each stage as soon
+as the stages it needs are done, spread over a process pool, and writes
+one row per cell to a CSV results table.  Descriptor stages start processes
+of their own (the SIFT pool, DataLoader workers), which daemonic pool
+workers may not, so they run in the calling process, one at a time, while
+the pool runs feature and LDA stages; CNN backbones are fetched and
+truncated there before anything is scheduled.  Each stage sets the
+hyperparameters it needs in its own process (feature_extraction.
+hyperparameters), and the CPUs are divided between the stages running at
+once: each stage's own SIFT pool, image loaders and torch threads get
+cpu_count / n_workers CPUs, instead of each sizing itself to the whole
+machine.  Artifacts go where the single-run pipeline puts them, so
+finished stages are reused by later runs and by lda.py.
+
+SIFT cells ignore cnn_num_layers_removed and CNN cells n_keypoints (CNN
+features always use feature_extraction.n_keypoints in their file names).
+"""
+
+import os
+import csv
+import time
+import pickle
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import feature_extraction as fe
+import lda
+from descriptor_store import DescriptorStore
+from descriptor_cache import hash_image_files
+
+GRID_KEYS = ("feature_model", "cnn_num_layers_removed", "n_keypoints",
+             "n_clusters", "n_topics")
+SIFT_MODELS = ("sift", "dense_sift")
+RESULT_KEYS = GRID_KEYS + ("n_documents", "perplexity", "descriptor_seconds",
+                           "features_seconds", "lda_seconds", "feature_path",
+                           "error")
+
+# Hyperparameters
+n_grid_workers = os.cpu_count()  # processes running stages at once
+
+
+def expand_grid(grid):
+    """The cells of a grid, a dictionary of lists of values of GRID_KEYS
+    (a key left out takes its current value in feature_extraction, or
+    lda.n_topics).  Values a cell ignores are normalized, and duplicate
+    cells dropped.
+
+    Returns:
+        A list of {key: value} cells.
+    """
+    defaults = {name: [getattr(fe, name)] for name in GRID_KEYS[:-1]}
+    defaults["n_topics"] = [lda.n_topics]
+    values = [grid.get(name, defaults[name]) for name in GRID_KEYS]
+    cells = []
+    for combination in itertools.product(*values):
+        cell = dict(zip(GRID_KEYS, combination))
+        if cell["feature_model"] in SIFT_MODELS:
+            cell["cnn_num_layers_removed"] = None
+        else:
+            cell["n_keypoints"] = fe.n_keypoints
+        if cell not in cells:
+            cells.append(cell)
+    return cells
+
+
+def get_stage_cpus(n_workers):
+    """CPUs each stage gets when n_workers stages run at once."""
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers or 1))
+
+
+def get_cell_hyperparameters(cell, n_cpus=None):
+    """feature_extraction hyperparameters of a cell's stages, with their
+    inner parallelism limited to n_cpus CPUs when given."""
+    values = dict(n_keypoints=cell["n_keypoints"],
+                  n_clusters=cell["n_clusters"])
+    if n_cpus is not None:
+        # the split InferenceEngine makes by default, on n_cpus; one CPU
+        # loads images in the stage's own process
+        values["n_sift_workers"] = n_cpus
+        values["cnn_num_workers"] = 0 if n_cpus <= 1 else max(1, n_cpus // 4)
+        values["cnn_num_threads"] = max(1, n_cpus - values["cnn_num_workers"])
+    if cell["feature_model"] in SIFT_MODELS:
+        values["sift_mode"] = "dense" if cell["feature_model"] == \
+            "dense_sift" else "detect"
+    else:
+        values["feature_model"] = cell["feature_model"]
+        values["cnn_num_layers_removed"] = cell["cnn_num_layers_removed"]
+    return values
+
+
+def fetch_backbones(cells):
+    """Fetches the weights of the cells' CNN backbones and saves their
+    truncated copies, once per backbone and truncation, so no two stages
+    download or write them at the same time."""
+    fetched = set()
+    for cell in cells:
+        if cell["feature_model"] in SIFT_MODELS:
+            continue
+        key = (cell["feature_model"], cell["cnn_num_layers_removed"])
+        if key not in fetched:
+            with fe.hyperparameters(**get_cell_hyperparameters(cell)):
+                fe.get_model()
+            fetched.add(key)
+
+
+def build_descriptors(cell, n_cpus=None):
+    """Extracts the cell's descriptors on n_cpus CPUs (all by default),
+    unless their store exists.
+
+    Returns:
+        {"save_root": data directory, "descriptor_seconds": time taken}.
+    """
+    start = time.time()
+    with fe.hyperparameters(**get_cell_hyperparameters(cell, n_cpus)):
+        if cell["feature_model"] in SIFT_MODELS:
+            save_root = fe.getDirPrefix(fe.num_most_common_labels_used,
+                                        fe.get_sift_model_name(),
+                                        makedirs=True)
+        else:
+            save_root = fe.get_cnn_save_root()
+        if not DescriptorStore.exists(
+                fe.get_descriptor_store_path(save_root, fe.n_keypoints)):
+            if cell["feature_model"] in SIFT_MODELS:
+                fe.extract_sift_store(fe.get_sift_dataset(), save_root)
+            else:
+                fe.extract_cnn_store(save_root)
+    return dict(save_root=save_root, descriptor_seconds=time.time() - start)
+
+
+def build_features(cell, n_cpus, descriptors):
+    """Trains the cell's codebook and builds its feature matrix on n_cpus
+    CPUs, unless the matrix exists.
+
+    Returns:
+        descriptors, plus feature_path, the image_ids of the matrix rows
+        and features_seconds.
+    """
+    start = time.time()
+    save_root = descriptors["save_root"]
+    sift = cell["feature_model"] in SIFT_MODELS
+    with fe.hyperparameters(**get_cell_hyperparameters(cell, n_cpus)):
+        feature_path = os.path.join(
+            save_root, "feature_matrix_%s_keypoints_%s_clusters" % (
+                fe.n_keypoints, fe.n_clusters))
+        kmeans_path = os.path.join(
+            save_root, "%skmeans_%s_clusters_%s_keypoints.pkl" % (
+                "" if sift else "batch_", fe.n_clusters, fe.n_keypoints))
+        dataset = fe.get_sift_dataset() if sift else fe.get_cnn_dataset()
+        if fe.feature_matrix_exists(feature_path):
+            index_mask = fe.load_feature_matrix(feature_path)[1] if sift \
+                else None
+        else:
+            store = fe.load_descriptor_store(save_root, fe.n_keypoints)
+            if sift:
+                kmeans = fe.fit_sift_codebook(store)
+                M, index_mask = fe.build_sift_feature_matrix(store, dataset,
+                                                             kmeans)
+            else:
+                if fe.cnn_descriptor_reduction is not None:
+                    raise Exception("The grid runner does not reduce CNN "
+                                    "descriptors, set "
+                                    "cnn_descriptor_reduction to None")
+                kmeans = fe.get_codebook_trainer().fit_store(store)
+                M = fe.build_histograms(store, kmeans, fe.n_clusters)
+                index_mask = None
+            with open(kmeans_path, "wb") as f:
+                pickle.dump(kmeans, f)
+            fe.save_feature_matrix(feature_path, M, index_mask)
+    image_ids = list(dataset.image_paths)
+    if index_mask is not None:
+        image_ids = [f for f, keep in zip(image_ids, index_mask) if keep]
+    return dict(descriptors, feature_path=feature_path, image_ids=image_ids,
+                features_seconds=time.time() - start)
+
+
+def build_lda(cell, features):
+    """Fits the cell's LDA model, saves its predictions next to the
+    features and returns the cell's row of the results table."""
+    start = time.time()
+    M = fe.load_feature_matrix(features["feature_path"])
+    if isinstance(M, tuple):  # SIFT matrices carry their index mask
+        M = M[0]
+    lda_model = lda.LDA2("", M, n_topics=cell["n_topics"]).off_the_shelf_LDA()
+    predicted_cluster, cluster_dic, prob_distr_dic = lda.group_predictions(
+        features["image_ids"], lda.batch_transform(lda_model, M, n_workers=1))
+    lda.save_predictions(features["save_root"], predicted_cluster,
+                         cluster_dic, prob_distr_dic, cell["n_topics"],
+                         cell["n_keypoints"], cell["n_clusters"])
+    row = dict(cell, n_documents=M.shape[0],
+               perplexity=lda_model.perplexity(M),
+               lda_seconds=time.time() - start)
+    for name in ("descriptor_seconds", "features_seconds", "feature_path"):
+        row[name] = features[name]
+    return row
+
+
+def run_graph(tasks, n_workers=n_grid_workers, on_result=None,
+              parent_tasks=()):
+    """Runs a dependency graph of tasks, each as soon as the tasks it
+    depends on are done, over a pool of n_workers processes (in this
+    process if n_workers is 1).
+
+    Arguments:
+        tasks (dict): {key: (function, args, dependencies)}, in an order
+            where dependencies come first.  function is called with args
+            followed by the results of its dependencies.
+        n_workers (int): Number of processes.
+        on_result: Called with (key, result) as each task finishes.
+        parent_tasks: Keys of tasks run in this process, one at a time,
+            while the pool works on the others: pool workers are daemonic
+            (on older Pythons), so tasks that start processes of their own
+            (a multiprocessing Pool, DataLoader workers) cannot run there.
+
+    Returns:
+        {key: result}.  A task that raised gets its exception as result,
+        and the tasks depending on it are not run.
+    """
+    seen = set()
+    for key, (_, _, dependencies) in tasks.items():
+        for dependency in dependencies:
+            if dependency not in seen:
+                raise Exception("Task %s depends on %s, which is not an "
+                                "earlier task" % (key, dependency))
+        seen.add(key)
+    results = {}
+
+    def finish(key, result):
+        results[key] = result
+        if isinstance(result, Exception):
+            print("%s failed: %s" % (key, result))
+        if on_result is not None:
+            on_result(key, result)
+
+    def failed_dependency(key):
+        for dependency in tasks[key][2]:
+            if isinstance(results.get(dependency), Exception):
+                return results[dependency]
+        return None
+
+    if n_workers is None or n_workers <= 1:
+        for key, (function, args, dependencies) in tasks.items():
+            error = failed_dependency(key)
+            if error is not None:
+                finish(key, error)
+                continue
+            try:
+                finish(key, function(*args, *[results[d]
+                                              for d in dependencies]))
+            except Exception as e:
+                finish(key, e)
+        return results
+
+    waiting = dict(tasks)
+    running = {}
+    with ProcessPoolExecutor(n_workers) as executor:
+        while waiting or running:
+            ready_in_parent = []
+            for key in list(waiting):
+                function, args, dependencies = waiting[key]
+                if not all(d in results for d in dependencies):
+                    continue
+                error = failed_dependency(key)
+                if error is not None:
+                    del waiting[key]
+                    finish(key, error)
+                elif key in parent_tasks:
+                    ready_in_parent.append(key)
+                else:
+                    del waiting[key]
+                    running[executor.submit(
+                        function, *args,
+                        *[results[d] for d in dependencies])] = key
+            if ready_in_parent:
+                # the pool keeps working while this process runs the task
+                key = ready_in_parent[0]
+                function, args, dependencies = waiting.pop(key)
+                try:
+                    finish(key, function(*args, *[results[d]
+                                                  for d in dependencies]))
+                except Exception as e:
+                    finish(key, e)
+                continue
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    finish(key, future.result())
+                except Exception as e:
+                    finish(key, e)
+    return results
+
+
+def write_results(results_path, rows):
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    with open(results_path + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_KEYS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: row.get(key) for key in RESULT_KEYS})
+    os.replace(results_path + ".tmp", results_path)
+
+
+def run_grid(grid, results_path, n_workers=n_grid_workers):
+    """Runs every cell of a hyperparameter grid (see expand_grid) and
+    writes the results table to results_path, a CSV file updated as cells
+    finish.
+
+    Example:
+        run_grid({"feature_model": ["sift"], "n_keypoints": [100, 300],
+                  "n_clusters": [100, 300], "n_topics": [20, 30]},
+                 "grid_results.csv")
+    extracts SIFT descriptors twice, trains four codebooks and fits eight
+    LDA models.
+
+    Returns:
+        The rows of the results table, one per cell, in grid order.
+    """
+    cells = expand_grid(grid)
+    n_cpus = get_stage_cpus(n_workers)
+    tasks = {}
+    for cell in cells:
+        descriptors = ("descriptors", cell["feature_model"],
+                       cell["cnn_num_layers_removed"], cell["n_keypoints"])
+        features = ("features",) + descriptors[1:] + (cell["n_clusters"],)
+        if descriptors not in tasks:
+            tasks[descriptors] = (build_descriptors, (cell, n_cpus), [])
+        if features not in tasks:
+            tasks[features] = (build_features, (cell, n_cpus),
+                               [descriptors])
+        tasks[("lda",) + features[1:] + (cell["n_topics"],)] = (
+            build_lda, (cell,), [features])
+    print("%d cells: %d descriptor, %d feature and %d LDA stages" % (
+        len(cells), *[sum(key[0] == stage for key in tasks)
+                      for stage in ("descriptors", "features", "lda")]))
+
+    # hash the images once here, so extractions all find their hashes
+    # cached instead of racing to write the hash index
+    hash_image_files(fe.get_sift_dataset().image_paths,
+                     fe.descriptor_cache_root)
+    fetch_backbones(cells)
+
+    rows = {}
+
+    def on_result(key, result):
+        if key[0] != "lda":
+            return
+        rows[key] = result if not isinstance(result, Exception) else dict(
+            tasks[key][1][0], error=str(result))
+        write_results(results_path, [rows[k] for k in tasks if k in rows])
+
+    start = time.time()
+    run_graph(tasks, n_workers, on_result,
+              parent_tasks=[key for key in tasks if key[0] == "descriptors"])
+    print("grid of %d cells done in %.1fs, results in %s" % (
+        len(cells), time.time() - start, results_path))
+    return [rows[key] for key in tasks if key in rows]
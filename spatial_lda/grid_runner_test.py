@@ -0,0 +1,73 @@
+import os
+import unittest
+from multiprocessing import Pool
+import feature_extraction
+from grid_runner import expand_grid, run_graph
+
+
+def add(*values):
+    return sum(values)
+
+
+def fail():
+    raise Exception("failed")
+
+
+def pooled_squares(n):
+    # a stage with a process pool of its own, like SIFT extraction
+    with Pool(2) as pool:
+        return pool.map(abs, range(-n, 0)), os.getpid()
+
+
+def total(squares):
+    return sum(squares[0]), os.getpid()
+
+
+class GridRunnerTestCase(unittest.TestCase):
+    def test_expand_grid(self):
+        cells = expand_grid({"feature_model": ["sift", "resnet18"],
+                             "cnn_num_layers_removed": [1, 2],
+                             "n_keypoints": [100, 300], "n_clusters": [50],
+                             "n_topics": [20, 30]})
+        # sift ignores the truncation, CNNs the number of keypoints
+        self.assertEqual(len(cells), 2 * 2 + 2 * 2)
+        for cell in cells:
+            if cell["feature_model"] == "sift":
+                self.assertIsNone(cell["cnn_num_layers_removed"])
+            else:
+                self.assertEqual(cell["n_keypoints"],
+                                 feature_extraction.n_keypoints)
+
+    def test_run_graph(self):
+        tasks = {"a": (add, (1,), []), "b": (add, (2,), ["a"]),
+                 "c": (fail, (), []), "d": (add, (3,), ["b", "c"]),
+                 "e": (add, (4,), ["a", "b"])}
+        finished = []
+        for n_workers in (1, 2):
+            results = run_graph(tasks, n_workers,
+                                lambda key, result: finished.append(key))
+            self.assertEqual(results["e"], 4 + 1 + 3)
+            # d depends on the failed c, so it is not run
+            self.assertIsInstance(results["d"], Exception)
+            self.assertEqual(sorted(results), sorted(tasks))
+        self.assertEqual(len(finished), 2 * len(tasks))
+
+    def test_run_graph_parent_tasks(self):
+        tasks = {"a": (pooled_squares, (4,), []), "b": (total, (), ["a"])}
+        results = run_graph(tasks, 2, parent_tasks=["a"])
+        # a ran (and started its pool) in this process, b in the pool
+        self.assertEqual(results["a"][1], os.getpid())
+        self.assertEqual(results["b"][0], 1 + 2 + 3 + 4)
+        self.assertNotEqual(results["b"][1], os.getpid())
+
+    def test_run_graph_unknown_dependency(self):
+        tasks = {"a": (add, (1,), ["b"]), "b": (add, (2,), [])}
+        for n_workers in (1, 2):
+            with self.assertRaises(Exception):
+                run_graph(tasks, n_workers)
+            with self.assertRaises(Exception):
+                run_graph({"a": (add, (1,), ["missing"])}, n_workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
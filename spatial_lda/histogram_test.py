@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from sklearn.cluster import KMeans
+from descriptor_store import write_descriptor_store
+from feature_extraction import build_histogram, build_histograms
+from reduction import DescriptorReducer, ReducedCodebook
+
+
+class BuildHistogramsTestCase(unittest.TestCase):
+    def test_matches_build_histogram(self):
+        rng = np.random.RandomState(0)
+        descriptors = [rng.rand(rng.randint(1, 40), 8).astype(np.float32)
+                       for _ in range(25)]
+        kmeans = KMeans(n_clusters=6, n_init=1, random_state=0).fit(
+            np.vstack(descriptors))
+        with tempfile.TemporaryDirectory() as root:
+            store = write_descriptor_store(
+                os.path.join(root, "store"),
+                [(str(i), des) for i, des in enumerate(descriptors)])
+            expected = np.array([build_histogram(des, kmeans, 6)
+                                 for des in descriptors])
+            # small chunks force several predict calls
+            histograms = build_histograms(store, kmeans, 6, chunk_rows=50)
+            np.testing.assert_array_equal(histograms.toarray(), expected)
+            subset = [3, 1, 20]
+            np.testing.assert_array_equal(
+                build_histograms(store, kmeans, 6, ids=subset).toarray(),
+                expected[subset])
+
+    def test_uint8_store_gives_same_histograms(self):
+        # SIFT-like descriptors: whole numbers in 0-255 held as float32
+        rng = np.random.RandomState(1)
+        descriptors = [rng.randint(0, 256, size=(rng.randint(1, 40), 8))
+                       .astype(np.float32) for _ in range(25)]
+        kmeans = KMeans(n_clusters=6, n_init=1, random_state=0).fit(
+            np.vstack(descriptors))
+        items = [(str(i), des) for i, des in enumerate(descriptors)]
+        with tempfile.TemporaryDirectory() as root:
+            exact = write_descriptor_store(os.path.join(root, "float32"),
+                                           items)
+            compact = write_descriptor_store(os.path.join(root, "uint8"),
+                                             items, dtype=np.uint8)
+            self.assertEqual(compact.rows.dtype, np.uint8)
+            np.testing.assert_array_equal(
+                build_histograms(compact, kmeans, 6, chunk_rows=50).toarray(),
+                build_histograms(exact, kmeans, 6).toarray())
+
+    def test_float16_store_clips_and_keeps_words(self):
+        # ReLU-like activations
+        rng = np.random.RandomState(3)
+        descriptors = [np.maximum(rng.randn(rng.randint(1, 40), 8), 0)
+                       .astype(np.float32) * 10 for _ in range(25)]
+        kmeans = KMeans(n_clusters=6, n_init=1, random_state=0).fit(
+            np.vstack(descriptors))
+        items = [(str(i), des) for i, des in enumerate(descriptors)]
+        with tempfile.TemporaryDirectory() as root:
+            exact = write_descriptor_store(os.path.join(root, "float32"),
+                                           items)
+            compact = write_descriptor_store(os.path.join(root, "float16"),
+                                             items, dtype=np.float16)
+            np.testing.assert_array_equal(
+                build_histograms(compact, kmeans, 6, chunk_rows=50).toarray(),
+                build_histograms(exact, kmeans, 6).toarray())
+            # values past float16's 65504 are clipped, not written as inf
+            clipped = write_descriptor_store(
+                os.path.join(root, "clipped"),
+                [("0", np.array([[1e6, -1e6, 1.]], dtype=np.float32))],
+                dtype=np.float16)
+            np.testing.assert_array_equal(
+                clipped.rows, [[65504, -65504, 1]])
+
+    def test_reduced_store_matches_reduced_codebook(self):
+        rng = np.random.RandomState(2)
+        descriptors = [rng.rand(rng.randint(0, 40), 16).astype(np.float32)
+                       for _ in range(25)]
+        items = [(str(i), des) for i, des in enumerate(descriptors)]
+        with tempfile.TemporaryDirectory() as root:
+            store = write_descriptor_store(os.path.join(root, "raw"), items)
+            reducer = DescriptorReducer(4, random_state=0).fit_store(store)
+            reduced = reducer.reduce_store(store, os.path.join(root, "pca"),
+                                           chunk_rows=50)
+            self.assertEqual(reduced.dim, 4)
+            np.testing.assert_array_equal(reduced.counts, store.counts)
+            kmeans = KMeans(n_clusters=6, n_init=1, random_state=0).fit(
+                reduced.rows)
+            # the codebook predicts raw descriptors like the reduced ones
+            np.testing.assert_array_equal(
+                build_histograms(store, ReducedCodebook(reducer, kmeans),
+                                 6).toarray(),
+                build_histograms(reduced, kmeans, 6).toarray())
+            # no more components than descriptor dimensions
+            with self.assertRaises(Exception):
+                DescriptorReducer(16).fit_store(store)
+
+
+if __name__ == '__main__':
+    unittest.main()
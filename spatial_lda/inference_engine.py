@@ -0,0 +1,323 @@
+"""Batched CNN feature inference.
+
+InferenceEngine runs a feature backbone over a dataset with autograd turned
+off, decodes images in parallel DataLoader workers that prefetch batches
+ahead of the forward pass, and converts each batch to compact numpy arrays
+as soon as it comes out of the network, so memory stays flat from the first
+batch to the last.  It keeps track of how long each stage (decode, forward,
+post-process) takes, so a run can report where the CPU time goes.
+"""
+
+import contextlib
+import inspect
+import os
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from descriptor_store import cast_descriptors
+
+
+def inference_context():
+    """torch.inference_mode where available, torch.no_grad otherwise."""
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+PRECISIONS = ("float32", "bfloat16")
+
+
+def precision_context(precision, device_type="cpu"):
+    """Autocast to bfloat16 for precision "bfloat16" (convolutions and
+    matrix products run in bf16, on CPUs with bf16 vector instructions);
+    float32 (or None) runs as is."""
+    if precision in (None, "float32"):
+        return contextlib.nullcontext()
+    if precision == "bfloat16":
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    raise Exception("Unknown precision %s" % precision)
+
+
+def flatten_activations(outputs, dtype=np.float32):
+    """Default post-processing: (N x C x H x W) activations to an
+    (N x C x H*W) array, i.e. C descriptors of dimension H*W per image,
+    converted to dtype with cast_descriptors."""
+    if outputs.dtype == torch.bfloat16:  # numpy has no bfloat16
+        outputs = outputs.float()
+    return cast_descriptors(torch.flatten(outputs, start_dim=2).numpy(),
+                            dtype)
+
+
+def resolve_tap(model, tap):
+    """Returns the module of model a tap point refers to.
+
+    An int tap counts layers removed from the end of the model's top-level
+    children, like cnn_num_layers_removed: tap k is the output of
+    torch.nn.Sequential(*list(model.children())[:-k]).  Auxiliary
+    classifier heads (aux1, AuxLogits, ...), which do not run in eval mode,
+    are not counted.  A str tap is a module name from model.named_modules(),
+    e.g. "features.7".
+    """
+    if isinstance(tap, str):
+        modules = dict(model.named_modules())
+        if tap not in modules:
+            raise Exception("No module named %s in the model" % tap)
+        return modules[tap]
+    children = [module for name, module in model.named_children()
+                if not name.lower().startswith("aux")]
+    if not 0 < tap < len(children):
+        raise Exception("Cannot remove %d of the model's %d layers" % (
+            tap, len(children)))
+    return children[-tap - 1]
+
+
+class _TapsDone(Exception):
+    """Raised by the last tap's hook to skip the rest of the forward pass."""
+
+
+class FeatureTaps:
+    """Captures the activations at several tap points of a model in one
+    forward pass, using forward hooks.  Layers after the deepest tap are
+    not run.  A module that forward calls more than once (e.g. the ReLU a
+    torchvision ResNet block reuses) is captured at its first call only;
+    tap a module that runs once per forward to get a later activation.
+
+    Arguments:
+        model: A torch.nn.Module.
+        taps (list): Tap points, see resolve_tap.
+    """
+
+    def __init__(self, model, taps):
+        self.model = model
+        self.taps = list(taps)
+        self.modules = [resolve_tap(model, tap) for tap in self.taps]
+        self.outputs = {}
+        self._handles = []
+
+    def _hook(self, tap):
+        def hook(module, inputs, output):
+            if tap in self.outputs:
+                return
+            self.outputs[tap] = output
+            if len(self.outputs) == len(self.taps):
+                raise _TapsDone()
+        return hook
+
+    def __enter__(self):
+        for tap, module in zip(self.taps, self.modules):
+            self._handles.append(module.register_forward_hook(self._hook(tap)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __call__(self, images):
+        """Returns {tap: activations} for a batch of images."""
+        self.outputs = {}
+        try:
+            self.model(images)
+        except _TapsDone:
+            pass
+        missing = [tap for tap in self.taps if tap not in self.outputs]
+        if missing:
+            raise Exception("Tap points %s were never reached" % missing)
+        return self.outputs
+
+
+class StageTimer:
+    """Accumulates wall-clock time and item counts per pipeline stage."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+
+    def add(self, stage, seconds, n_items):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.items[stage] = self.items.get(stage, 0) + n_items
+
+    def report(self):
+        total = sum(self.seconds.values())
+        for stage, seconds in self.seconds.items():
+            print("%-12s %8.1fs  %5.1f%%  %8.1f images/sec" % (
+                stage, seconds, 100 * seconds / max(total, 1e-9),
+                self.items[stage] / max(seconds, 1e-9)))
+
+
+def forward_crops(forward, images):
+    """Runs forward on a batch of images or, for an N x n x C x H x W batch
+    of n crops per image (see dataset.get_eval_transform), on all N * n crops
+    at once, concatenating each image's crops along the channel axis: an
+    image's descriptors are those of all its crops."""
+    if images.dim() != 5:
+        return forward(images)
+    n, n_crops = images.shape[:2]
+    outputs = forward(images.flatten(0, 1))
+
+    def join(out):
+        return out.reshape(n, n_crops * out.shape[1], *out.shape[2:])
+
+    if isinstance(outputs, dict):
+        return {tap: join(out) for tap, out in outputs.items()}
+    return join(outputs)
+
+
+class InferenceEngine:
+    """Runs a feature backbone over a dataset in inference mode.
+
+    Arguments:
+        model: A torch.nn.Module mapping an image batch to activations.
+        batch_size (int): Images per forward pass.
+        num_workers (int): DataLoader worker processes decoding images;
+            defaults to a quarter of the CPUs (at least one).
+        prefetch_factor (int): Batches each worker prepares ahead.
+        num_threads (int): Intra-op threads for the forward pass; defaults to
+            the CPUs left over by the decode workers.
+        postprocess: Callable mapping an activation batch (a torch tensor) to
+            a numpy array whose first axis indexes the images; defaults to
+            flatten_activations.
+        precision (str): "float32" or "bfloat16", see precision_context.
+        channels_last (bool): Run the model and its inputs in the
+            channels_last (NHWC) memory format, which the oneDNN CPU
+            convolutions are fastest with.
+    """
+
+    def __init__(self, model, batch_size=64, num_workers=None,
+                 prefetch_factor=2, num_threads=None, postprocess=None,
+                 precision="float32", channels_last=False):
+        cpus = os.cpu_count() or 1
+        if num_workers is None:
+            num_workers = max(1, cpus // 4)
+        if num_threads is None:
+            num_threads = max(1, cpus - num_workers)
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.num_threads = num_threads
+        self.postprocess = postprocess or flatten_activations
+        self.precision = precision
+        self.channels_last = channels_last
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.timer = StageTimer()
+
+    def forward(self, forward, images):
+        """Runs forward (the model or FeatureTaps on it) on a batch in the
+        engine's precision and memory format."""
+        def forward_batch(batch):
+            if self.channels_last:
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            return forward(batch)
+
+        with precision_context(self.precision):
+            return forward_crops(forward_batch, images)
+
+    def get_loader(self, dataset, indices=None):
+        if indices is not None:
+            dataset = torch.utils.data.Subset(dataset, indices)
+        kwargs = {}
+        if self.num_workers > 0 and "prefetch_factor" in inspect.signature(
+                torch.utils.data.DataLoader).parameters:
+            # torch < 1.7 has neither argument (and prefetches 2 batches)
+            kwargs["prefetch_factor"] = self.prefetch_factor
+            kwargs["persistent_workers"] = False
+        # no shuffling: batches come back in dataset order
+        return torch.utils.data.DataLoader(dataset,
+                                           batch_size=self.batch_size,
+                                           shuffle=False,
+                                           num_workers=self.num_workers,
+                                           **kwargs)
+
+    def run(self, dataset, indices=None, taps=None):
+        """Yields (start, outputs) for consecutive batches, where outputs is
+        the post-processed batch for positions start, start + 1, ... of
+        indices (or of the dataset if indices is None).  With taps, outputs
+        is a {tap: post-processed batch} dictionary instead."""
+        loader = self.get_loader(dataset, indices)
+        forward = self.model
+        if taps is not None:
+            forward = FeatureTaps(self.model, taps)
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        start = 0
+        try:
+            if taps is not None:
+                forward.__enter__()
+            with inference_context():
+                batches = iter(loader)
+                progress = tqdm(total=len(loader))
+                while True:
+                    # time spent waiting on the loader; with workers this
+                    # is the decoding the prefetch could not hide
+                    tic = time.time()
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    images = batch[0] if isinstance(batch, (list, tuple)) \
+                        else batch
+                    n = images.shape[0]
+                    self.timer.add("decode", time.time() - tic, n)
+
+                    tic = time.time()
+                    outputs = self.forward(forward, images)
+                    self.timer.add("forward", time.time() - tic, n)
+
+                    tic = time.time()
+                    if taps is not None:
+                        outputs = {tap: self.postprocess(out)
+                                   for tap, out in outputs.items()}
+                    else:
+                        outputs = self.postprocess(outputs)
+                    self.timer.add("postprocess", time.time() - tic, n)
+                    yield start, outputs
+                    start += n
+                    progress.update(1)
+                progress.close()
+        finally:
+            if taps is not None:
+                forward.__exit__(None, None, None)
+            torch.set_num_threads(previous_threads)
+
+    def output_shape(self, dataset, taps=None):
+        """Shape of one image's post-processed output, found by running the
+        model on the first image; a {tap: shape} dictionary with taps."""
+        image = dataset[0]
+        if isinstance(image, (list, tuple)):
+            image = image[0]
+        with inference_context():
+            if taps is None:
+                return self.postprocess(
+                    self.forward(self.model, image[None])).shape[1:]
+            with FeatureTaps(self.model, taps) as forward:
+                outputs = self.forward(forward, image[None])
+            return {tap: self.postprocess(out).shape[1:]
+                    for tap, out in outputs.items()}
+
+    def extract_into(self, dataset, writer, indices=None):
+        """Runs the model over the dataset and writes each batch straight
+        into writer (a FixedDescriptorStoreWriter) at its position."""
+        for start, outputs in self.run(dataset, indices):
+            writer.write(start, outputs)
+        self.timer.report()
+
+    def extract_taps_into(self, dataset, writers, indices=None):
+        """Like extract_into for several tap points in a single pass:
+        writers maps each tap to the writer its activations go to."""
+        for start, outputs in self.run(dataset, indices, taps=list(writers)):
+            for tap, out in outputs.items():
+                writers[tap].write(start, out)
+        self.timer.report()
+
+    def extract(self, dataset, indices=None):
+        """Runs the model over the dataset and returns a list with one
+        post-processed array per image, in order."""
+        descriptors = []
+        for _, outputs in self.run(dataset, indices):
+            descriptors.extend(outputs)
+        self.timer.report()
+        return descriptors
@@ -0,0 +1,136 @@
+import unittest
+import numpy as np
+import os
+import tempfile
+import torch
+from inference_engine import InferenceEngine, FeatureTaps
+from dataset import TileCrop
+from export import export_backbone
+from backbones import BackboneSpec, truncate_backbone
+
+
+class InferenceEngineTestCase(unittest.TestCase):
+    def test_extract_keeps_dataset_order(self):
+        torch.manual_seed(0)
+        images = torch.rand(10, 3, 16, 16)
+        dataset = torch.utils.data.TensorDataset(images,
+                                                 torch.arange(10))
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU())
+        engine = InferenceEngine(model, batch_size=4, num_workers=0)
+        indices = [7, 2, 5, 0, 9]
+        descriptors = engine.extract(dataset, indices)
+        self.assertEqual(len(descriptors), len(indices))
+        with torch.no_grad():
+            expected = torch.flatten(model(images[indices]),
+                                     start_dim=2).numpy()
+        for des, exp in zip(descriptors, expected):
+            np.testing.assert_allclose(des, exp, rtol=1e-5, atol=1e-6)
+
+    def test_bfloat16_and_channels_last(self):
+        torch.manual_seed(0)
+        images = torch.rand(6, 3, 16, 16)
+        dataset = torch.utils.data.TensorDataset(images, torch.arange(6))
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(8, 4, 3), torch.nn.ReLU())
+        with torch.no_grad():
+            expected = torch.flatten(model(images), start_dim=2).numpy()
+        for precision, channels_last, tolerance in (
+                ("float32", True, 1e-5), ("bfloat16", False, 0.05),
+                ("bfloat16", True, 0.05)):
+            engine = InferenceEngine(model, batch_size=4, num_workers=0,
+                                     precision=precision,
+                                     channels_last=channels_last)
+            descriptors = np.stack(engine.extract(dataset))
+            self.assertEqual(descriptors.shape, expected.shape)
+            # bf16 activations come back as float32 arrays
+            self.assertEqual(descriptors.dtype, np.float32)
+            drift = np.linalg.norm(descriptors - expected) / \
+                np.linalg.norm(expected)
+            self.assertLess(drift, tolerance, (precision, channels_last))
+
+    def test_taps_match_truncated_models(self):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(4, 2, 3), torch.nn.ReLU())
+        images = torch.rand(2, 3, 12, 12)
+        with torch.no_grad():
+            with FeatureTaps(model, [3, "2"]) as taps:
+                outputs = taps(images)
+            torch.testing.assert_close(outputs[3], model[:1](images))
+            torch.testing.assert_close(outputs["2"], model[:3](images))
+        # hooks are removed on exit
+        self.assertEqual(len(model[0]._forward_hooks), 0)
+
+    def test_reused_module_keeps_first_call(self):
+        torch.manual_seed(0)
+        relu = torch.nn.ReLU()
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), relu,
+                                    torch.nn.Conv2d(4, 2, 3), relu,
+                                    torch.nn.Conv2d(2, 2, 3))
+        images = torch.rand(2, 3, 12, 12)
+        with torch.no_grad():
+            with FeatureTaps(model, ["1", "4"]) as taps:
+                outputs = taps(images)
+            torch.testing.assert_close(outputs["1"], model[:2](images))
+            torch.testing.assert_close(outputs["4"], model(images))
+
+    def test_loader_on_old_torch(self):
+        # torch < 1.7 DataLoaders take neither prefetch_factor nor
+        # persistent_workers
+        def old_loader(dataset, batch_size=1, shuffle=False, num_workers=0):
+            return num_workers
+
+        engine = InferenceEngine(torch.nn.Identity(), num_workers=2)
+        loader = torch.utils.data.DataLoader
+        torch.utils.data.DataLoader = old_loader
+        try:
+            self.assertEqual(engine.get_loader([]), 2)
+        finally:
+            torch.utils.data.DataLoader = loader
+        self.assertEqual(engine.get_loader([]).prefetch_factor, 2)
+
+    def test_truncating_every_layer_is_rejected(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(4, 2, 3))
+        spec = BackboneSpec("toy", 1)
+        self.assertEqual(len(truncate_backbone(model, spec, 2)), 1)
+        for tap in (3, 4, "missing"):
+            with self.assertRaises(Exception):
+                truncate_backbone(model, spec, tap)
+
+    def test_tiles_become_extra_descriptors(self):
+        torch.manual_seed(0)
+        images = torch.rand(3, 3, 20, 30)
+        tiles = torch.stack([TileCrop(16, 2)(image) for image in images])
+        self.assertEqual(tuple(tiles.shape), (3, 4, 3, 16, 16))
+        # fixed offsets: corners of the image
+        torch.testing.assert_close(tiles[0, 3], images[0, :, 4:, 14:])
+        dataset = torch.utils.data.TensorDataset(tiles, torch.arange(3))
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 2, 3), torch.nn.ReLU())
+        engine = InferenceEngine(model, batch_size=2, num_workers=0)
+        self.assertEqual(tuple(engine.output_shape(dataset)), (8, 196))
+        descriptors = engine.extract(dataset)
+        with torch.no_grad():
+            expected = torch.flatten(model(tiles[1]), start_dim=2).numpy()
+        np.testing.assert_allclose(descriptors[1], expected.reshape(8, 196),
+                                   rtol=1e-5, atol=1e-6)
+
+    def test_torchscript_export_matches_eager(self):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3),
+                                    torch.nn.BatchNorm2d(4),
+                                    torch.nn.ReLU()).eval()
+        images = torch.rand(4, 3, 12, 12)
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "model")
+            exported = export_backbone(model, images[:2], path, "torchscript")
+            self.assertTrue(os.path.exists(path + ".pt"))
+            # the saved graph is reused, and batch size is not fixed
+            exported = export_backbone(model, images[:2], path, "torchscript")
+            with torch.no_grad():
+                torch.testing.assert_close(exported(images), model(images),
+                                           rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,8 @@ Expectation-Maximization."""
 # Native Python imports
 import os
 import copy
+import time
+from multiprocessing import Pool
 
 # External package imports
 import pickle
@@ -12,6 +14,7 @@ import sys
 
 # External package imports
 import numpy as np
+import scipy.sparse
 import cv2 as cv
 from sklearn.decomposition import LatentDirichletAllocation as LDA
 from scipy.special import kl_div
@@ -19,74 +22,171 @@ from dataset import *
 
 # Custom module imports
 import feature_extraction
+import sparse_lda
+import online_lda
 import crop_images
 from feature_extraction import n_keypoints, n_cnn_keypoints, n_clusters, \
     feature_model, cnn_num_layers_removed, num_most_common_labels_used
 
 # Hyperparameters
 n_topics = 30
+lda_transform_chunk_size = 5000  # documents per LDA transform call
+n_lda_workers = 1  # processes running the chunks; 1 runs in this process
 
 
 class LDA2:
-    """Class that implements Latent Dirichlet Allocation using an
-    Expectation-Maximization framework.  This function iterates through the
-    following two steps to find a locally-optimal maximum likelihood estimate of
-    the relevant posterior distribution.
+    """Latent Dirichlet Allocation fit by collapsed Gibbs sampling over the
+    visual-word count matrix, with the sparse sampler of sparse_lda (per
+    token cost grows with the topics a document and a word use, not with
+    n_topics).
 
-    Arguments:
-        features: A numpy array of size (N_images x N_descriptors)
-        alpha (float): A parameter for our LDA model (TODO: add on here).
-        beta (float): A parameter for our LDA model (TODO: add on here).
+    After find_params, components_ (n_topics x vocab_size topic-word
+    pseudo-counts) and transform follow sklearn's LatentDirichletAllocation,
+    so a fitted LDA2 can stand in for it in the prediction code.
 
+    Arguments:
+        data_path (str): Data directory (kept for reference).
+        feature_path: Feature matrix, or the path of one (see
+            get_data_matrix); row m holds the word counts of image m.
+        alpha: Document-topic Dirichlet prior, a float (symmetric) or one
+            value per topic.
+        beta (float): Topic-word Dirichlet prior.
+        eps (float): find_params stops once the per-token log likelihood
+            changes by less than this between checks.
+        n_topics (int): Number of topics.
+        V (int): Vocabulary size, the number of columns of the feature
+            matrix if None.
+        random_state (int): Seed for the initial topics and the sampler.
     """
 
-    # TODO: How do we represent the cardinality of our "vocabulary"
     def __init__(self, data_path, feature_path, alpha=1, beta=1, eps=1e-5,
-                 n_topics=10, V=100):
+                 n_topics=10, V=None, random_state=None):
         self.data_path = data_path  # File path for data
         self.feature_path = feature_path
         self.alpha = alpha  # Dirichlet dist hyperparameter
         self.beta = beta  # Dirichlet dist hyperparameter
         self.log_likelihood = None  # Array of log likelihoods
-        self.parameters = None  # Numpy vector of parameters
+        self.parameters = None  # (theta, phi) once fit
         self.eps = eps  # Convergence threshold
         self.keypoints = None
         self.n_topics = n_topics
+        self.random_state = random_state
         self.get_data_matrix()  # Call in constructor method
-        # self.m_documents = self.M.shape[0]
-        self.vocab_size = V
-        # self.init_LDA()  # Call in constructor method
+        self.vocab_size = self.M.shape[1] if V is None else V
+        if self.vocab_size != self.M.shape[1]:
+            raise Exception("V is %d but the feature matrix has %d words" % (
+                self.vocab_size, self.M.shape[1]))
 
     def get_data_matrix(self):
-        if type(self.feature_path) == list:
-            self.M = self.feature_path  # LAZY OVERRIDE sorry lol
-        else:
-            with open(self.feature_path, 'rb') as f:
-                self.M = pickle.load(f)
-        self.m_documents = None
+        """Sets self.M from feature_path, which is either a feature matrix
+        (sparse, numpy array or list of histograms) or the path of one saved
+        by feature_extraction.save_feature_matrix."""
+        M = self.feature_path  # LAZY OVERRIDE sorry lol
+        if isinstance(M, str):
+            M = feature_extraction.load_feature_matrix(M)
+            if isinstance(M, tuple):  # SIFT matrices carry their index mask
+                M = M[0]
+        if type(M) == list:
+            M = np.vstack(M)
+        self.M = scipy.sparse.csr_matrix(M)
+        self.m_documents = self.M.shape[0]
 
     def off_the_shelf_LDA(self):
         lda = LDA(n_components=self.n_topics)
         lda.fit(self.M)
         return lda
 
-    def init_LDA(self):
-        self.M_word_topic = np.zeros(
-            (self.k_topics, self.m_documents))  # (k x m)
-        self.M_topic_vocab = np.zeros(
-            (self.k_topics, self.vocab_size))  # (k x v)
-        self.M_count_k = np.zeros((self.k_topics, 1))  # (k x 1)
-
-        # Now we need to randomly initialize documents and vocab over topics
-        self.document_topics = np.random.randint(1, self.k_topics,
-                                                 size=(self.k_topics,
-                                                       self.m_documents))
-        # TODO: FINISH THIS
+    def online_LDA(self, shard_root, checkpoint_path=None,
+                   n_passes=online_lda.lda_n_passes):
+        """Online counterpart of off_the_shelf_LDA: writes the rows of
+        self.M that are not sharded yet (all of them for a new shard_root)
+        to feature shards at shard_root and trains an online_lda.OnlineLDA
+        on them, resuming and extending the model at checkpoint_path when
+        there is one.  self.M is taken to extend the matrix the existing
+        shards were written from, i.e. images are only ever appended."""
+        manifest = online_lda.load_manifest(shard_root)
+        n_sharded = sum(shard["rows"] for shard in manifest["shards"]) \
+            if manifest is not None else 0
+        if n_sharded > self.M.shape[0]:
+            raise Exception("Shards at %s hold %d rows, the feature matrix "
+                            "only %d" % (shard_root, n_sharded,
+                                         self.M.shape[0]))
+        if n_sharded < self.M.shape[0]:
+            online_lda.append_feature_shards(shard_root, self.M[n_sharded:])
+        return online_lda.train_online_lda(
+            shard_root, n_topics=self.n_topics,
+            checkpoint_path=checkpoint_path, n_passes=n_passes,
+            random_state=self.random_state)
+
+    def get_alpha(self):
+        return np.broadcast_to(np.asarray(self.alpha, dtype=np.float64),
+                               (self.n_topics,)).copy()
+
+    def init_LDA(self, theta=None, phi=None, block_size=100000):
+        """Expands the count matrix into tokens (one per visual word
+        occurrence, grouped by document), gives each a topic and builds the
+        count tables.
+
+        Topics are drawn uniformly at random, or, to warm start the sampler
+        from another model, from p(k) ~ theta[d, k] phi[k, w] given its
+        (m_documents x n_topics) theta and (n_topics x vocab_size) phi."""
+        self.rng = np.random.RandomState(self.random_state)
+        counts = scipy.sparse.csr_matrix(self.M)
+        counts.sum_duplicates()
+        values = np.rint(counts.data).astype(np.int64)
+        if np.any(values < 0):
+            raise Exception("Word counts must be non-negative")
+        self.words = np.repeat(counts.indices, values).astype(np.int32)
+        rows = np.repeat(np.arange(self.m_documents), np.diff(counts.indptr))
+        row_tokens = np.bincount(rows, weights=values,
+                                 minlength=self.m_documents).astype(np.int64)
+        self.doc_ptr = np.concatenate([[0], np.cumsum(row_tokens)])
+        self.docs = np.repeat(np.arange(self.m_documents), row_tokens)
+        self.n_tokens = self.words.size
+
+        if theta is not None and theta.shape[1] != self.n_topics:
+            raise Exception("Cannot warm start %d topics from %d" % (
+                self.n_topics, theta.shape[1]))
+        if theta is None:
+            self.z = self.rng.randint(self.n_topics,
+                                      size=self.n_tokens).astype(np.int32)
+        else:
+            entries = np.repeat(np.arange(values.size), values)
+            self.z = np.empty(self.n_tokens, dtype=np.int32)
+            for start in range(0, self.n_tokens, block_size):
+                e = entries[start:start + block_size]
+                cdf = np.cumsum(theta[rows[e]] * phi[:, counts.indices[e]].T,
+                                axis=1)
+                u = self.rng.random_sample(e.size) * cdf[:, -1]
+                self.z[start:start + block_size] = np.minimum(
+                    (cdf < u[:, None]).sum(axis=1), self.n_topics - 1)
+        self.n_dk = np.zeros((self.m_documents, self.n_topics),
+                             dtype=np.int32)  # (m x k)
+        self.n_wk = np.zeros((self.vocab_size, self.n_topics),
+                             dtype=np.int32)  # (v x k)
+        np.add.at(self.n_dk, (self.docs, self.z), 1)
+        np.add.at(self.n_wk, (self.words, self.z), 1)
+        self.n_k = self.n_wk.sum(axis=0).astype(np.int32)  # (k)
+        self.doc_topics, self.doc_n_topics = sparse_lda.topic_lists(self.n_dk)
+        self.word_topics, self.word_n_topics = \
+            sparse_lda.topic_lists(self.n_wk)
+        self.log_likelihood = []
 
     def compute_conditional_dist(self, m, n):
-        # Return a probability distribution for word n in document m
-        # belonging to a topic
-        vector = [self.M_word_topic[k, m]]
+        """Full conditional distribution over topics of token n of document
+        m, given every other token's topic (dense, for inspection; the
+        sampler draws from it without building it)."""
+        i = self.doc_ptr[m] + n
+        w, t = self.words[i], self.z[i]
+        n_dk = self.n_dk[m].astype(np.float64)
+        n_wk = self.n_wk[w].astype(np.float64)
+        n_k = self.n_k.astype(np.float64)
+        n_dk[t] -= 1
+        n_wk[t] -= 1
+        n_k[t] -= 1
+        p = (self.get_alpha() + n_dk) * (self.beta + n_wk) / (
+            self.beta * self.vocab_size + n_k)
+        return p / p.sum()
 
     def sample_phi_from_dirichlet(self, n=1):
         """Function to sample from a Dirichlet distribution.
@@ -99,12 +199,21 @@ class LDA2:
             A np array of samples from the Dirichlet distribution, of size n.
         """
 
-        return np.random.dirichlet(self.beta, size=n)
+        return np.random.dirichlet(
+            np.broadcast_to(self.beta, (self.vocab_size,)), size=n)
 
     def gibbs_sampler(self, T):
-        for t in T:  # Iterate over timesteps
-            for i in []:
-                pass
+        """Runs T sweeps of the sparse collapsed Gibbs sampler over every
+        token."""
+        if not hasattr(self, "z"):
+            self.init_LDA()
+        alpha = self.get_alpha()
+        for t in range(T):  # Iterate over timesteps
+            sparse_lda.sparse_gibbs_sweep(
+                self.doc_ptr, self.words, self.z, self.n_dk, self.n_wk,
+                self.n_k, self.doc_topics, self.doc_n_topics,
+                self.word_topics, self.word_n_topics, alpha,
+                float(self.beta), self.rng.random_sample(self.n_tokens))
 
     def sample_pi_from_dirichlet(self, n=1):
         """Function to sample from a Dirichlet distribution.
@@ -117,26 +226,259 @@ class LDA2:
             A np array of samples from the Dirichlet distribution, of size n.
         """
 
-        return np.random.dirichlet(self.alpha, size=n)
+        return np.random.dirichlet(self.get_alpha(), size=n)
 
-    def find_params(self):
-        """Function that iterates over the expectation and maximization steps
-        until the parameter estimates converge to their optimal set."""
+    def get_theta(self):
+        """(m_documents x n_topics) document-topic distributions."""
+        theta = self.n_dk + self.get_alpha()
+        return theta / theta.sum(axis=1, keepdims=True)
 
-        old_params = np.zeros(self.parameters.shape)
+    def get_phi(self):
+        """(n_topics x vocab_size) topic-word distributions."""
+        phi = self.n_wk.T + self.beta
+        return phi / phi.sum(axis=1, keepdims=True)
 
-        # Iterate until our parameters converge
-        while np.linalg.norm(old_params - new_params) > self.eps:
-            # Take expectation step
-            self.expectation_step()
+    def token_log_likelihood(self, X=None, theta=None, block_size=1000):
+        """Mean log likelihood per token of count matrix X (the training
+        matrix by default) under theta (the fitted topics, or transform(X)
+        for new documents) and the current topics."""
+        X = self.M if X is None else scipy.sparse.csr_matrix(X)
+        if theta is None:
+            theta = self.get_theta() if X is self.M else self.transform(X)
+        return token_log_likelihood(X, theta, self.get_phi())
 
-            # Take maximization step
-            self.maximization_step()
-
-            old_params = copy.deepcopy(self.parameters)
+    def find_params(self, max_iter=500, check_every=10):
+        """Samples until the per-token log likelihood, checked every
+        check_every sweeps, changes by less than eps (or max_iter sweeps).
 
+        Returns:
+            (theta, phi), the document-topic and topic-word distributions.
+        """
+        self.init_LDA()
+        old_ll = -np.inf
+        for it in range(0, max_iter, check_every):
+            self.gibbs_sampler(check_every)
+            ll = self.token_log_likelihood()
+            self.log_likelihood.append(ll)
+            if abs(ll - old_ll) < self.eps:
+                break
+            old_ll = ll
+        self.components_ = self.n_wk.T + self.beta
+        self.parameters = (self.get_theta(), self.get_phi())
         return self.parameters
 
+    def transform(self, X, max_iter=100, tol=1e-6, block_size=1000):
+        """Topic distributions of the documents in count matrix X under the
+        fitted topics (see transform_documents).
+
+        Returns:
+            A (n_documents x n_topics) array whose rows sum to one.
+        """
+        return transform_documents(X, self.get_phi(), self.get_alpha(),
+                                   max_iter, tol, block_size)
+
+
+def transform_documents(X, phi, alpha, max_iter=100, tol=1e-6,
+                        block_size=1000, theta=None):
+    """Topic distributions of the documents in count matrix X under fixed
+    topics phi (n_topics x vocab_size), by fixed-point iteration of the
+    posterior mean of each document's topic proportions with Dirichlet
+    prior alpha.  Documents are processed in dense blocks of block_size
+    rows.  The iteration starts from theta when given (e.g. the result for
+    slightly different topics), from uniform distributions otherwise.
+
+    Returns:
+        A (n_documents x n_topics) array whose rows sum to one.
+    """
+    X = scipy.sparse.csr_matrix(X, dtype=np.float64)
+    n_topics = phi.shape[0]
+    initial = theta
+    theta = np.empty((X.shape[0], n_topics))
+    for start in range(0, X.shape[0], block_size):
+        counts = X[start:start + block_size].toarray()
+        if initial is None:
+            block = np.full((counts.shape[0], n_topics), 1.0 / n_topics)
+        else:
+            block = initial[start:start + block_size]
+        for _ in range(max_iter):
+            # expected topic counts of each document's words
+            ratio = counts / np.maximum(block @ phi, 1e-300)
+            new_block = block * (ratio @ phi.T) + alpha
+            new_block /= new_block.sum(axis=1, keepdims=True)
+            change = np.max(np.abs(new_block - block))
+            block = new_block
+            if change < tol:
+                break
+        theta[start:start + block_size] = block
+    return theta
+
+
+def token_log_likelihood(X, theta, phi, block_size=1000):
+    """Mean log likelihood per token of count matrix X under document-topic
+    distributions theta (n_documents x n_topics) and topic-word
+    distributions phi (n_topics x vocab_size); exp of its negative is the
+    perplexity."""
+    X = scipy.sparse.csr_matrix(X)
+    total = 0.0
+    for start in range(0, X.shape[0], block_size):
+        block = X[start:start + block_size].tocoo()
+        p = theta[start:start + block_size] @ phi  # (block x vocab)
+        total += np.sum(block.data * np.log(p[block.row, block.col]))
+    return float(total / max(X.sum(), 1))
+
+
+def benchmark_lda(feature_path, n_topics=n_topics, n_iter=200,
+                  test_fraction=0.2, alpha=None, beta=None, random_state=0):
+    """Fits LDA2 (sparse Gibbs) and sklearn's LatentDirichletAllocation on
+    the same feature matrix and compares fit time and held-out perplexity.
+
+    Arguments:
+        feature_path: Feature matrix or its path, as taken by LDA2.
+        n_topics (int): Number of topics of both models.
+        n_iter (int): Gibbs sweeps of LDA2 and EM passes of sklearn.
+        test_fraction (float): Share of the documents held out.
+        alpha, beta: Priors of both models; sklearn's defaults (1 /
+            n_topics) if None.
+        random_state (int): Seed for the split and both models.
+
+    Returns:
+        A dictionary {"lda2": stats, "sklearn": stats}, where stats holds
+        fit_seconds, train_perplexity and test_perplexity.
+    """
+    alpha = 1.0 / n_topics if alpha is None else alpha
+    beta = 1.0 / n_topics if beta is None else beta
+    M = LDA2("", feature_path).M
+    order = np.random.RandomState(random_state).permutation(M.shape[0])
+    n_test = int(round(test_fraction * M.shape[0]))
+    train, test = M[order[n_test:]], M[order[:n_test]]
+
+    results = {}
+    model = LDA2("", train, alpha=alpha, beta=beta, n_topics=n_topics,
+                 random_state=random_state)
+    start = time.time()
+    model.init_LDA()
+    model.gibbs_sampler(n_iter)
+    model.components_ = model.n_wk.T + beta
+    fit_seconds = time.time() - start
+    results["lda2"] = dict(
+        fit_seconds=fit_seconds,
+        train_perplexity=np.exp(-model.token_log_likelihood()),
+        test_perplexity=np.exp(-model.token_log_likelihood(test)))
+
+    sk = LDA(n_components=n_topics, doc_topic_prior=alpha,
+             topic_word_prior=beta, max_iter=n_iter,
+             random_state=random_state)
+    start = time.time()
+    sk.fit(train)
+    fit_seconds = time.time() - start
+    phi = sk.components_ / sk.components_.sum(axis=1, keepdims=True)
+    results["sklearn"] = dict(
+        fit_seconds=fit_seconds,
+        train_perplexity=np.exp(-token_log_likelihood(
+            train, sk.transform(train), phi)),
+        test_perplexity=np.exp(-token_log_likelihood(
+            test, sk.transform(test), phi)))
+
+    print("%d documents, %d words, %d topics, %d iterations (%s sampler)" % (
+        M.shape[0], M.shape[1], n_topics, n_iter,
+        "compiled" if sparse_lda.COMPILED else "pure Python"))
+    for name, stats in results.items():
+        print("%-8s fit %8.2fs  train perplexity %8.2f  test perplexity "
+              "%8.2f" % (name, stats["fit_seconds"],
+                         stats["train_perplexity"],
+                         stats["test_perplexity"]))
+    return results
+
+
+_worker_lda_model = None
+
+
+def _init_lda_worker(lda_model):
+    global _worker_lda_model
+    _worker_lda_model = lda_model
+
+
+def _lda_transform_worker(X):
+    return _worker_lda_model.transform(X)
+
+
+def batch_transform(lda_model, X, chunk_size=None, n_workers=None):
+    """Topic distributions of every row of a feature matrix, transformed in
+    chunks of chunk_size documents instead of one document per call.
+
+    Arguments:
+        lda_model: A fitted model with a transform method (sklearn's
+            LatentDirichletAllocation or a fitted LDA2).
+        X: (n_documents x n_clusters) feature matrix, sparse or dense.
+        chunk_size (int): Documents per transform call,
+            lda_transform_chunk_size if None.
+        n_workers (int): Processes the chunks are spread over, n_lda_workers
+            if None; 1 runs in this process.
+
+    Returns:
+        A (n_documents x n_topics) array.
+    """
+    # read here, so changes to the module hyperparameters apply
+    chunk_size = chunk_size or lda_transform_chunk_size
+    n_workers = n_lda_workers if n_workers is None else n_workers
+    X = scipy.sparse.csr_matrix(X)
+    chunks = [X[start:start + chunk_size]
+              for start in range(0, X.shape[0], chunk_size)]
+    start = time.time()
+    if n_workers is None or n_workers <= 1 or len(chunks) <= 1:
+        predictions = [lda_model.transform(chunk) for chunk in chunks]
+    else:
+        with Pool(min(n_workers, len(chunks)), initializer=_init_lda_worker,
+                  initargs=(lda_model,)) as pool:
+            predictions = pool.map(_lda_transform_worker, chunks)
+    elapsed = time.time() - start
+    print("Transformed %d documents in %.1fs (%.1f documents/sec)" % (
+        X.shape[0], elapsed, X.shape[0] / max(elapsed, 1e-9)))
+    if not predictions:
+        return np.zeros((0, lda_model.components_.shape[0]))
+    return np.vstack(predictions)
+
+
+def group_predictions(image_ids, predictions):
+    """Builds the prediction dictionaries from the topic distributions of
+    a list of images.
+
+    Arguments:
+        image_ids (list): Image ids (file names), one per row.
+        predictions: (n_images x n_topics) topic distributions.
+
+    Returns:
+        (predicted_cluster, cluster_dic, prob_distr_dic): image id to most
+        likely topic, topic to the images it is most likely for (in image
+        order) and image id to its (1 x n_topics) distribution.
+    """
+    predicted = np.argmax(predictions, axis=1)
+    prob_distr_dic = {f: predictions[i:i + 1]
+                      for i, f in enumerate(image_ids)}
+    predicted_cluster = dict(zip(image_ids, predicted))
+    # stable sort keeps the images of each topic in their original order
+    order = np.argsort(predicted, kind="stable")
+    topics, starts = np.unique(predicted[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    cluster_dic = {predicted[group[0]]: [image_ids[i] for i in group]
+                   for group in groups if group.size}
+    return predicted_cluster, cluster_dic, prob_distr_dic
+
+
+def save_predictions(save_root, predicted_cluster, cluster_dic,
+                     prob_distr_dic, n_topics, n_keypoints, n_clusters):
+    """Pickles the dictionaries of group_predictions to save_root, under
+    the names the evaluation code loads them from."""
+    names = {"predicted": predicted_cluster,
+             "clustered_images": cluster_dic,
+             "prob_distrs": prob_distr_dic}
+    for name, dic in names.items():
+        with open(os.path.join(save_root,
+                               "%s_%s_topics_%s_keypoints_%s_clusters.pkl" % (
+                                   name, n_topics, n_keypoints, n_clusters)),
+                  "wb") as f:
+            pickle.dump(dic, f)
+
 
 def compute_num_labels_in_cluster(cluster_predictions, actual_dic):
     """Given the cluster_predictions, that maps id:cluster, actual_dic that
@@ -244,7 +586,8 @@ def evaluate_dataset_cnn():
 
 
 def evaluate_dataset_sift():
-    data_dir = getDirPrefix(num_most_common_labels_used, "sift")
+    data_dir = getDirPrefix(num_most_common_labels_used,
+                            feature_extraction.get_sift_model_name())
     dataset = ADE20K(root=getDataRoot(), transform=None, useStringLabels=True,
                      randomSeed=49)
     mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
@@ -254,10 +597,8 @@ def evaluate_dataset_sift():
                                      "feature_matrix_%s_keypoints_%s_clusters" % (
                                      n_keypoints, n_clusters))
 
-    with open(sift_feature_path, "rb") as f:
-        feature_tup = pickle.load(f)
-
-    hist_list, index_mask = feature_tup
+    hist_list, index_mask = feature_extraction.load_feature_matrix(
+        sift_feature_path)
     dataset.applyMask(index_mask)
 
     actual_dic = {}
@@ -457,13 +798,9 @@ def main():
                         "/sift_feature_matrix_%s_keypoints_%s_clusters" % (
     n_keypoints, n_clusters)
     M, kmeans = feature_extraction.create_feature_matrix(dataset_path)
-    with open(sift_feature_path, "wb") as f:
-        print(sift_feature_path)
-        pickle.dump(M, f)
+    print(sift_feature_path)
+    feature_extraction.save_feature_matrix(sift_feature_path, M)
     print("dumped feature matrix")
-
-    with open(sift_feature_path, "rb") as f:
-        M = pickle.load(f)
     # CnnM = feature_extraction.create_feature_matrix_cnn(dataset_path)
     # feature_path = "/home/yaatehr/programs/spatial_LDA/data/features1.pkl"
     # feature_path = "/home/yaatehr/programs/spatial_LDA/data
@@ -474,23 +811,17 @@ def main():
     lda_model = lda.off_the_shelf_LDA()  # Fit the sklearn LDA model
     predicted = {}
     img_files = os.listdir(dataset_path)
-    descriptor_path = "/home/yaatehr/programs/spatial_LDA/data" \
-                      "/image_descriptors_dictionary_%s_keypoints.pkl" % \
-                      n_keypoints
-    # with open ("/home/yaatehr/programs/spatial_LDA/data
-    # /img_descriptors_dic1.pkl", "rb") as f:
-    with open(descriptor_path, "rb") as f:
-        descriptor_dic = pickle.load(f)
-    predicted_cluster = {}  # dictionary of imgid: cluster
-    cluster_dic = {}  # ictionary of cluster: [images in cluster]
-    prob_distr_dic = {}  # maps id: probability distribution over clusters
+    descriptor_dic = feature_extraction.load_descriptor_store(
+        "/home/yaatehr/programs/spatial_LDA/data", n_keypoints)
     kmeans_path = "/home/yaatehr/programs/spatial_LDA/data/kmeans_" \
                   "%s_clusters_%s_keypoints.pkl" % (
     n_clusters, n_keypoints)
 
     with open(kmeans_path, "rb") as f:
         kmeans = pickle.load(f)
-    num_files = 0
+    image_ids = []
+    store_ids = []
+    expected_count = feature_extraction.get_expected_descriptor_count()
     for l in img_files:
         label_path = os.path.join(dataset_path, l)  # a/
         labels = os.listdir(label_path)  # a/amusement_park
@@ -501,24 +832,21 @@ def main():
             for f in images:
                 if f[-3:] != 'jpg':
                     continue
-                if num_files % 100 == 0:
-                    print(num_files)
-                des = descriptor_dic[f]
-                if des is None or des.shape[
-                    0] != n_keypoints:  # only use images with n_keypoints
-                    continue
-                feature = feature_extraction.build_histogram(des, kmeans,
-                                                             n_clusters)
-                predictions = lda_model.transform(
-                    np.reshape(feature, (1, feature.size)))
-                prob_distr_dic[f] = predictions
-                predicted_class = np.argmax(predictions, axis=1)[0]
-                predicted_cluster[f] = predicted_class
-                if predicted_class in cluster_dic:
-                    cluster_dic[predicted_class].append(f)
-                else:
-                    cluster_dic[predicted_class] = [f]
-                num_files += 1
+                if len(image_ids) % 100 == 0:
+                    print(len(image_ids))
+                i = descriptor_dic.get_id(f)
+                if i is None:
+                    continue  # never extracted into the descriptor store
+                if descriptor_dic.counts[i] != expected_count:
+                    continue  # only use images with a full descriptor set
+                image_ids.append(f)
+                store_ids.append(i)
+    # every image's histogram in one batched pass over the store
+    features = feature_extraction.build_histograms(descriptor_dic, kmeans,
+                                                   n_clusters, ids=store_ids)
+    predictions = batch_transform(lda_model, features)
+    predicted_cluster, cluster_dic, prob_distr_dic = group_predictions(
+        image_ids, predictions)
     with open(
             "/home/yaatehr/programs/spatial_LDA/data/predicted_%s_topics_"
             "%s_keypoints_%s_clusters.pkl" % (
@@ -542,88 +870,38 @@ def build_cnn_predictions():
     over.
     Hopefully this will be useful if we need to change the dataset
     parameters."""
-    cnn_root = getDirPrefix(num_most_common_labels_used, feature_model,
+    cnn_root = getDirPrefix(num_most_common_labels_used,
+                            feature_extraction.get_cnn_model_name(),
                             cnn_num_layers_removed=cnn_num_layers_removed,
                             makedirs=True)
     cnn_feature_path = os.path.join(cnn_root,
                                     "feature_matrix_%s_keypoints_%s_clusters"
                                     % (
                                     n_keypoints, n_clusters))
-    if not os.path.exists(cnn_feature_path):
+    if not feature_extraction.feature_matrix_exists(cnn_feature_path):
         hist_list, kmeans = feature_extraction.create_feature_matrix_cnn()
-        with open(cnn_feature_path, "wb") as f:
-            print(cnn_feature_path)
-            pickle.dump(hist_list, f)
+        print(cnn_feature_path)
+        feature_extraction.save_feature_matrix(cnn_feature_path, hist_list)
         print("dumped feature matrix")
 
-    with open(cnn_feature_path, "rb") as f:
-        hist_list = pickle.load(f)
+    hist_list = feature_extraction.load_feature_matrix(cnn_feature_path)
+    if isinstance(hist_list, list):  # older matrices were pickled as rows
+        hist_list = scipy.sparse.vstack(
+            [scipy.sparse.csr_matrix(h) for h in hist_list])
+    hist_list = scipy.sparse.csr_matrix(hist_list)
 
-    lda = LDA2("", cnn_feature_path, n_topics=n_topics)  # Make the class
+    lda = LDA2("", hist_list, n_topics=n_topics)  # Make the class
     lda_model = lda.off_the_shelf_LDA()  # Fit the sklearn LDA model
-    predicted = {}
-    descriptor_path = os.path.join(cnn_root, \
-                                   "image_descriptors_dictionary_%s_keypoints.pkl" % \
-                                   n_keypoints)
-    with open(descriptor_path, "rb") as f:
-        descriptor_dic = pickle.load(f)
-    predicted_cluster = {}  # dictionary of imgid: cluster
-    cluster_dic = {}  # ictionary of cluster: [images in cluster]
-    prob_distr_dic = {}  # maps id: probability distribution over clusters
-
-    kmeans_path = os.path.join(cnn_root,
-                               "kmeans_%s_clusters_%s_keypoints.pkl" % (
-                               n_clusters, n_keypoints))
-    if not os.path.exists(kmeans_path):
-        kmeans_path = os.path.join(cnn_root,
-                                   "batch_kmeans_%s_clusters_%s_keypoints.pkl" % (
-                                   n_clusters, n_keypoints))
 
-    with open(kmeans_path, "rb") as f:
-        kmeans = pickle.load(f)
-    transform = get_model_transform(feature_model)
-    dataset = ADE20K(root=getDataRoot(), transform=transform,
-                     useStringLabels=True, randomSeed=49)
-    mostCommonLabels = list(map(lambda x: x[0], dataset.counter.most_common(
-        num_most_common_labels_used)))
-    dataset.selectSubset(mostCommonLabels, normalizeWeights=True)
-    batch_size = 50
-    loader = get_single_loader(dataset=dataset, batch_size=batch_size)
-    assert len(hist_list) == len(dataset)
-
-    num_files = 0
-    for i in range(len(hist_list)):
-        if num_files % 100 == 0:
-            print(num_files)
-
-        f = dataset.image_paths[i]
-        feature = hist_list[i]
-        predictions = lda_model.transform(
-            np.reshape(feature, (1, feature.size)))
-        prob_distr_dic[f] = predictions
-        predicted_class = np.argmax(predictions, axis=1)[0]
-        predicted_cluster[f] = predicted_class
-        if predicted_class in cluster_dic:
-            cluster_dic[predicted_class].append(f)
-        else:
-            cluster_dic[predicted_class] = [f]
-        num_files += 1
-    with open(os.path.join(cnn_root,
-                           "predicted_%s_topics_%s_keypoints_%s_clusters.pkl"
-                           % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(predicted_cluster, f)
-    with open(os.path.join(cnn_root,
-                           "clustered_images_%s_topics_%s_keypoints_"
-                           "%s_clusters.pkl" % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(cluster_dic, f)
-    with open(os.path.join(cnn_root,
-                           "prob_distrs_%s_topics_%s_keypoints_%s_clusters"
-                           ".pkl" % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(prob_distr_dic, f)
-        # Now we can predict!
+    # the rows follow the images of the dataset the features came from
+    dataset = feature_extraction.get_cnn_dataset()
+    assert hist_list.shape[0] == len(dataset)
+
+    predictions = batch_transform(lda_model, hist_list)
+    predicted_cluster, cluster_dic, prob_distr_dic = group_predictions(
+        dataset.image_paths, predictions)
+    save_predictions(cnn_root, predicted_cluster, cluster_dic, prob_distr_dic,
+                     n_topics, n_keypoints, n_clusters)
 
 
 def build_sift_predictions():
@@ -631,34 +909,27 @@ def build_sift_predictions():
     over.
     Hopefully this will be useful if we need to change the dataset
     parameters."""
-    save_root = getDirPrefix(num_most_common_labels_used, "sift", makedirs=True)
+    save_root = getDirPrefix(num_most_common_labels_used,
+                             feature_extraction.get_sift_model_name(),
+                             makedirs=True)
     sift_feature_path = os.path.join(save_root,
                                      "feature_matrix_%s_keypoints_%s_clusters" % (
                                      n_keypoints, n_clusters))
 
-    if not os.path.exists(sift_feature_path):
-        feature_tup, kmeans = feature_extraction.create_feature_matrix_sift()
-        with open(sift_feature_path, "wb") as f:
-            print(sift_feature_path)
-            pickle.dump(feature_tup, f)
+    if not feature_extraction.feature_matrix_exists(sift_feature_path):
+        (hist_list, index_mask), kmeans = \
+            feature_extraction.create_feature_matrix_sift()
+        print(sift_feature_path)
+        feature_extraction.save_feature_matrix(sift_feature_path, hist_list,
+                                               index_mask)
         print("dumped feature matrix")
 
-    with open(sift_feature_path, "rb") as f:
-        feature_tup = pickle.load(f)
-
-    hist_list, index_mask = feature_tup
+    hist_list, index_mask = feature_extraction.load_feature_matrix(
+        sift_feature_path)
 
     lda = LDA2("", hist_list, n_topics=n_topics)  # Make the class
     lda_model = lda.off_the_shelf_LDA()  # Fit the sklearn LDA model
     predicted = {}
-    descriptor_path = os.path.join(save_root,
-                                   "image_descriptors_dictionary_%s_keypoints.pkl" % \
-                                   n_keypoints)
-    with open(descriptor_path, "rb") as f:
-        descriptor_dic = pickle.load(f)
-    predicted_cluster = {}  # dictionary of imgid: cluster
-    cluster_dic = {}  # ictionary of cluster: [images in cluster]
-    prob_distr_dic = {}  # maps id: probability distribution over clusters
 
     kmeans_path = os.path.join(save_root,
                                "kmeans_%s_clusters_%s_keypoints.pkl" % (
@@ -676,38 +947,13 @@ def build_sift_predictions():
 
     assert sum(index_mask) == len(
         dataset), "index_mask len %d and dataset len %d with hist_list  %d" % (
-    sum(index_mask), len(dataset), len(hist_list))
-
-    num_files = 0
-    for i in range(len(dataset)):
-        if num_files % 100 == 0:
-            print(num_files)
-
-        f = dataset.image_paths[i]
-        feature = hist_list[i]
-        predictions = lda_model.transform(
-            np.reshape(feature, (1, feature.size)))
-        prob_distr_dic[f] = predictions
-        predicted_class = np.argmax(predictions, axis=1)[0]
-        predicted_cluster[f] = predicted_class
-        if predicted_class in cluster_dic:
-            cluster_dic[predicted_class].append(f)
-        else:
-            cluster_dic[predicted_class] = [f]
-        num_files += 1
-    with open(os.path.join(save_root,
-                           "predicted_%s_topics_%s_keypoints_%s_clusters.pkl" % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(predicted_cluster, f)
-    with open(os.path.join(save_root,
-                           "clustered_images_%s_topics_%s_keypoints_%s_clusters.pkl" % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(cluster_dic, f)
-    with open(os.path.join(save_root,
-                           "prob_distrs_%s_topics_%s_keypoints_%s_clusters.pkl" % (
-                           n_topics, n_keypoints, n_clusters)), "wb") as f:
-        pickle.dump(prob_distr_dic, f)
-        # Now we can predict!
+    sum(index_mask), len(dataset), hist_list.shape[0])
+
+    predictions = batch_transform(lda_model, hist_list[:len(dataset)])
+    predicted_cluster, cluster_dic, prob_distr_dic = group_predictions(
+        dataset.image_paths[:len(dataset)], predictions)
+    save_predictions(save_root, predicted_cluster, cluster_dic,
+                     prob_distr_dic, n_topics, n_keypoints, n_clusters)
 
 
 def ryan_test():
@@ -0,0 +1,175 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse
+from sklearn.decomposition import LatentDirichletAllocation
+import lda
+import online_lda
+import topic_sweep
+from lda import LDA2, batch_transform, group_predictions
+
+
+class BatchPredictionsTestCase(unittest.TestCase):
+    def test_matches_per_image_loop(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.csr_matrix(rng.poisson(0.5, size=(60, 20)))
+        model = LatentDirichletAllocation(n_components=4, max_iter=5,
+                                          random_state=0).fit(X)
+        ids = ["img%d.jpg" % i for i in range(X.shape[0])]
+        predicted_cluster, cluster_dic, prob_distr_dic = {}, {}, {}
+        for i, f in enumerate(ids):
+            predictions = model.transform(X[i:i + 1])
+            prob_distr_dic[f] = predictions
+            predicted_cluster[f] = np.argmax(predictions, axis=1)[0]
+            cluster_dic.setdefault(predicted_cluster[f], []).append(f)
+
+        batched = group_predictions(
+            ids, batch_transform(model, X, chunk_size=25))
+        self.assertEqual(batched[0], predicted_cluster)
+        self.assertEqual(batched[1], cluster_dic)
+        for f in ids:
+            np.testing.assert_allclose(batched[2][f], prob_distr_dic[f])
+
+
+class BatchTransformDefaultsTestCase(unittest.TestCase):
+    def test_hyperparameters_read_at_call_time(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.csr_matrix(rng.poisson(0.5, size=(10, 6)))
+        model = LatentDirichletAllocation(n_components=2, max_iter=2,
+                                          random_state=0).fit(X)
+        sizes = []
+        transform = model.transform
+        model.transform = lambda chunk: sizes.append(chunk.shape[0]) or \
+            transform(chunk)
+        chunk_size = lda.lda_transform_chunk_size
+        lda.lda_transform_chunk_size = 4
+        try:
+            batch_transform(model, X)
+        finally:
+            lda.lda_transform_chunk_size = chunk_size
+        self.assertEqual(sizes, [4, 4, 2])
+
+
+class LDA2TestCase(unittest.TestCase):
+    def test_empty_documents(self):
+        # empty documents in the middle and at the end
+        M = scipy.sparse.csr_matrix([[1, 2, 0], [0, 0, 0], [0, 0, 3],
+                                     [0, 0, 0]])
+        model = LDA2("", M, n_topics=2, random_state=0)
+        model.init_LDA()
+        np.testing.assert_array_equal(model.doc_ptr, [0, 3, 3, 6, 6])
+        np.testing.assert_array_equal(model.n_dk.sum(axis=1), [3, 0, 3, 0])
+        model.gibbs_sampler(2)
+        np.testing.assert_array_equal(model.n_dk.sum(axis=1), [3, 0, 3, 0])
+        # warm started from given topics
+        model.init_LDA(np.full((4, 2), 0.5), np.full((2, 3), 1 / 3.))
+        np.testing.assert_array_equal(model.n_dk.sum(axis=1), [3, 0, 3, 0])
+
+
+class OnlineLDATestCase(unittest.TestCase):
+    def test_resume_and_extend(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.csr_matrix(rng.poisson(0.5, size=(90, 20)))
+        with tempfile.TemporaryDirectory() as root:
+            shard_root = os.path.join(root, "shards")
+            checkpoint = os.path.join(root, "online_lda.pkl")
+            online_lda.append_feature_shards(shard_root, X[:60],
+                                             shard_size=20)
+            # interrupt the run in its second shard
+            load = online_lda.load_feature_shard
+            calls = []
+
+            def interrupted(*args):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise KeyboardInterrupt
+                return load(*args)
+
+            online_lda.load_feature_shard = interrupted
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    online_lda.train_online_lda(shard_root, n_topics=3,
+                                                checkpoint_path=checkpoint,
+                                                random_state=0)
+            finally:
+                online_lda.load_feature_shard = load
+            resumed = online_lda.OnlineLDA.load(checkpoint)
+            self.assertEqual(len(resumed.trained_shards), 1)
+            self.assertEqual(len(resumed.schedule), 2)
+
+            online_lda.append_feature_shards(shard_root, X[60:],
+                                             shard_size=20)
+            model = online_lda.train_online_lda(
+                shard_root, n_topics=3, checkpoint_path=checkpoint)
+            # each shard trained exactly once, the new ones included
+            self.assertEqual(len(model.trained_shards), 5)
+            self.assertEqual(model.n_documents_seen, X.shape[0])
+            self.assertEqual(batch_transform(model, X).shape, (90, 3))
+
+    def test_lda2_appends_new_rows(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.csr_matrix(rng.poisson(0.5, size=(90, 20)))
+        with tempfile.TemporaryDirectory() as root:
+            shard_root = os.path.join(root, "shards")
+            checkpoint = os.path.join(root, "online_lda.pkl")
+            LDA2("", X[:60], n_topics=3, random_state=0).online_LDA(
+                shard_root, checkpoint)
+            model = LDA2("", X, n_topics=3).online_LDA(shard_root, checkpoint)
+            manifest = online_lda.load_manifest(shard_root)
+            self.assertEqual(sum(s["rows"] for s in manifest["shards"]), 90)
+            self.assertEqual(model.n_documents_seen, X.shape[0])
+            # nothing new: no shards are written, nothing is trained
+            LDA2("", X, n_topics=3).online_LDA(shard_root, checkpoint)
+            self.assertEqual(online_lda.load_manifest(shard_root), manifest)
+
+
+class TopicSweepTestCase(unittest.TestCase):
+    def test_split_topics(self):
+        rng = np.random.RandomState(0)
+        theta = rng.dirichlet(np.ones(3), size=10)
+        phi = rng.dirichlet(np.ones(8), size=3)
+        split_theta, split_phi = topic_sweep.split_topics(theta, phi, 5)
+        self.assertEqual(split_theta.shape, (10, 5))
+        self.assertEqual(split_phi.shape, (5, 8))
+        np.testing.assert_allclose(split_theta.sum(axis=1), 1)
+        np.testing.assert_allclose(split_phi.sum(axis=1), 1)
+        # nothing to split: the inputs come back as they are
+        same_theta, same_phi = topic_sweep.split_topics(theta, phi, 3)
+        self.assertIs(same_theta, theta)
+        self.assertIs(same_phi, phi)
+
+    def test_empty_documents(self):
+        rng = np.random.RandomState(0)
+        X = rng.poisson(1, size=(30, 12))
+        X[1::3] = 0  # empty documents throughout
+        X[-1] = 0  # and at the end
+        X = scipy.sparse.csr_matrix(X)
+        phi = topic_sweep.fit_seed_model(X, 2, sample_fraction=1., n_iter=2,
+                                         random_state=0)
+        self.assertEqual(phi.shape, (2, 12))
+        with tempfile.TemporaryDirectory() as root:
+            results = topic_sweep.sweep_topics(X, [2, 3], root, n_workers=1,
+                                               max_iter=4, check_every=2)
+        self.assertEqual([r["n_topics"] for r in results], [2, 3])
+
+    def test_split_document_tokens(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.csr_matrix(rng.poisson(2, size=(20, 10)))
+        observed, scored = topic_sweep.split_document_tokens(X, 0)
+        np.testing.assert_array_equal((observed + scored).toarray(),
+                                      X.toarray())
+        self.assertGreater(observed.sum(), 0)
+        self.assertGreater(scored.sum(), 0)
+
+    def test_shared_feature_matrix(self):
+        X = scipy.sparse.random(30, 12, density=0.3, format="csr",
+                                random_state=0)
+        with tempfile.TemporaryDirectory() as root:
+            topic_sweep.share_feature_matrix(X, root)
+            shared = topic_sweep.load_shared_feature_matrix(root)
+            np.testing.assert_array_equal(shared.toarray(), X.toarray())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -183,6 +183,63 @@ class ResNetWithDropout(ResNet):
         return output
 
 
+class StudentResNet(nn.Module):
+    """
+    small resnet trained to regress the feature maps of a larger (teacher)
+    network, see train_cnn.distillStudent; its output has the teacher's
+    shape, out_channels x out_size
+    """
+
+    def __init__(self, out_channels, out_size, widths=(32, 64, 128),
+                 layers=(1, 1, 1), block=BasicBlock):
+        super(StudentResNet, self).__init__()
+
+        self.in_planes = widths[0]
+
+        self.Conv1 = nn.Conv2d(3, self.in_planes, kernel_size=7, stride=2,
+                               padding=3, bias=False)
+        self.BN1 = nn.BatchNorm2d(self.in_planes)
+        self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
+
+        stages = []
+        for i, (width, blocks) in enumerate(zip(widths, layers)):
+            stages.append(self._make_layer(block, width, blocks,
+                                           stride=1 if i == 0 else 2))
+        self.stages = nn.Sequential(*stages)
+
+        # 1x1 projection to the teacher's channels, pooled to its map size
+        self.head = nn.Conv2d(self.in_planes, out_channels, kernel_size=1)
+        self.pool = nn.AdaptiveAvgPool2d(tuple(out_size))
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+                m.weight.data.normal_(0, math.sqrt(2. / n))
+            elif isinstance(m, nn.BatchNorm2d):
+                m.weight.data.fill_(1)
+                m.bias.data.zero_()
+
+    def _make_layer(self, block, out_planes, blocks, stride=1):
+        layers = []
+        layers.append(block(self.in_planes, out_planes, stride))
+        self.in_planes = out_planes * block.expansion
+        for i in range(1, blocks):
+            layers.append(block(self.in_planes, out_planes))
+        return nn.Sequential(*layers)
+
+    def forward(self, x):
+        output = self.Conv1(x)
+        output = F.relu(self.BN1(output))
+        output = self.maxpool(output)
+
+        output = self.stages(output)
+
+        output = self.head(output)
+        output = self.pool(output)
+
+        return output
+
+
 def resnet_18():
     model = ResNet(BasicBlock, [2, 2, 2, 2])
     return model
@@ -332,6 +332,24 @@ class SegNet(nn.Module):
 
         return x_00d, x_softmax
 
+    def get_feature(self, input_img):
+        """
+        Encoder output (the bottleneck of the network), used as features
+        """
+        x = input_img
+        stages = [
+            (self.encoder_conv_00, self.encoder_conv_01),
+            (self.encoder_conv_10, self.encoder_conv_11),
+            (self.encoder_conv_20, self.encoder_conv_21, self.encoder_conv_22),
+            (self.encoder_conv_30, self.encoder_conv_31, self.encoder_conv_32),
+            (self.encoder_conv_40, self.encoder_conv_41, self.encoder_conv_42)
+        ]
+        for stage in stages:
+            for conv in stage:
+                x = F.relu(conv(x))
+            x = F.max_pool2d(x, kernel_size=2, stride=2)
+        return x
+
     def init_vgg_weigts(self):
         assert self.encoder_conv_00[0].weight.size() == self.vgg16.features[
             0].weight.size()
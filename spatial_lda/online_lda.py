@@ -0,0 +1,208 @@
+"""Online LDA training over feature matrices streamed from disk.
+
+A batch fit holds the whole feature matrix in memory and has to start over
+when images are added.  Here the feature matrix is split into shards of a
+few thousand rows, each a sparse .npz file, listed in order in a manifest:
+
+    manifest.json       number of words and the shards (file name, rows)
+    shard_00000.npz     rows of the first shard, and so on
+
+OnlineLDA streams the shards through sklearn's online variational Bayes
+(LatentDirichletAllocation.partial_fit), one mini-batch at a time, and
+checkpoints the model after every shard.  An interrupted run resumes at the
+shard it stopped in, and images appended as new shards later are trained
+into the existing model without revisiting the old ones.
+"""
+
+import os
+import json
+import pickle
+
+import numpy as np
+import scipy.sparse
+from sklearn.decomposition import LatentDirichletAllocation as LDA
+
+MANIFEST_FILE = "manifest.json"
+
+# Hyperparameters
+feature_shard_size = 5000  # feature matrix rows per shard
+lda_learning_decay = 0.7  # kappa in (0.5, 1], how fast old batches fade
+lda_learning_offset = 10.  # tau_0 > 0, downweights the first updates
+lda_batch_size = 128  # documents per online update
+lda_n_passes = 1  # passes over the shards per fit
+
+
+def load_manifest(shard_root):
+    path = os.path.join(shard_root, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _save_manifest(shard_root, manifest):
+    # write then rename, so a crash never leaves a half written manifest
+    path = os.path.join(shard_root, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def append_feature_shards(shard_root, M, shard_size=feature_shard_size):
+    """Appends the rows of feature matrix M to the shards at shard_root
+    (created if missing), shard_size rows per new shard.
+
+    Returns:
+        The names of the new shards.
+    """
+    M = scipy.sparse.csr_matrix(M)
+    os.makedirs(shard_root, exist_ok=True)
+    manifest = load_manifest(shard_root) or {"n_words": M.shape[1],
+                                             "shards": []}
+    if manifest["n_words"] != M.shape[1]:
+        raise Exception("Shards at %s have %d words, the new rows %d" % (
+            shard_root, manifest["n_words"], M.shape[1]))
+    names = []
+    for start in range(0, M.shape[0], shard_size):
+        name = "shard_%05d.npz" % len(manifest["shards"])
+        rows = M[start:start + shard_size]
+        scipy.sparse.save_npz(os.path.join(shard_root, name), rows)
+        manifest["shards"].append({"name": name, "rows": rows.shape[0]})
+        _save_manifest(shard_root, manifest)
+        names.append(name)
+    return names
+
+
+def load_feature_shard(shard_root, name):
+    return scipy.sparse.load_npz(os.path.join(shard_root, name)).tocsr()
+
+
+def iter_feature_shards(shard_root, names=None):
+    """Yields (name, rows) for the given shards, all of them in manifest
+    order by default."""
+    if names is None:
+        names = [shard["name"]
+                 for shard in load_manifest(shard_root)["shards"]]
+    for name in names:
+        yield name, load_feature_shard(shard_root, name)
+
+
+class OnlineLDA:
+    """LDA trained online over feature matrix shards, with checkpoints.
+
+    Arguments:
+        n_topics (int): Number of topics.
+        learning_decay (float): Exponent kappa of the learning rate
+            (tau_0 + n_updates) ** -kappa.
+        learning_offset (float): tau_0 of the learning rate.
+        batch_size (int): Documents per partial_fit update.
+        checkpoint_path (str): The model is pickled here after every shard;
+            None disables checkpoints.
+        random_state (int): Seed for the model and the shard order.
+    """
+
+    def __init__(self, n_topics=10, learning_decay=lda_learning_decay,
+                 learning_offset=lda_learning_offset,
+                 batch_size=lda_batch_size, checkpoint_path=None,
+                 random_state=None):
+        self.model = LDA(n_components=n_topics, learning_method="online",
+                         learning_decay=learning_decay,
+                         learning_offset=learning_offset,
+                         batch_size=batch_size, random_state=random_state)
+        self.n_topics = n_topics
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.rng = np.random.RandomState(random_state)
+        self.trained_shards = []  # shards trained on at least once
+        self.schedule = []  # (pass, shard) still to train on
+        self.n_documents_seen = 0
+
+    @staticmethod
+    def load(checkpoint_path):
+        with open(checkpoint_path, "rb") as f:
+            online = pickle.load(f)
+        online.checkpoint_path = checkpoint_path
+        return online
+
+    def save(self, path=None):
+        path = path or self.checkpoint_path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f)
+        os.replace(path + ".tmp", path)
+
+    def fit_shards(self, shard_root, n_passes=lda_n_passes, new_only=False):
+        """Trains on the shards at shard_root, n_passes times each in a
+        random order per pass.  A schedule left unfinished by an interrupted
+        run (e.g. in a model loaded from its checkpoint) is finished first,
+        instead of starting a new one.
+
+        Arguments:
+            shard_root (str): Directory written by append_feature_shards.
+            n_passes (int): Passes over the shards.
+            new_only (bool): Only train on shards the model has not seen,
+                to extend a trained model with newly appended images.
+        """
+        manifest = load_manifest(shard_root)
+        if manifest is None:
+            raise Exception("No feature shards at %s" % shard_root)
+        if self.schedule:
+            print("resuming: %d shard updates left" % len(self.schedule))
+        else:
+            names = [shard["name"] for shard in manifest["shards"]]
+            if new_only:
+                names = [n for n in names if n not in self.trained_shards]
+            self.schedule = [(p, names[i]) for p in range(n_passes)
+                             for i in self.rng.permutation(len(names))]
+        # the online updates scale each mini-batch to the corpus size
+        self.model.total_samples = sum(s["rows"] for s in manifest["shards"])
+        while self.schedule:
+            p, name = self.schedule[0]
+            X = load_feature_shard(shard_root, name)
+            for start in range(0, X.shape[0], self.batch_size):
+                self.model.partial_fit(X[start:start + self.batch_size])
+            self.schedule.pop(0)
+            if name not in self.trained_shards:
+                self.trained_shards.append(name)
+            self.n_documents_seen += X.shape[0]
+            print("pass %d, %s: %d documents seen" % (
+                p, name, self.n_documents_seen))
+            if self.checkpoint_path is not None:
+                self.save()
+        return self
+
+    @property
+    def components_(self):
+        return self.model.components_
+
+    def transform(self, X):
+        return self.model.transform(X)
+
+    def perplexity(self, shard_root, names=None):
+        """Perplexity of the model on the given shards (all by default),
+        computed one shard at a time."""
+        log_likelihood, n_tokens = 0.0, 0
+        for _, X in iter_feature_shards(shard_root, names):
+            # score is a bound on the log likelihood of the shard
+            log_likelihood += self.model.score(X)
+            n_tokens += X.sum()
+        return float(np.exp(-log_likelihood / max(n_tokens, 1)))
+
+
+def train_online_lda(shard_root, n_topics=10, checkpoint_path=None,
+                     n_passes=lda_n_passes, random_state=None, **kwargs):
+    """Trains an OnlineLDA on the shards at shard_root, picking up from
+    checkpoint_path when it exists: an interrupted run is finished and
+    shards appended since the checkpoint are trained in; otherwise a new
+    model is fit.  Extra keyword arguments go to OnlineLDA."""
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        online = OnlineLDA.load(checkpoint_path)
+        if online.n_topics != n_topics:
+            raise Exception("Checkpoint %s has %d topics, not %d" % (
+                checkpoint_path, online.n_topics, n_topics))
+        if online.schedule:  # finish the interrupted run first
+            online.fit_shards(shard_root, n_passes)
+        return online.fit_shards(shard_root, n_passes, new_only=True)
+    online = OnlineLDA(n_topics=n_topics, checkpoint_path=checkpoint_path,
+                       random_state=random_state, **kwargs)
+    return online.fit_shards(shard_root, n_passes)
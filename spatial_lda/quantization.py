@@ -0,0 +1,88 @@
+"""Int8 quantization of truncated feature backbones for CPU inference.
+
+Two modes are supported:
+    "dynamic"  Linear layers get int8 weights and activations are quantized
+               on the fly (torch.ao.quantization.quantize_dynamic).  Needs
+               no data, but leaves convolutions in float32, so it is
+               rejected for models without Linear layers (most truncated
+               backbones), where it would change nothing.
+    "static"   Post-training static quantization of the whole graph (convs
+               included) with FX graph mode: observers are inserted, a few
+               calibration batches are run to fix the activation ranges and
+               the model is converted to int8 kernels.
+
+Models FX cannot trace (e.g. backbones truncated with a forward hook)
+cannot be statically quantized; quantize_backbone raises for them rather
+than falling back to another mode, since the features are cached and
+stored under the mode that was asked for.
+"""
+
+import copy
+import warnings
+
+import torch
+
+QUANTIZATION_MODES = ("dynamic", "static")
+
+
+def get_quantized_engine():
+    """Best available int8 CPU backend."""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise Exception("No quantized CPU backend available")
+
+
+def quantize_dynamic(model):
+    """Returns a copy of model with int8 dynamically quantized Linear
+    layers."""
+    if not any(isinstance(m, torch.nn.Linear) for m in model.modules()):
+        raise Exception("Dynamic quantization only quantizes Linear layers "
+                        "and the model has none, use static quantization")
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batches):
+    """Returns a statically quantized copy of model.
+
+    Arguments:
+        model: A torch.nn.Module traceable by torch.fx.
+        calibration_batches: Iterable of input batches used to observe
+            activation ranges; a few hundred images are usually enough.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = get_quantized_engine()
+    torch.backends.quantized.engine = engine
+    calibration_batches = iter(calibration_batches)
+    first = next(calibration_batches)
+    prepared = prepare_fx(copy.deepcopy(model).eval(),
+                          get_default_qconfig_mapping(engine), (first,))
+    with torch.no_grad():
+        prepared(first)
+        for batch in calibration_batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def quantize_backbone(model, mode, calibration_batches=None):
+    """Quantizes a truncated backbone in the given mode (see
+    QUANTIZATION_MODES); mode None returns the model unchanged."""
+    if mode is None:
+        return model
+    if mode not in QUANTIZATION_MODES:
+        raise Exception("Unknown quantization mode %s" % mode)
+    if mode == "static":
+        if calibration_batches is None:
+            raise Exception("Static quantization needs calibration batches")
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                return quantize_static(model, calibration_batches)
+        except Exception as e:
+            raise Exception("Static quantization failed (%s); the model "
+                            "cannot be traced by torch.fx" % e)
+    return quantize_dynamic(model)
+
@@ -0,0 +1,49 @@
+import unittest
+import torch
+from quantization import quantize_backbone
+
+
+def relative_error(reference, other):
+    return float((reference - other).norm() / reference.norm())
+
+
+class QuantizationTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.images = torch.rand(8, 3, 16, 16)
+
+    def test_static(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(8, 4, 3),
+                                    torch.nn.ReLU()).eval()
+        quantized = quantize_backbone(model, "static",
+                                      [self.images[:4], self.images[4:]])
+        with torch.no_grad():
+            reference, outputs = model(self.images), quantized(self.images)
+        self.assertEqual(outputs.shape, reference.shape)
+        self.assertEqual(outputs.dtype, torch.float32)
+        self.assertLess(relative_error(reference, outputs), 0.1)
+
+    def test_dynamic(self):
+        model = torch.nn.Sequential(torch.nn.Flatten(),
+                                    torch.nn.Linear(3 * 16 * 16, 32),
+                                    torch.nn.ReLU()).eval()
+        quantized = quantize_backbone(model, "dynamic")
+        with torch.no_grad():
+            reference, outputs = model(self.images), quantized(self.images)
+        self.assertEqual(outputs.shape, reference.shape)
+        self.assertLess(relative_error(reference, outputs), 0.1)
+
+    def test_rejected_modes(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3)).eval()
+        self.assertIs(quantize_backbone(model, None), model)
+        with self.assertRaises(Exception):
+            quantize_backbone(model, "int4")
+        with self.assertRaises(Exception):  # no calibration batches
+            quantize_backbone(model, "static")
+        with self.assertRaises(Exception):  # no Linear layer to quantize
+            quantize_backbone(model, "dynamic")
+
+
+if __name__ == '__main__':
+    unittest.main()
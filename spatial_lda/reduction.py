@@ -0,0 +1,155 @@
+"""Dimensionality reduction of descriptors before codebook training.
+
+CNN descriptors are long (one value per spatial position of a feature map),
+and both MiniBatchKMeans training and every codebook assignment cost time
+proportional to their dimension.  A DescriptorReducer is fit on a sample of
+a DescriptorStore, with IncrementalPCA or a sparse random projection, and
+then rewrites the store chunk by chunk in n_components dimensions.  That
+rewrite is a second pass over the finished store, not part of extraction:
+the projection is only known once a sample of every image's descriptors
+has been seen.  The
+codebook is trained and applied in the reduced space; ReducedCodebook keeps
+the projection and the k-means model together, so code that predicts words
+for raw descriptors keeps working unchanged.
+"""
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+from tqdm import tqdm
+
+from codebook import reservoir_sample
+from descriptor_store import DescriptorStoreWriter
+
+REDUCTION_METHODS = ("pca", "random")
+
+
+class DescriptorReducer:
+    """Projects descriptor rows onto n_components dimensions.
+
+    Arguments:
+        n_components (int): Dimension of the reduced descriptors.
+        method (str): "pca" for IncrementalPCA, "random" for a sparse random
+            projection (no fitting cost, distances preserved only
+            approximately).
+        sample_size (int): Rows sampled from a store by fit_store.
+        batch_size (int): Rows per IncrementalPCA update.
+        random_state (int): Seed for sampling and the random projection.
+    """
+
+    def __init__(self, n_components=64, method="pca", sample_size=100000,
+                 batch_size=4096, random_state=None):
+        if method not in REDUCTION_METHODS:
+            raise Exception("Unknown reduction method %s" % method)
+        self.n_components = n_components
+        self.method = method
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def check_dim(self, dim):
+        if dim <= self.n_components:
+            raise Exception("Cannot reduce %d dimensional descriptors to %d "
+                            "dimensions, n_components must be below the "
+                            "descriptor dimension" % (dim, self.n_components))
+
+    def fit(self, X):
+        """Fits the projection on a (n_rows x dim) sample and sets
+        explained_variance_ratio_, the fraction of the sample's variance
+        the reduced descriptors keep."""
+        X = np.asarray(X, dtype=np.float32)
+        self.check_dim(X.shape[1])
+        if self.method == "pca":
+            self.model = IncrementalPCA(
+                n_components=self.n_components,
+                batch_size=max(self.batch_size, self.n_components))
+            self.model.fit(X)
+            self.explained_variance_ratio_ = float(
+                np.sum(self.model.explained_variance_ratio_))
+        else:
+            self.model = SparseRandomProjection(
+                n_components=self.n_components,
+                random_state=self.random_state).fit(X)
+            # variance of the sample explained by its best linear
+            # reconstruction from the projection, comparable to PCA's
+            centered = X - X.mean(axis=0)
+            projected = self.model.transform(centered)
+            coef = np.linalg.lstsq(projected, centered, rcond=None)[0]
+            self.explained_variance_ratio_ = float(
+                1 - np.sum(np.square(centered - projected @ coef)) /
+                max(np.sum(np.square(centered)), 1e-12))
+        self.dim = X.shape[1]
+        print("reduced %d dimensional descriptors to %d with %s, explained "
+              "variance %.3f" % (self.dim, self.n_components, self.method,
+                                 self.explained_variance_ratio_))
+        return self
+
+    def fit_store(self, descriptor_store, ids=None):
+        """Fits the projection on a uniform sample of a DescriptorStore's
+        rows."""
+        self.check_dim(descriptor_store.dim)  # before reading any rows
+        sample = reservoir_sample(
+            (rows for _, _, rows in descriptor_store.iter_chunks(ids)),
+            self.sample_size, random_state=self.random_state)
+        return self.fit(sample)
+
+    def transform(self, X, chunk_rows=1 << 16):
+        """Reduces descriptor rows, upcasting compact (uint8 / float16) rows
+        one chunk at a time; returns float32 rows."""
+        out = np.empty((X.shape[0], self.n_components), dtype=np.float32)
+        for start in range(0, X.shape[0], chunk_rows):
+            out[start:start + chunk_rows] = self.model.transform(
+                np.asarray(X[start:start + chunk_rows], dtype=np.float32))
+        return out
+
+    def reduce_store(self, descriptor_store, root, dtype=None,
+                     chunk_rows=1 << 18):
+        """Writes the reduced rows of every image of descriptor_store to a
+        new store at root, one chunk at a time.
+
+        Arguments:
+            descriptor_store: A DescriptorStore.
+            root (str): Directory of the reduced store.
+            dtype: Dtype of the reduced store, that of descriptor_store if
+                None; integer dtypes fall back to float32, since projected
+                values are signed and fractional.
+            chunk_rows (int): Approximate number of rows held at once.
+
+        Returns:
+            The reduced DescriptorStore.
+        """
+        dtype = np.dtype(dtype or descriptor_store.dtype)
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.dtype(np.float32)
+        counts = descriptor_store.counts
+        writer = DescriptorStoreWriter(root, dim=self.n_components,
+                                       dtype=dtype)
+        for start, end, rows in tqdm(
+                descriptor_store.iter_chunks(chunk_rows=chunk_rows),
+                desc="reducing descriptors"):
+            reduced = self.transform(rows)
+            bounds = np.cumsum(counts[start:end])[:-1]
+            for i, des in zip(range(start, end), np.split(reduced, bounds)):
+                writer.append(descriptor_store.paths[i], des)
+        return writer.close()
+
+
+class ReducedCodebook:
+    """A codebook trained on reduced descriptors, with the same predict /
+    n_clusters / cluster_centers_ interface as a fitted KMeans.  predict
+    takes raw descriptors and projects them first; cluster_centers_ are in
+    the reduced space.
+
+    Arguments:
+        reducer: A fitted DescriptorReducer.
+        kmeans: A clustering model fitted on reducer-transformed rows.
+    """
+
+    def __init__(self, reducer, kmeans):
+        self.reducer = reducer
+        self.kmeans = kmeans
+        self.n_clusters = kmeans.n_clusters
+        self.cluster_centers_ = kmeans.cluster_centers_
+
+    def predict(self, X):
+        return self.kmeans.predict(self.reducer.transform(X))
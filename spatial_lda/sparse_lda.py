@@ -0,0 +1,181 @@
+"""Sparse collapsed Gibbs sampling for LDA (Yao, Mimno & McCallum, "Efficient
+Methods for Topic Model Inference on Streaming Document Collections", KDD
+2009).
+
+The full conditional of a token of word w in document d,
+
+    p(z = k) ~ (alpha_k + n_dk) (beta + n_wk) / (V beta + n_k),
+
+is split into three buckets
+
+    s = sum_k alpha_k beta / (V beta + n_k)          (smoothing, all topics)
+    r = sum_k n_dk beta / (V beta + n_k)             (topics of document d)
+    q = sum_k (alpha_k + n_dk) n_wk / (V beta + n_k) (topics of word w)
+
+s and r are kept up to date incrementally, so drawing a topic only walks
+the topics document d and word w actually use; most of the mass sits in q
+and r, and the O(n_topics) walk over s is rarely needed.  Topic counts live
+in dense arrays, and the topics in use by each document and each word in
+array-backed lists beside them.
+
+The sweep runs as compiled code with numba (a dependency, see env/).  The
+plain Python fallback gives the same results, but is orders of magnitude
+slower and only meant for environments without numba.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    COMPILED = True
+except ImportError:  # numba missing, fall back to plain Python
+    COMPILED = False
+    print("numba is not installed, the Gibbs sampler runs as plain Python "
+          "and will be very slow (see env/requirements.txt)")
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True)
+def _remove_topic(topics, n_topics_used, row, k):
+    # swap-remove k from the row's list of topics in use
+    for j in range(n_topics_used[row]):
+        if topics[row, j] == k:
+            n_topics_used[row] -= 1
+            topics[row, j] = topics[row, n_topics_used[row]]
+            return
+
+
+@njit(cache=True)
+def _add_topic(topics, n_topics_used, row, k):
+    topics[row, n_topics_used[row]] = k
+    n_topics_used[row] += 1
+
+
+@njit(cache=True)
+def sparse_gibbs_sweep(doc_ptr, words, z, n_dk, n_wk, n_k, doc_topics,
+                       doc_n_topics, word_topics, word_n_topics, alpha, beta,
+                       uniform):
+    """Resamples the topic z[i] of every token once, in place.
+
+    Arguments:
+        doc_ptr: (n_docs + 1) token offsets; document d owns tokens
+            doc_ptr[d]:doc_ptr[d + 1].
+        words: Word of each token.
+        z: Topic of each token.
+        n_dk, n_wk, n_k: Document-topic, word-topic and topic counts.
+        doc_topics, doc_n_topics: Per document, the topics with n_dk > 0
+            (first doc_n_topics[d] entries of row d).
+        word_topics, word_n_topics: Same per word.
+        alpha: (n_topics) document-topic prior.
+        beta (float): Topic-word prior.
+        uniform: One uniform random number per token.
+    """
+    n_topics = n_k.shape[0]
+    beta_sum = beta * n_wk.shape[0]
+    denom = np.empty(n_topics)
+    q_coef = np.empty(n_topics)
+    s = 0.0
+    for k in range(n_topics):
+        denom[k] = 1.0 / (beta_sum + n_k[k])
+        q_coef[k] = alpha[k] * denom[k]
+        s += alpha[k] * beta * denom[k]
+    q_terms = np.empty(n_topics)
+
+    for d in range(doc_ptr.shape[0] - 1):
+        r = 0.0
+        for j in range(doc_n_topics[d]):
+            k = doc_topics[d, j]
+            r += n_dk[d, k] * beta * denom[k]
+            q_coef[k] = (alpha[k] + n_dk[d, k]) * denom[k]
+
+        for i in range(doc_ptr[d], doc_ptr[d + 1]):
+            w = words[i]
+            t = z[i]
+
+            # take the token out of the counts
+            s -= alpha[t] * beta * denom[t]
+            r -= n_dk[d, t] * beta * denom[t]
+            n_dk[d, t] -= 1
+            n_wk[w, t] -= 1
+            n_k[t] -= 1
+            if n_dk[d, t] == 0:
+                _remove_topic(doc_topics, doc_n_topics, d, t)
+            if n_wk[w, t] == 0:
+                _remove_topic(word_topics, word_n_topics, w, t)
+            denom[t] = 1.0 / (beta_sum + n_k[t])
+            s += alpha[t] * beta * denom[t]
+            r += n_dk[d, t] * beta * denom[t]
+            q_coef[t] = (alpha[t] + n_dk[d, t]) * denom[t]
+
+            q = 0.0
+            for j in range(word_n_topics[w]):
+                k = word_topics[w, j]
+                q_terms[j] = q_coef[k] * n_wk[w, k]
+                q += q_terms[j]
+
+            u = uniform[i] * (s + r + q)
+            t = -1
+            if u < q:
+                for j in range(word_n_topics[w]):
+                    u -= q_terms[j]
+                    if u <= 0:
+                        t = word_topics[w, j]
+                        break
+                if t < 0:  # rounding: last topic of the bucket
+                    t = word_topics[w, word_n_topics[w] - 1]
+            elif u < q + r:
+                u -= q
+                for j in range(doc_n_topics[d]):
+                    k = doc_topics[d, j]
+                    u -= n_dk[d, k] * beta * denom[k]
+                    if u <= 0:
+                        t = k
+                        break
+                if t < 0:
+                    t = doc_topics[d, doc_n_topics[d] - 1]
+            else:
+                u -= q + r
+                for k in range(n_topics):
+                    u -= alpha[k] * beta * denom[k]
+                    if u <= 0:
+                        t = k
+                        break
+                if t < 0:
+                    t = n_topics - 1
+
+            # and back in with its new topic
+            s -= alpha[t] * beta * denom[t]
+            r -= n_dk[d, t] * beta * denom[t]
+            if n_dk[d, t] == 0:
+                _add_topic(doc_topics, doc_n_topics, d, t)
+            if n_wk[w, t] == 0:
+                _add_topic(word_topics, word_n_topics, w, t)
+            n_dk[d, t] += 1
+            n_wk[w, t] += 1
+            n_k[t] += 1
+            denom[t] = 1.0 / (beta_sum + n_k[t])
+            s += alpha[t] * beta * denom[t]
+            r += n_dk[d, t] * beta * denom[t]
+            q_coef[t] = (alpha[t] + n_dk[d, t]) * denom[t]
+            z[i] = t
+
+        # leave the document: its topics fall back to the smoothing term
+        for j in range(doc_n_topics[d]):
+            k = doc_topics[d, j]
+            q_coef[k] = alpha[k] * denom[k]
+
+
+def topic_lists(counts):
+    """Array-backed lists of the topics in use per row of a (rows x
+    n_topics) count table: (topics, n_topics_used)."""
+    topics = np.zeros(counts.shape, dtype=np.int32)
+    n_used = np.zeros(counts.shape[0], dtype=np.int32)
+    rows, cols = np.nonzero(counts)
+    n_used[:] = np.bincount(rows, minlength=counts.shape[0])
+    starts = np.concatenate([[0], np.cumsum(n_used)[:-1]])
+    topics[rows, np.arange(rows.size) - starts[rows]] = cols
+    return topics, n_used
@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+import sparse_lda
+from sparse_lda import sparse_gibbs_sweep, topic_lists
+
+
+def toy_sampler_state(rng, n_docs=12, n_words=15, n_topics=4):
+    """Random topic assignments of a toy corpus, with their count tables and
+    topic lists, in the order sparse_gibbs_sweep takes them."""
+    doc_tokens = rng.randint(0, 20, size=n_docs)
+    doc_ptr = np.concatenate([[0], np.cumsum(doc_tokens)])
+    docs = np.repeat(np.arange(n_docs), doc_tokens)
+    words = rng.randint(n_words, size=docs.size).astype(np.int32)
+    z = rng.randint(n_topics, size=docs.size).astype(np.int32)
+    n_dk = np.zeros((n_docs, n_topics), dtype=np.int32)
+    n_wk = np.zeros((n_words, n_topics), dtype=np.int32)
+    np.add.at(n_dk, (docs, z), 1)
+    np.add.at(n_wk, (words, z), 1)
+    n_k = n_wk.sum(axis=0).astype(np.int32)
+    return (doc_ptr, words, z, n_dk, n_wk, n_k) + topic_lists(n_dk) + \
+        topic_lists(n_wk)
+
+
+class SparseGibbsSweepTestCase(unittest.TestCase):
+    @unittest.skipUnless(sparse_lda.COMPILED, "numba is not installed")
+    def test_compiled_matches_python(self):
+        rng = np.random.RandomState(0)
+        compiled = toy_sampler_state(rng)
+        python = [a.copy() for a in compiled]
+        alpha = np.full(compiled[3].shape[1], 0.1)
+        for _ in range(5):
+            uniform = rng.random_sample(compiled[2].size)
+            sparse_gibbs_sweep(*compiled, alpha, 0.01, uniform)
+            sparse_gibbs_sweep.py_func(*python, alpha, 0.01, uniform)
+        for a, b in zip(compiled, python):
+            np.testing.assert_array_equal(a, b)
+
+    def test_counts_stay_consistent(self):
+        rng = np.random.RandomState(0)
+        state = toy_sampler_state(rng)
+        (doc_ptr, words, z, n_dk, n_wk, n_k, doc_topics, doc_n_topics,
+         word_topics, word_n_topics) = state
+        n_topics = n_dk.shape[1]
+        docs = np.repeat(np.arange(n_dk.shape[0]), np.diff(doc_ptr))
+        alpha = np.full(n_topics, 0.1)
+        for _ in range(5):
+            sparse_gibbs_sweep(*state, alpha, 0.01,
+                               rng.random_sample(z.size))
+
+        expected = np.zeros_like(n_dk)
+        np.add.at(expected, (docs, z), 1)
+        np.testing.assert_array_equal(n_dk, expected)
+        expected = np.zeros_like(n_wk)
+        np.add.at(expected, (words, z), 1)
+        np.testing.assert_array_equal(n_wk, expected)
+        np.testing.assert_array_equal(n_k, np.bincount(z, minlength=n_topics))
+        for counts, topics, n_used in ((n_dk, doc_topics, doc_n_topics),
+                                       (n_wk, word_topics, word_n_topics)):
+            for row in range(counts.shape[0]):
+                self.assertEqual(sorted(topics[row, :n_used[row]]),
+                                 list(np.flatnonzero(counts[row])))
+
+if __name__ == '__main__':
+    unittest.main()
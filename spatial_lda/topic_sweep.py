@@ -0,0 +1,300 @@
+"""Warm-started sweep over the number of LDA topics.
+
+Picking n_topics used to mean refitting LDA from scratch for every value.
+sweep_topics fits all values on one cached feature matrix at a fraction of
+that cost:
+
+  * the feature matrix (and the seed model's document topics) is written
+    once as raw arrays and memory mapped by every worker process, instead
+    of being pickled to each of them;
+  * a cheap seed model (the smallest n_topics, fit on a subsample of the
+    documents for a few sweeps) is fit first, and every cell starts its
+    sampler from the seed's topics, split up to the cell's n_topics
+    (split_topics), instead of from random topics;
+  * each cell stops once its held-out perplexity has plateaued.
+
+Held-out perplexity is measured by document completion: the tokens of each
+held-out document are split in two at random, the document's topics are
+inferred from one half and the perplexity scored on the other, so no token
+is both used to infer topics and scored.
+
+Cells run in parallel processes.
+
+The sweep fits LDA2, the collapsed Gibbs sampler (compiled with numba, see
+sparse_lda), because warm starting needs a sampler that can start from
+given topics.  The pipeline itself (lda.main, grid_runner) deploys sklearn's
+variational LatentDirichletAllocation, so the perplexities rank numbers of
+topics for the model family, not for the exact deployed fit; refit the
+chosen n_topics with LDA2.off_the_shelf_LDA to compare.
+"""
+
+import os
+import json
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.sparse
+
+from lda import LDA2, transform_documents
+
+# Hyperparameters
+sweep_max_iter = 300  # Gibbs sweeps per cell at most
+sweep_check_every = 5  # sweeps between held-out perplexity checks
+sweep_plateau_tol = 1e-3  # relative perplexity gain that counts as a plateau
+sweep_patience = 2  # consecutive plateaued checks before a cell stops
+sweep_test_fraction = 0.1  # documents held out for the perplexity checks
+seed_sample_fraction = 0.25  # documents the seed model is fit on
+seed_iter = 50  # Gibbs sweeps of the seed model
+n_sweep_workers = os.cpu_count()  # processes running the cells
+
+SHARED_ARRAYS = ("data", "indices", "indptr")
+
+
+def share_feature_matrix(M, root):
+    """Writes a feature matrix as raw CSR arrays under root, for
+    load_shared_feature_matrix to memory map."""
+    M = scipy.sparse.csr_matrix(M)
+    os.makedirs(root, exist_ok=True)
+    for name in SHARED_ARRAYS:
+        np.save(os.path.join(root, name + ".npy"), getattr(M, name))
+    with open(os.path.join(root, "shape.json"), "w") as f:
+        json.dump(list(M.shape), f)
+
+
+def load_shared_feature_matrix(root):
+    """The matrix written by share_feature_matrix, backed by read-only
+    memory maps of its arrays."""
+    with open(os.path.join(root, "shape.json"), "r") as f:
+        shape = tuple(json.load(f))
+    arrays = [np.load(os.path.join(root, name + ".npy"), mmap_mode="r")
+              for name in SHARED_ARRAYS]
+    return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def split_topics(theta, phi, n_topics, random_state=None, noise=0.1):
+    """Grows a (theta, phi) pair to n_topics topics by repeatedly splitting
+    the topic with the most document mass into two: each half gets half of
+    the topic's document weight and a randomly perturbed copy of its word
+    distribution.
+
+    The grown theta is allocated once and filled column by column, so a
+    memory mapped theta is read once and never copied whole per split.
+
+    Arguments:
+        theta: (n_documents x k) document-topic distributions.
+        phi: (k x vocab_size) topic-word distributions, k <= n_topics.
+        n_topics (int): Number of topics wanted.
+        random_state (int): Seed of the perturbations.
+        noise (float): Relative size of the perturbations.
+
+    Returns:
+        (theta, phi) with n_topics topics; theta and phi themselves when
+        there is nothing to split.
+    """
+    k = phi.shape[0]
+    if n_topics < k:
+        raise Exception("Cannot split %d topics into %d" % (k, n_topics))
+    if n_topics == k:
+        return theta, phi
+    rng = np.random.RandomState(random_state)
+    split_theta = np.empty((theta.shape[0], n_topics), dtype=np.float64)
+    split_theta[:, :k] = theta
+    split_phi = np.empty((n_topics, phi.shape[1]), dtype=np.float64)
+    split_phi[:k] = phi
+    mass = split_theta[:, :k].sum(axis=0).tolist()  # document mass per topic
+    for new in range(k, n_topics):
+        t = int(np.argmax(mass))
+        split_theta[:, t] /= 2
+        split_theta[:, new] = split_theta[:, t]
+        mass[t] /= 2
+        mass.append(mass[t])
+        halves = split_phi[t] * (1 + noise * rng.uniform(-1, 1,
+                                                         (2, phi.shape[1])))
+        halves /= halves.sum(axis=1, keepdims=True)
+        split_phi[t], split_phi[new] = halves
+    return split_theta, split_phi
+
+
+def fit_seed_model(M, n_topics, sample_fraction=seed_sample_fraction,
+                   n_iter=seed_iter, alpha=1, beta=1, random_state=None):
+    """Fits the cheap seed model: n_topics topics on a random subsample of
+    the documents, for n_iter sweeps.
+
+    Returns:
+        The seed's (n_topics x vocab_size) topic-word distributions.
+    """
+    rng = np.random.RandomState(random_state)
+    n_docs = max(1, int(round(sample_fraction * M.shape[0])))
+    sample = np.sort(rng.choice(M.shape[0], n_docs, replace=False))
+    seed = LDA2("", M[sample], alpha=alpha, beta=beta, n_topics=n_topics,
+                random_state=random_state)
+    seed.init_LDA()
+    seed.gibbs_sampler(n_iter)
+    return seed.get_phi()
+
+
+def split_document_tokens(X, random_state=None):
+    """Splits every token of count matrix X into one of two halves at
+    random, for document completion.
+
+    Returns:
+        (observed, scored), two count matrices that add up to X.
+    """
+    X = scipy.sparse.csr_matrix(X)
+    counts = np.rint(X.data).astype(np.int64)
+    rng = np.random.RandomState(random_state)
+    observed_counts = rng.binomial(counts, 0.5)
+    # each half gets its own index arrays, eliminate_zeros edits them
+    observed = scipy.sparse.csr_matrix(
+        (observed_counts, X.indices.copy(), X.indptr.copy()), shape=X.shape)
+    scored = scipy.sparse.csr_matrix(
+        (counts - observed_counts, X.indices.copy(), X.indptr.copy()),
+        shape=X.shape)
+    observed.eliminate_zeros()
+    scored.eliminate_zeros()
+    return observed, scored
+
+
+def fit_until_plateau(model, observed, scored, theta=None, phi=None,
+                      max_iter=sweep_max_iter, check_every=sweep_check_every,
+                      plateau_tol=sweep_plateau_tol, patience=sweep_patience):
+    """Runs model's sampler, warm started from (theta, phi) when given,
+    until its held-out perplexity improves by less than plateau_tol
+    (relative) on patience consecutive checks, or for max_iter sweeps.
+
+    The held-out documents' topics are inferred from their observed
+    tokens and the perplexity is computed on their scored tokens (see
+    split_document_tokens).
+
+    Returns:
+        The list of held-out perplexities, one per check.
+    """
+    model.init_LDA(theta, phi)
+    perplexities = []
+    plateaued = 0
+    held_out_theta = None
+    for it in range(0, max_iter, check_every):
+        model.gibbs_sampler(check_every)
+        # the topics move little between checks, so each held-out
+        # transform starts from the last one
+        held_out_theta = transform_documents(
+            observed, model.get_phi(), model.get_alpha(),
+            theta=held_out_theta)
+        perplexities.append(float(np.exp(-model.token_log_likelihood(
+            scored, held_out_theta))))
+        if len(perplexities) > 1:
+            gain = (perplexities[-2] - perplexities[-1]) / perplexities[-2]
+            plateaued = plateaued + 1 if gain < plateau_tol else 0
+            if plateaued >= patience:
+                break
+    model.components_ = model.n_wk.T + model.beta
+    return perplexities
+
+
+_worker_config = None
+
+
+def _init_sweep_worker(config):
+    global _worker_config
+    _worker_config = config
+
+
+def _sweep_worker(n_topics):
+    config = _worker_config
+    M = load_shared_feature_matrix(config["matrix_root"])
+    train, held_out = M[config["train"]], M[config["test"]]
+    model = LDA2("", train, alpha=config["alpha"], beta=config["beta"],
+                 n_topics=n_topics, random_state=config["random_state"])
+    theta = phi = None
+    if config["seed_phi"] is not None:
+        seed_theta = np.load(config["seed_theta_path"], mmap_mode="r")
+        theta, phi = split_topics(seed_theta, config["seed_phi"], n_topics,
+                                  config["random_state"])
+    start = time.time()
+    observed, scored = split_document_tokens(held_out,
+                                             config["random_state"])
+    perplexities = fit_until_plateau(model, observed, scored, theta, phi,
+                                     **config["fit_kwargs"])
+    result = dict(n_topics=n_topics,
+                  sweeps=len(perplexities) * config["fit_kwargs"].get(
+                      "check_every", sweep_check_every),
+                  fit_seconds=time.time() - start,
+                  held_out_perplexity=perplexities[-1])
+    print("%d topics: held-out perplexity %.2f after %d sweeps (%.1fs)" % (
+        n_topics, result["held_out_perplexity"], result["sweeps"],
+        result["fit_seconds"]))
+    return result
+
+
+def sweep_topics(feature_path, topic_values, matrix_root, warm_start=True,
+                 alpha=1, beta=1, test_fraction=sweep_test_fraction,
+                 n_workers=n_sweep_workers, random_state=0, **fit_kwargs):
+    """Fits LDA2 for every number of topics in topic_values and reports
+    its held-out perplexity.
+
+    Arguments:
+        feature_path: Feature matrix, or its path, as taken by LDA2.
+        topic_values (list): Numbers of topics to fit.
+        matrix_root (str): Directory the shared copy of the feature matrix
+            is written to (reused when it is already there), along with the
+            seed model's document topics.
+        warm_start (bool): Seed every cell from the split topics of a cheap
+            seed model (see module docstring); False starts every cell
+            from random topics, for comparison.
+        alpha, beta: Priors of every model.
+        test_fraction (float): Documents held out for the perplexity.
+        n_workers (int): Processes running the cells; 1 runs in this
+            process.
+        random_state (int): Seed for the split, the seed model and the
+            samplers.
+        fit_kwargs: max_iter, check_every, plateau_tol or patience for
+            fit_until_plateau.
+
+    Returns:
+        A list with one dictionary per cell: n_topics, sweeps, fit_seconds
+        and held_out_perplexity.  The seed model's cost is reported as
+        seed_seconds on every cell.
+    """
+    topic_values = sorted(topic_values)
+    if not os.path.exists(os.path.join(matrix_root, "shape.json")):
+        share_feature_matrix(LDA2("", feature_path).M, matrix_root)
+    M = load_shared_feature_matrix(matrix_root)
+    order = np.random.RandomState(random_state).permutation(M.shape[0])
+    n_test = int(round(test_fraction * M.shape[0]))
+    config = dict(matrix_root=matrix_root, alpha=alpha, beta=beta,
+                  test=np.sort(order[:n_test]), train=np.sort(order[n_test:]),
+                  random_state=random_state, fit_kwargs=fit_kwargs,
+                  seed_phi=None)
+
+    start = time.time()
+    if warm_start:
+        train = M[config["train"]]
+        config["seed_phi"] = fit_seed_model(
+            train, topic_values[0], alpha=alpha, beta=beta,
+            random_state=random_state)
+        # the seed's topics for every training document, split per cell and
+        # shared with the workers like the feature matrix
+        config["seed_theta_path"] = os.path.join(
+            matrix_root, "seed_theta_%d_topics_%s.npy" % (topic_values[0],
+                                                          random_state))
+        np.save(config["seed_theta_path"], transform_documents(
+            train, config["seed_phi"], np.mean(alpha)))
+    seed_seconds = time.time() - start
+
+    if n_workers is None or n_workers <= 1 or len(topic_values) <= 1:
+        _init_sweep_worker(config)
+        results = [_sweep_worker(k) for k in topic_values]
+    else:
+        # largest cells first, so the pool is not left waiting on one
+        with Pool(min(n_workers, len(topic_values)),
+                  initializer=_init_sweep_worker,
+                  initargs=(config,)) as pool:
+            results = pool.map(_sweep_worker, topic_values[::-1],
+                               chunksize=1)[::-1]
+    for result in results:
+        result["seed_seconds"] = seed_seconds
+    print("%s sweep over %s topics took %.1fs" % (
+        "warm started" if warm_start else "cold", topic_values,
+        time.time() - start))
+    return results
@@ -3,8 +3,10 @@ from models.ResNet import *
 from dataset import *
 from torchvision import transforms
 from skimage import io
+import datetime
 import gc
 import os
+import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -17,9 +19,13 @@ from models.ResNet import *
 from models.InceptionV3 import *
 from models.SegNet import *
 from utils import topNError, saveErrorGraph
+from inference_engine import precision_context
 
 # Hyperparameters
 cnnLr, cnnDropout = 1e-3, 0.5
+# "bfloat16" trains under autocast (bf16 convolutions / matmuls, float32
+# weights and optimizer state); channels_last runs NHWC tensors
+cnnPrecision, cnnChannelsLast = "float32", False
 
 # Set up GPU env and get relevant file paths and directories
 cnnModelPath = os.path.join('models', 'bestCNNmodel')
@@ -74,16 +80,34 @@ def test():
 
 
 def cnnEpoch(model, loader, device, criterion, output_period, epoch,
-             optimizer=None):
+             optimizer=None, precision=None, channels_last=None,
+             teacher=None):
+    """
+    One pass over loader, training model when an optimizer is given.  With
+    a teacher network the model learns to regress the teacher's outputs
+    (distillation) instead of the labels, and the summed loss takes the
+    place of the top 1 error in the returned errors.
+    """
+    precision = cnnPrecision if precision is None else precision
+    channels_last = cnnChannelsLast if channels_last is None \
+        else channels_last
     running_loss = 0.0
     num_batches = len(loader)
     errors = np.zeros(2)
     for batch_num, (inputs, labels) in enumerate(loader, 1):
         inputs = inputs.to(device)
-        labels = np.array(labels).to(device)
-
-        outputs = model(inputs)
-        loss = criterion(outputs, labels)
+        if channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        if teacher is not None:
+            with torch.no_grad():
+                labels = teacher(inputs).float()
+        else:
+            labels = np.array(labels).to(device)
+
+        with precision_context(precision, device.type):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+        outputs = outputs.float()
         if optimizer is not None:
             optimizer.zero_grad()
             loss.backward()
@@ -98,7 +122,10 @@ def cnnEpoch(model, loader, device, criterion, output_period, epoch,
             ))
             running_loss = 0.0
         gc.collect()
-        errors += topNError(outputs, labels, [1, 2], False)
+        if teacher is not None:
+            errors[0] += loss.item() * inputs.shape[0]
+        else:
+            errors += topNError(outputs, labels, [1, 2], False)
     return errors
 
 
@@ -129,11 +156,115 @@ def trainCNN(modelName='resnet'):
     # setup the device for running
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
+    if cnnChannelsLast:
+        model = model.to(memory_format=torch.channels_last)
     model.eval()
 
     return model
 
 
+def distillStudent(teacherName, studentName=None, tap=None,
+                   widths=(32, 64, 128), layers=(1, 1, 1), num_epochs=10,
+                   batch_size=32, val_fraction=0.1, output_period=50):
+    """
+    Trains a small StudentResNet to regress the activations of a truncated
+    teacher backbone on the dataset's images (mean squared error), keeps the
+    weights with the lowest validation loss and saves them as a backbone
+    (see backbones.StudentSpec), so that feature_model = studentName with
+    cnn_num_layers_removed = 0 extracts features with the student.
+
+    Arguments:
+        teacherName (str): Backbone to distill, see backbones.BACKBONES.
+        studentName (str): Name of the student backbone, by default
+            "student_<teacher>_<tap>".
+        tap: Truncation point of the teacher, its default tap if None.
+        widths, layers: Channels and blocks of the student's stages.
+        num_epochs (int): Passes over the training images.
+        batch_size (int): Images per update.
+        val_fraction (float): Images held out to pick the best epoch.
+    """
+    import backbones
+    from feature_extraction import backbone_weights_root, \
+        truncated_backbone_root, get_cnn_dataset, cnn_num_workers
+    spec = backbones.get_backbone_spec(teacherName)
+    tap = spec.default_tap if tap is None else tap
+    studentName = studentName or "student_%s_%s" % (
+        spec.name, str(tap).replace(".", "_"))
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    teacher = backbones.load_truncated_backbone(
+        teacherName, tap, weights_root=backbone_weights_root,
+        truncated_root=truncated_backbone_root).to(device).eval()
+    channels, _ = backbones.get_descriptor_shape(
+        teacherName, tap, truncated_root=truncated_backbone_root)
+    with torch.no_grad():
+        out_size = teacher(torch.zeros(1, 3, spec.input_size,
+                                       spec.input_size,
+                                       device=device)).shape[2:]
+    kwargs = {"out_channels": int(channels),
+              "out_size": [int(n) for n in out_size],
+              "widths": list(widths), "layers": list(layers)}
+    studentSpec = backbones.StudentSpec(studentName, spec.name, tap, kwargs)
+    model = studentSpec.construct().to(device)
+    if cnnChannelsLast:
+        model = model.to(memory_format=torch.channels_last)
+        teacher = teacher.to(memory_format=torch.channels_last)
+
+    dataset = get_cnn_dataset(teacherName)
+    num_val = max(1, int(len(dataset) * val_fraction))
+    train_set, val_set = torch.utils.data.random_split(
+        dataset, [len(dataset) - num_val, num_val],
+        generator=torch.Generator().manual_seed(0))
+    num_workers = cnn_num_workers if cnn_num_workers is not None else \
+        max(1, (os.cpu_count() or 1) // 4)
+    train_loader = torch.utils.data.DataLoader(
+        train_set, batch_size=batch_size, shuffle=True,
+        num_workers=num_workers)
+    val_loader = torch.utils.data.DataLoader(
+        val_set, batch_size=batch_size, shuffle=False,
+        num_workers=num_workers)
+
+    criterion = nn.MSELoss().to(device)
+    optimizer = optim.Adam(model.parameters(), lr=cnnLr)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min',
+                                                           patience=2)
+    bestValLoss, bestState = np.inf, None
+    print('Distilling %s into %s' % (teacherName, studentName))
+    for epoch in range(1, num_epochs + 1):
+        model.train()
+        trainLoss = cnnEpoch(model, train_loader, device, criterion,
+                             output_period, epoch, optimizer=optimizer,
+                             teacher=teacher)[0] / len(train_set)
+        model.eval()
+        with torch.no_grad():
+            valLoss = cnnEpoch(model, val_loader, device, criterion,
+                               output_period, epoch,
+                               teacher=teacher)[0] / len(val_set)
+        print('Epoch %d: train loss %.4f, val loss %.4f' % (
+            epoch, trainLoss, valLoss))
+        if valLoss < bestValLoss:
+            bestValLoss = valLoss
+            bestState = {k: v.detach().cpu().clone()
+                         for k, v in model.state_dict().items()}
+        scheduler.step(valLoss)
+
+    # saved like downloaded weights, so backbones.load_backbone finds them
+    os.makedirs(backbone_weights_root, exist_ok=True)
+    torch.save(bestState, os.path.join(backbone_weights_root,
+                                       "%s.pth" % studentName))
+    # microseconds, so two trainings within a second still differ
+    studentSpec.trained_at = datetime.datetime.now().isoformat()
+    backbones.save_student_spec(studentSpec, backbone_weights_root)
+    # drop a truncated copy saved from earlier weights
+    truncated_path = backbones.get_truncated_path(studentName, 0,
+                                                  truncated_backbone_root)
+    for path in (truncated_path, truncated_path[:-len(".pt")] + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+    model.load_state_dict(bestState)
+    return model.eval()
+
+
 ################################################################################
 # AUXILIARY CODE
 ################################################################################
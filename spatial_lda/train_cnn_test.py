@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import torch
+import torchvision
+import backbones
+import feature_extraction as fe
+import train_cnn
+
+STUDENT = "student_test"
+
+
+def random_images(n_images, size=224):
+    generator = torch.Generator().manual_seed(0)
+    return [(torch.randn(3, size, size, generator=generator), 0)
+            for _ in range(n_images)]
+
+
+class DistillStudentTestCase(unittest.TestCase):
+    def tearDown(self):
+        backbones.BACKBONES.pop(STUDENT, None)
+
+    def distill(self):
+        return train_cnn.distillStudent(
+            "alexnet", STUDENT, widths=(4, 8, 8), layers=(1, 1, 1),
+            num_epochs=1, batch_size=2, val_fraction=0.25)
+
+    def test_student_is_saved_and_registered(self):
+        with tempfile.TemporaryDirectory() as root:
+            weights_root = os.path.join(root, "weights")
+            os.makedirs(weights_root)
+            # random teacher weights, so nothing is downloaded
+            torch.save(torchvision.models.alexnet().state_dict(),
+                       os.path.join(weights_root, "alexnet.pth"))
+            with fe.hyperparameters(
+                    backbone_weights_root=weights_root,
+                    truncated_backbone_root=os.path.join(root, "truncated"),
+                    cnn_num_workers=0), \
+                    mock.patch.object(fe, "get_cnn_dataset",
+                                      lambda name: random_images(4)):
+                student = self.distill()
+                spec_path = os.path.join(weights_root, "%s.json" % STUDENT)
+                with open(spec_path, "r") as f:
+                    meta = json.load(f)
+                self.assertEqual(meta["teacher"], "alexnet")
+                self.assertIsNotNone(meta["trained_at"])
+                self.assertTrue(os.path.exists(
+                    os.path.join(weights_root, "%s.pth" % STUDENT)))
+
+                teacher = backbones.load_truncated_backbone(
+                    "alexnet", weights_root=weights_root,
+                    truncated_root=os.path.join(root, "truncated"))
+                inputs = torch.zeros(1, 3, 224, 224)
+                with torch.no_grad():
+                    self.assertEqual(student(inputs).shape,
+                                     teacher(inputs).shape)
+
+                # a fresh process finds the student in the weights directory
+                backbones.BACKBONES.pop(STUDENT)
+                with mock.patch.object(backbones, "default_weights_root",
+                                       weights_root):
+                    spec = backbones.get_backbone_spec(STUDENT)
+                self.assertIsInstance(spec, backbones.StudentSpec)
+                self.assertEqual(spec.trained_at, meta["trained_at"])
+                model = backbones.load_backbone(STUDENT,
+                                                weights_root=weights_root)
+                with torch.no_grad():
+                    self.assertTrue(torch.equal(model(inputs),
+                                                student(inputs)))
+
+                # retraining invalidates features of the old weights
+                self.distill()
+                with open(spec_path, "r") as f:
+                    self.assertNotEqual(json.load(f)["trained_at"],
+                                        meta["trained_at"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Hierarchical k-means vocabulary tree (Nister & Stewenius, "Scalable
+Recognition with a Vocabulary Tree", CVPR 2006).
+
+The tree recursively splits the descriptors into branching_factor clusters
+up to a fixed depth, giving branching_factor ** depth visual words.  A
+descriptor is quantized by descending the tree, which costs
+branching_factor * depth distance computations instead of one per word for
+a flat codebook.  VocabularyTree exposes the same fit / predict /
+n_clusters / cluster_centers_ interface as the fitted KMeans objects used by
+build_histogram and validation.get_prediction_for_image.
+"""
+
+import sys
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from codebook import reservoir_sample
+
+
+class VocabularyTree:
+    """Vocabulary tree quantizer.
+
+    Leaves are numbered node by node at the deepest level, so predict
+    returns words in [0, branching_factor ** depth).  Leaves that no
+    training descriptor reached are never predicted and simply stay empty
+    in the histograms.
+
+    Arguments:
+        branching_factor (int): Number of children per node.
+        depth (int): Number of levels below the root.
+        sample_size (int): Rows sampled from a store by fit_store.
+        random_state (int): Seed for k-means and sampling.
+    """
+
+    def __init__(self, branching_factor=10, depth=3, sample_size=200000,
+                 random_state=None):
+        self.branching_factor = branching_factor
+        self.depth = depth
+        self.sample_size = sample_size
+        self.random_state = random_state
+        self.n_clusters = branching_factor ** depth
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        b = self.branching_factor
+        self.centers = []  # per level: (b ** level, b, dim) child centers
+        self.valid = []  # per level: (b ** level, b) child reached in fit
+        node = np.zeros(X.shape[0], dtype=np.int64)
+        for level in range(self.depth):
+            n_nodes = b ** level
+            centers = np.zeros((n_nodes, b, X.shape[1]), dtype=np.float32)
+            valid = np.zeros((n_nodes, b), dtype=bool)
+            child = np.zeros(X.shape[0], dtype=np.int64)
+            order = np.argsort(node, kind="stable")
+            bounds = np.searchsorted(node[order], np.arange(n_nodes + 1))
+            for n in range(n_nodes):
+                rows = order[bounds[n]:bounds[n + 1]]
+                if rows.size == 0:
+                    continue
+                if rows.size <= b:
+                    # too few descriptors to split: one child per descriptor
+                    centers[n, :rows.size] = X[rows]
+                    valid[n, :rows.size] = True
+                    child[rows] = np.arange(rows.size)
+                    continue
+                kmeans = KMeans(n_clusters=b, n_init=1,
+                                random_state=self.random_state).fit(X[rows])
+                centers[n] = kmeans.cluster_centers_
+                valid[n] = True
+                child[rows] = kmeans.labels_
+            self.centers.append(centers)
+            self.valid.append(valid)
+            node = node * b + child
+
+        # Leaf centers, for code that reads cluster_centers_; leaves no
+        # descriptor reached take their parent's center
+        dim = X.shape[1]
+        leaf_centers = self.centers[-1].reshape(-1, dim)
+        fallback = leaf_centers
+        if self.depth > 1:
+            fallback = np.repeat(self.centers[-2].reshape(-1, dim), b, axis=0)
+        self.cluster_centers_ = np.where(self.valid[-1].reshape(-1, 1),
+                                         leaf_centers, fallback)
+        return self
+
+    def fit_store(self, descriptor_store, ids=None):
+        """Fits the tree on a uniform sample of a DescriptorStore's rows."""
+        sample = reservoir_sample(
+            (rows for _, _, rows in descriptor_store.iter_chunks(ids)),
+            self.sample_size, random_state=self.random_state)
+        return self.fit(sample)
+
+    def predict(self, X, chunk_rows=1 << 16):
+        b = self.branching_factor
+        if not hasattr(self, "_sq_norms"):
+            self._sq_norms = [np.where(valid, np.sum(centers ** 2, axis=2),
+                                       np.inf)
+                              for centers, valid in zip(self.centers,
+                                                        self.valid)]
+        words = np.empty(X.shape[0], dtype=np.int64)
+        for start in range(0, X.shape[0], chunk_rows):
+            # compact (uint8 / float16) rows are upcast one chunk at a time
+            x = np.asarray(X[start:start + chunk_rows], dtype=np.float32)
+            node = np.zeros(x.shape[0], dtype=np.int64)
+            for centers, sq_norms in zip(self.centers, self._sq_norms):
+                # one small matrix product per node against its b children
+                order = np.argsort(node, kind="stable")
+                nodes, bounds = np.unique(node[order], return_index=True)
+                bounds = np.append(bounds, order.size)
+                child = np.empty_like(node)
+                for n, lo, hi in zip(nodes, bounds[:-1], bounds[1:]):
+                    rows = order[lo:hi]
+                    dist = sq_norms[n] - 2 * (x[rows] @ centers[n].T)
+                    child[rows] = np.argmin(dist, axis=1)
+                node = node * b + child
+            words[start:start + chunk_rows] = node
+        return words
+
+
+def quantization_error(X, centers, words):
+    """Mean squared distance between descriptors and their assigned word."""
+    return float(np.mean(np.sum(np.square(X - centers[words]), axis=1)))
+
+
+def benchmark_vocabulary_tree(X_train, X_test, shapes=((10, 2), (10, 3)),
+                              random_state=0):
+    """Compares vocabulary trees against flat codebooks of the same size.
+
+    For each (branching_factor, depth) it reports the time to quantize
+    X_test, the quantization error of both codebooks and the fraction of
+    descriptors the tree sends to the same leaf an exhaustive search over
+    the tree's own leaves would pick.
+
+    Returns:
+        A list of dictionaries, one per shape.
+    """
+    X_train = np.asarray(X_train, dtype=np.float32)
+    X_test = np.asarray(X_test, dtype=np.float32)
+    results = []
+    for b, depth in shapes:
+        tree = VocabularyTree(b, depth, random_state=random_state).fit(X_train)
+        flat = MiniBatchKMeans(n_clusters=b ** depth,
+                               random_state=random_state).fit(X_train)
+
+        start = time.time()
+        tree_words = tree.predict(X_test)
+        tree_time = time.time() - start
+        start = time.time()
+        flat_words = flat.predict(X_test)
+        flat_time = time.time() - start
+
+        leaves = np.flatnonzero(tree.valid[-1].reshape(-1))
+        leaf_centers = tree.cluster_centers_[leaves]
+        exhaustive = leaves[np.argmin(
+            np.sum(leaf_centers ** 2, axis=1)[None, :] -
+            2 * X_test @ leaf_centers.T, axis=1)]
+
+        result = {"branching_factor": b, "depth": depth,
+                  "n_words": b ** depth,
+                  "tree_seconds": tree_time, "flat_seconds": flat_time,
+                  "speedup": flat_time / max(tree_time, 1e-9),
+                  "tree_error": quantization_error(
+                      X_test, tree.cluster_centers_, tree_words),
+                  "flat_error": quantization_error(
+                      X_test, flat.cluster_centers_, flat_words),
+                  "leaf_agreement": float(np.mean(tree_words == exhaustive))}
+        print("b=%(branching_factor)d depth=%(depth)d words=%(n_words)d: "
+              "%(speedup).1fx faster than flat, quantization error "
+              "%(tree_error).1f vs %(flat_error).1f, "
+              "leaf agreement %(leaf_agreement).3f" % result)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    # usage: python vocab_tree.py <descriptor store directory>
+    from descriptor_store import DescriptorStore
+    store = DescriptorStore(sys.argv[1])
+    sample = reservoir_sample((rows for _, _, rows in store.iter_chunks()),
+                              120000, random_state=0)
+    benchmark_vocabulary_tree(sample[:100000], sample[100000:])
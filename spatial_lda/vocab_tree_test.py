@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+from vocab_tree import VocabularyTree
+
+
+class VocabularyTreeTestCase(unittest.TestCase):
+    def test_predict_matches_nearest_leaf(self):
+        # 4 well separated groups of 4 tight blobs each, one blob per leaf
+        # of a 4 x 2 tree, so descending the tree finds the nearest leaf
+        rng = np.random.RandomState(0)
+        groups = rng.uniform(-100, 100, size=(4, 1, 3))
+        blobs = (groups + rng.uniform(-10, 10, size=(4, 4, 3))).reshape(-1, 3)
+
+        def sample(n):
+            return np.vstack([blob + rng.randn(n, 3) * 0.5 for blob in blobs])
+
+        tree = VocabularyTree(branching_factor=4, depth=2,
+                              random_state=0).fit(sample(20))
+        self.assertEqual(tree.n_clusters, 16)
+        X = sample(10)
+        words = tree.predict(X, chunk_rows=7)
+        distances = np.sum(np.square(
+            X[:, None, :] - tree.cluster_centers_[None]), axis=2)
+        np.testing.assert_array_equal(words, np.argmin(distances, axis=1))
+        self.assertEqual(len(np.unique(words)), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()